@@ -1,13 +1,35 @@
+import warnings
+
 import pandas as pd
 import numpy as np
 
+from bitparallel import (
+    WORD,
+    subsequence_lengths,
+)
+from Modules.instrument import (
+    batch_pairs,
+    timed,
+)
+from strbatch import (
+    PRUNED,
+    StringColumn,
+    count_pruned,
+    length_groups,
+)
+
 # This code is contributed by Soumen Ghosh
 #######################################################################################
 
 
-def longest_common_substring_similarity(s1, s2, norm='dice', min_len=2):
+def longest_common_substring_similarity(s1,
+                                        s2,
+                                        norm='dice',
+                                        min_len=2,
+                                        min_score=None):
     """
-    longest_common_substring_similarity(s1, s2, norm='dice', min_len=2)
+    longest_common_substring_similarity(s1, s2, norm='dice', min_len=2,
+                                        min_score=None)
     An implementation of the longest common substring similarity algorithm
     described in Christen, Peter (2012).
     Parameters
@@ -20,6 +42,9 @@ def longest_common_substring_similarity(s1, s2, norm='dice', min_len=2):
         The name of the normalization applied to the raw length computed by
         the lcs algorithm. One of "overlap", "jaccard", or "dice". Default:
         "dice""
+    min_score : float
+        Similarity threshold, see longest_common_substring_batch.
+        Default: None
     Returns
     -------
     pandas.Series
@@ -32,153 +57,391 @@ def longest_common_substring_similarity(s1, s2, norm='dice', min_len=2):
     if len(s1) == len(s2) == 0:
         return []
 
-    conc = pd.Series(list(zip(s1, s2)))
-
-    def lcs_iteration(x):
-        """
-        lcs_iteration(x)
-        A helper function implementation of a single iteration longest common
-        substring algorithm, adapted from https://en.wikibooks.org/wiki/Algori
-        thm_Implementation/Strings/Longest_common_substring. but oriented
-        towards the iterative approach described by Christen, Peter (2012).
-        Parameters
-        ----------
-        x : A series containing the two strings to be compared.
-        Returns
-        -------
-        A tuple of strings and a substring length i.e. ((str, str), int).
-        """
-
-        str1 = x[0]
-        str2 = x[1]
-
-        if str1 is np.nan or str2 is np.nan or min(len(str1),
-                                                   len(str2)) < min_len:
-            longest = 0
-            new_str1 = None
-            new_str2 = None
-        else:
-            # Creating a matrix of 0s for preprocessing
-            m = [[0] * (1 + len(str2)) for _ in range(1 + len(str1))]
-
-            # Track length of longest substring seen
-            longest = 0
-
-            # Track the ending position of this substring in str1 (x) and
-            # str2(y)
-            x_longest = 0
-            y_longest = 0
-
-            # Create matrix of substring lengths
-            for x in range(1, 1 + len(str1)):
-                for y in range(1, 1 + len(str2)):
-                    # Check if the chars match
-                    if str1[x - 1] == str2[y - 1]:
-                        # add 1 to the diagonal
-                        m[x][y] = m[x - 1][y - 1] + 1
-                        # Update values if longer than previous longest
-                        # substring
-                        if m[x][y] > longest:
-                            longest = m[x][y]
-                            x_longest = x
-                            y_longest = y
-                    else:
-                        # If there is no match, start from zero
-                        m[x][y] = 0
-
-            # Copy str1 and str2, but subtract the longest common substring
-            # for the next iteration.
-            new_str1 = str1[0:x_longest - longest] + str1[x_longest:]
-            new_str2 = str2[0:y_longest - longest] + str2[y_longest:]
-
-        return (new_str1, new_str2), longest
-
-    def lcs_apply(x):
-        """
-        lcs_apply(x)
-        A helper function that is applied to each pair of records
-        in s1 and s2. Assigns a similarity score to each pair,
-        between 0 and 1. Used by the pandas.apply method.
-        Parameters
-        ----------
-        x : pandas.Series
-          A pandas Series containing two strings to be compared.
-        Returns
-        -------
-        Float
-          A normalized similarity score.
-        """
-        if pd.isnull(x[0]) or pd.isnull(x[1]):
-            return np.nan
-
-        # Compute lcs value with first ordering.
-        lcs_acc_1 = 0
-        new_x_1 = (x[0], x[1])
-        while True:
-            # Get new string pair (iter_x) and length (iter_lcs)
-            # for this iteration.
-            iter_x, iter_lcs = lcs_iteration(new_x_1)
-            if iter_lcs < min_len:
-                # End if the longest substring is below the threshold
-                break
-            else:
-                # Otherwise, accumulate length and start a new iteration
-                # with the new string pair.
-                new_x_1 = iter_x
-                lcs_acc_1 = lcs_acc_1 + iter_lcs
-
-        # Compute lcs value with second ordering.
-        lcs_acc_2 = 0
-        new_x_2 = (x[1], x[0])
-        while True:
-            # Get new string pair (iter_x) and length (iter_lcs)
-            # for this iteration.
-            iter_x, iter_lcs = lcs_iteration(new_x_2)
-            if iter_lcs < min_len:
-                # End if the longest substring is below the threshold
-                break
-            else:
-                # Otherwise, accumulate length and start a new iteration
-                # with the new string pair.
-                new_x_2 = iter_x
-                lcs_acc_2 = lcs_acc_2 + iter_lcs
-
-        def normalize_lcs(lcs_value):
-            """
-            normalize_lcs(lcs_value)
-            A helper function used to normalize the score produced by
-            compute_score() to a score between 0 and 1. Applies one of the
-            normalization schemes described in in Christen, Peter (2012). The
-            normalization method is determined by the norm argument provided
-            to the parent, longest_common_substring_similarity function.
-            Parameters
-            ----------
-            lcs_value : Float
-                The raw lcs length.
-            Returns
-            -------
-            Float
-                The normalized lcs length.
-            """
-            if len(x[0]) == 0 or len(x[1]) == 0:
-                return 0
-            if norm == 'overlap':
-                return lcs_value / min(len(x[0]), len(x[1]))
-            elif norm == 'jaccard':
-                return lcs_value / (len(x[0]) + len(x[1]) - abs(lcs_value))
-            elif norm == 'dice':
-                return lcs_value * 2 / (len(x[0]) + len(x[1]))
-            else:
-                warnings.warn(
-                    'Unrecognized longest common substring normalization. '
-                    'Defaulting to "dice" method.')
-                return lcs_value * 2 / (len(x[0]) + len(x[1]))
+    return pd.Series(longest_common_substring_batch(s1,
+                                                    s2,
+                                                    norm=norm,
+                                                    min_len=min_len,
+                                                    min_score=min_score))
+
+
+@timed(pairs=batch_pairs)
+def longest_common_substring_batch(s1,
+                                   s2,
+                                   norm='dice',
+                                   min_len=2,
+                                   min_score=None,
+                                   stats=None,
+                                   bucket=8,
+                                   batch_size=4096):
+    """
+    longest_common_substring_batch(s1, s2, norm='dice', min_len=2,
+                                   min_score=None, stats=None)
+    Batch version of longest_common_substring_similarity for two aligned
+    string arrays, e.g. two whole DataFrame columns.
+    Each round finds the longest common substring of every active pair
+    with a rolling-row dynamic program vectorized over the batch, removes
+    it from both strings and accumulates its length, until it is shorter
+    than min_len. Pairs are grouped by string length, and the two rows of
+    the dynamic program are allocated once and reused for every round,
+    ordering and group.
+    The similarity is the mean of one term per ordering, and each term
+    grows with the accumulated length, which cannot exceed what it already
+    is plus the shorter remaining string. With min_score, pairs are
+    skipped as soon as these bounds put the mean below it: before any
+    round, then after every round.
+    Parameters
+    ----------
+    s1 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Left strings.
+    s2 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Right strings, aligned by position with s1.
+    norm : str
+        One of "overlap", "jaccard", or "dice". Default: "dice"
+    min_len : int
+        Common substrings shorter than min_len are not counted. Default: 2.
+    min_score : float
+        Threshold on the returned values. Pairs that are proven to stay
+        below it get strbatch.PRUNED instead of their score; other pairs
+        below it may still get their exact score. Default: None
+    stats : dict
+        When given, stats["pruned"] is increased by the number of pruned
+        pairs.
+    bucket : int
+        Width of the string length buckets used to group pairs. Default: 8.
+    batch_size : int
+        Maximum number of pairs scored together. Default: 4096.
+    Returns
+    -------
+    numpy.ndarray
+        A float array of normalized similarities, NaN for missing values.
+    """
+
+    a = StringColumn.from_values(s1)
+    b = StringColumn.from_values(s2)
+
+    if len(a) != len(b):
+        raise ValueError('Arrays or Series have to be same length.')
+
+    null = a.null | b.null
+    len1 = np.where(null, 0, a.lengths)
+    len2 = np.where(null, 0, b.lengths)
+
+    if norm not in ('overlap', 'jaccard', 'dice'):
+        warnings.warn('Unrecognized longest common substring normalization. '
+                      'Defaulting to "dice" method.')
+        norm = 'dice'
+    shorter = np.minimum(len1, len2)
 
+    pruned = np.zeros(len(a), dtype=bool)
+    if min_score is not None:
+        # Both orderings at their best, with some slack for rounding
+        target = 2 * min_score * (1 - 1e-9)
+        best = _lcs_term(shorter, len1, len2, norm)
+        pruned = ~null & (2 * best < target)
+
+    lcs_1 = np.zeros(len(a))
+    lcs_2 = np.zeros(len(a))
+    todo = np.flatnonzero(~null & ~pruned & (shorter >= max(min_len, 1)))
+
+    if len(todo):
+        width = max(len1[todo].max(), len2[todo].max()) + 1
+        work = np.zeros((2, min(batch_size, len(todo)), width), dtype=np.int32)
+    for group in length_groups(len1[todo], len2[todo], bucket, batch_size):
+        idx = todo[group]
+        A = a.padded(idx, len1[idx].max())
+        B = b.padded(idx, len2[idx].max())
+        need_1 = need_2 = None
+        if min_score is not None:
+            need_1 = _lcs_need(target - best[idx], len1[idx], len2[idx], norm)
         # Average the two orderings, since lcs may be sensitive to comparison
         # order.
-        return (normalize_lcs(lcs_acc_1) + normalize_lcs(lcs_acc_2)) / 2
+        lcs_1[idx] = _lcs_total(A, B, len1[idx], len2[idx], min_len, work,
+                                need_1)
+        if min_score is not None:
+            alive = ~np.isnan(lcs_1[idx])
+            idx, A, B = idx[alive], A[alive], B[alive]
+            first = _lcs_term(lcs_1[idx], len1[idx], len2[idx], norm)
+            need_2 = _lcs_need(target - first, len1[idx], len2[idx], norm)
+        lcs_2[idx] = _lcs_total(B, A, len2[idx], len1[idx], min_len, work,
+                                need_2)
+    pruned |= np.isnan(lcs_1) | np.isnan(lcs_2)
+
+    sims = (_lcs_term(lcs_1, len1, len2, norm)
+            + _lcs_term(lcs_2, len1, len2, norm)) / 2
+    sims[shorter == 0] = 0
+    sims[pruned] = PRUNED
+    sims[null] = np.nan
+    count_pruned(stats, pruned)
+    return sims
 
-    return conc.apply(lcs_apply)
 
+def _lcs_term(total, len1, len2, norm):
+    """
+    _lcs_term(total, len1, len2, norm)
+    Normalized accumulated length of one ordering.
+    """
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if norm == 'overlap':
+            return total / np.minimum(len1, len2)
+        if norm == 'jaccard':
+            return total / (len1 + len2 - total)
+        return total / ((len1 + len2) / 2)
+
+
+def _lcs_need(term, len1, len2, norm):
+    """
+    _lcs_need(term, len1, len2, norm)
+    Smallest accumulated length of one ordering whose normalized value
+    reaches term, the inverse of _lcs_term.
+    """
+    term = np.maximum(term, 0)
+    if norm == 'overlap':
+        return term * np.minimum(len1, len2)
+    if norm == 'jaccard':
+        return term * (len1 + len2) / (1 + term)
+    return term * (len1 + len2) / 2
 
 
+def _lcs_total(A, B, len1, len2, min_len, work, need=None):
+    """
+    _lcs_total(A, B, len1, len2, min_len, work, need=None)
+    Accumulated length of the iteratively removed longest common
+    substrings of each row pair of A and B.
+    Parameters
+    ----------
+    A : numpy.ndarray
+        (n, L1) codepoint matrix of the first strings.
+    B : numpy.ndarray
+        (n, L2) codepoint matrix of the second strings.
+    len1, len2 : numpy.ndarray
+        Unpadded string lengths.
+    min_len : int
+        Minimum substring length.
+    work : numpy.ndarray
+        (2, n_max, width) int32 buffer holding the two dynamic programming
+        rows, reused across calls.
+    need : numpy.ndarray
+        Accumulated length each pair has to reach. Pairs that cannot reach
+        it any more are dropped. Default: no threshold.
+    Returns
+    -------
+    numpy.ndarray
+        The accumulated lengths, one per pair, NaN for dropped pairs.
+    """
+    total = np.zeros(len(A))
+    active = np.arange(len(A))
+    len1 = len1.copy()
+    len2 = len2.copy()
+
+    while len(active):
+        if need is not None:
+            hopeless = total[active] + np.minimum(len1, len2) < need[active]
+            total[active[hopeless]] = np.nan
+            reachable = ~hopeless
+            active, A, B = active[reachable], A[reachable], B[reachable]
+            len1, len2 = len1[reachable], len2[reachable]
+            if not len(active):
+                break
+        longest, x_end, y_end = _lcs_iteration(A, B, len1, len2, work)
+        # End pairs whose longest substring is below the threshold,
+        # otherwise accumulate its length and remove it from both strings.
+        found = longest >= max(min_len, 1)
+        active = active[found]
+        longest = longest[found]
+        total[active] += longest
+        A = _cut(A[found], x_end[found] - longest, longest, len1[found])
+        B = _cut(B[found], y_end[found] - longest, longest, len2[found])
+        len1 = len1[found] - longest
+        len2 = len2[found] - longest
+        # Pairs that became too short cannot find another substring.
+        keep = np.minimum(len1, len2) >= min_len
+        active, A, B = active[keep], A[keep], B[keep]
+        len1, len2 = len1[keep], len2[keep]
+        if len(active):
+            A = A[:, :len1.max()]
+            B = B[:, :len2.max()]
+
+    return total
+
+
+def _lcs_iteration(A, B, len1, len2, work):
+    """
+    _lcs_iteration(A, B, len1, len2, work)
+    A single iteration of the longest common substring algorithm, adapted
+    from https://en.wikibooks.org/wiki/Algorithm_Implementation/Strings/
+    Longest_common_substring, with one rolling row per pair instead of a
+    full matrix. Ties are broken like the full matrix scan: the substring
+    ending first in A, then first in B, wins.
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Length of the longest common substring and its (exclusive) end
+        positions in A and B.
+    """
+    n, L1 = A.shape
+    L2 = B.shape[1]
+    prev = work[0, :n, :L2 + 1]
+    cur = work[1, :n, :L2 + 1]
+    prev.fill(0)
+    cur[:, 0] = 0
+
+    longest = np.zeros(n, dtype=np.int64)
+    x_longest = np.zeros(n, dtype=np.int64)
+    y_longest = np.zeros(n, dtype=np.int64)
+    valid_y = np.arange(L2)[None, :] < len2[:, None]
+
+    for x in range(1, L1 + 1):
+        # Add 1 to the diagonal where the chars match, else start from zero
+        np.add(prev[:, :-1], 1, out=cur[:, 1:])
+        cur[:, 1:] *= A[:, x - 1:x] == B
+        row = np.where(valid_y, cur[:, 1:], 0)
+        y = row.argmax(axis=1)
+        best = row[np.arange(n), y]
+        better = (best > longest) & (x <= len1)
+        longest[better] = best[better]
+        x_longest[better] = x
+        y_longest[better] = y[better] + 1
+        prev, cur = cur, prev
+
+    return longest, x_longest, y_longest
+
+
+def _cut(A, start, length, lengths):
+    """
+    _cut(A, start, length, lengths)
+    Remove A[i, start[i]:start[i] + length[i]] from every row of A and pad
+    the shortened rows with 0 again.
+    """
+    if len(A) == 0:
+        return A
+    cols = np.arange(A.shape[1])[None, :]
+    src = np.where(cols < start[:, None], cols, cols + length[:, None])
+    keep = src < lengths[:, None]
+    src = np.minimum(src, A.shape[1] - 1)
+    return np.where(keep, np.take_along_axis(A, src, axis=1), 0)
+
+
+@timed(pairs=batch_pairs)
+def longest_common_subsequence_batch(s1,
+                                     s2,
+                                     min_score=None,
+                                     stats=None,
+                                     bucket=8,
+                                     batch_size=4096):
+    """
+    longest_common_subsequence_batch(s1, s2, min_score=None, stats=None)
+    Longest common subsequence similarity of two aligned string arrays:
+    the subsequence length divided by the longer string length, i.e.
+    1 - strsimpy's MetricLCS distance.
+    Pairs whose shorter string has at most bitparallel.WORD characters
+    use the bit-parallel kernel, a few word operations per character of
+    the longer string. The others fall back to the dynamic program: row x
+    is the running maximum over y of c[x - 1, y - 1] + 1 where the
+    characters match and c[x - 1, y] elsewhere, so each row is computed
+    for a whole batch of pairs with one accumulate.
+    With min_score, pairs are skipped when the shorter length over the
+    longer one is below it, and dropped from the dynamic program once the
+    subsequence so far plus the rows left cannot reach it.
+    Parameters
+    ----------
+    s1 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Left strings.
+    s2 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Right strings, aligned by position with s1.
+    min_score : float
+        Threshold on the returned values. Pairs that are proven to stay
+        below it get strbatch.PRUNED instead of their score; other pairs
+        below it may still get their exact score. Default: None
+    stats : dict
+        When given, stats["pruned"] is increased by the number of pruned
+        pairs.
+    bucket : int
+        Width of the string length buckets used to group pairs. Default: 8.
+    batch_size : int
+        Maximum number of pairs scored together. Default: 4096.
+    Returns
+    -------
+    numpy.ndarray
+        A float array of similarities, 1 for equal strings and NaN for
+        missing values.
+    """
+
+    a = StringColumn.from_values(s1)
+    b = StringColumn.from_values(s2)
+
+    if len(a) != len(b):
+        raise ValueError('Arrays or Series have to be same length.')
+
+    null = a.null | b.null
+    len1 = np.where(null, 0, a.lengths)
+    len2 = np.where(null, 0, b.lengths)
+
+    longest = np.maximum(len1, len2)
+
+    # Subsequence length each pair has to reach, with some slack for
+    # rounding
+    need = None
+    pruned = np.zeros(len(a), dtype=bool)
+    if min_score is not None:
+        need = min_score * longest * (1 - 1e-9)
+        pruned = ~null & (longest > 0) & (np.minimum(len1, len2) < need)
+
+    lengths = np.zeros(len(a))
+    todo = np.flatnonzero(~null & ~pruned & (len1 > 0) & (len2 > 0))
+    short = np.minimum(len1[todo], len2[todo]) <= WORD
+    fast = todo[short]
+    for group in length_groups(len1[fast], len2[fast], bucket, batch_size):
+        idx = fast[group]
+        lengths[idx] = subsequence_lengths(a, b, idx, len1, len2)
+    todo = todo[~short]
+    for group in length_groups(len1[todo], len2[todo], bucket, batch_size):
+        idx = todo[group]
+        lengths[idx] = _lcseq_length(a.padded(idx, len1[idx].max()),
+                                     b.padded(idx, len2[idx].max()),
+                                     len1[idx],
+                                     len2[idx],
+                                     None if need is None else need[idx])
+    pruned |= np.isnan(lengths)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sims = lengths / longest
+    # Equal strings score 1, also when both are empty
+    sims[~null & (longest == 0)] = 1
+    sims[pruned] = PRUNED
+    sims[null] = np.nan
+    count_pruned(stats, pruned)
+    return sims
+
+
+def _lcseq_length(A, B, len1, len2, need=None, check=8):
+    """
+    _lcseq_length(A, B, len1, len2, need=None, check=8)
+    Longest common subsequence length of each row pair of A and B. Rows
+    stop changing once x passes the length of their string, and padding
+    columns only feed the columns to their right, so the answer is read
+    at column len2. Each remaining row adds at most 1, so every check rows
+    the pairs that cannot reach need any more are dropped and get NaN.
+    """
+    n, L1 = A.shape
+    prev = np.zeros((n, B.shape[1] + 1), dtype=np.int32)
+    cur = np.zeros_like(prev)
+    result = np.full(n, np.nan)
+    rows = np.arange(n)
+    for x in range(1, L1 + 1):
+        if need is not None and x % check == 0:
+            reachable = (prev[np.arange(len(rows)), len2]
+                         + np.maximum(len1 - x + 1, 0) >= need)
+            if not reachable.all():
+                A, B, prev, cur = (A[reachable], B[reachable],
+                                   prev[reachable], cur[reachable])
+                len1, len2 = len1[reachable], len2[reachable]
+                rows, need = rows[reachable], need[reachable]
+                if not len(rows):
+                    break
+        step = np.where(A[:, x - 1:x] == B, prev[:, :-1] + 1, prev[:, 1:])
+        np.maximum.accumulate(step, axis=1, out=cur[:, 1:])
+        frozen = x > len1
+        cur[frozen] = prev[frozen]
+        prev, cur = cur, prev
+    result[rows] = prev[np.arange(len(rows)), len2]
+    return result
@@ -1,9 +1,78 @@
-from os.path import join
+from glob import glob
+from hashlib import blake2b
+from importlib.util import find_spec
+from inspect import getsource
+from os import (
+    remove,
+    replace,
+    stat,
+    utime,
+)
+from os.path import (
+    getmtime,
+    join,
+)
+from warnings import warn
+from . import tweak
+from .instrument import (
+    data_rows,
+    timed,
+)
+from .params import mkdir
 from .tweak import Tweak
+import numpy as np
 from pandas import (
     DataFrame,
+    MultiIndex,
+    __version__ as pandas_version,
+    concat,
     read_csv,
+    to_datetime,
 )
+# Strings read as missing by read_csv
+from pandas._libs.parsers import STR_NA_VALUES
+from pandas.api.types import union_categoricals
+
+# Bump when the cached frame changes in a way the cache key cannot see
+CACHE_VERSION = 1
+
+# Cached frames kept per dataset, e.g. one per params["derived"] setting.
+# The least recently used ones are dropped first
+CACHE_ENTRIES = 4
+
+
+def take_pairs(data: DataFrame,
+               left: np.ndarray,
+               right: np.ndarray,
+               columns: list = None,
+               suffix: str = "1",
+               names: list = None) -> DataFrame:
+    """
+    Values of both records of the pairs (left[i], right[i]), positions in
+    data, side by side: col for the left record, col + suffix for the
+    right one. Every column is gathered with take on its array, so a
+    categorical column only copies its codes and no join is made. The
+    index holds the index labels of both records, with level names names
+    """
+    columns = list(data.columns) if columns is None else list(columns)
+    left = np.asarray(left, dtype=np.intp)
+    right = np.asarray(right, dtype=np.intp)
+    # take wraps negative positions around instead of failing
+    if (left < 0).any() or (right < 0).any():
+        raise IndexError("Pair positions must not be negative.")
+    gathered = {}
+    for col in columns:
+        values = data[col].array
+        gathered[col] = values.take(left)
+        gathered[col + suffix] = values.take(right)
+    index = MultiIndex.from_arrays(
+        [
+            data.index.take(left),
+            data.index.take(right),
+        ],
+        names=names,
+    )
+    return DataFrame(gathered, index=index, copy=False)
 
 
 class Dataset:
@@ -42,31 +111,266 @@ class Dataset:
             'CLASCOVID19',
             'RESDEFIN'
         ]
-        self._read()
-        self._format()
+        # Parsing schema of the non date columns in usefull_cols
+        self.dtypes = {
+            'APEPATER': 'category',
+            'APEMATER': 'category',
+            'NOMBRE': 'category',
+            'SEXO': 'category',
+            'FECNACI': 'category',
+            'EDAD': 'float32',
+            'CURP': 'category',
+            'DOMICILIO': 'category',
+            'CP': 'float32',
+            'TELEFONO': 'category',
+            'ENTNACI': 'category',
+            'ENTRESI': 'category',
+            'MPIORESI': 'category',
+            'ESINDIGE': 'category',
+            'HABLEIND': 'category',
+            'OCUPACIO': 'category',
+            'FECDEF': 'category',
+            'CLASCOVID19': 'category',
+            'RESDEFIN': 'category'
+        }
+        cache = None
+        if self.params.get("cache"):
+            if find_spec("pyarrow") is None:
+                warn("The Dataset cache needs pyarrow, reading without it.")
+            else:
+                cache = self._cache_path()
+        if cache is not None and self._load_cache(cache):
+            return
+        if self.params.get("chunksize"):
+            self._read_chunks()
+        else:
+            self._read()
+            self._format()
+        if cache is not None:
+            self._save_cache(cache)
 
+    def _read_options(self) -> dict:
+        """
+        read_csv arguments that only parse usefull_cols, with their dtypes
+        """
+        return {
+            "filepath_or_buffer": join(
+                self.params["path_data"],
+                self.params["dataset"],
+            ),
+            "usecols": self.usefull_cols,
+            "dtype": self.dtypes,
+            "parse_dates": self.dates_col,
+            "encoding": 'latin-1',
+        }
+
+    @timed(rows=data_rows)
     def _read(self) -> DataFrame:
-        filename = join(
-            self.params["path_data"],
-            self.params["dataset"],
-        )
+        if self.params.get("engine", "c") == "pyarrow":
+            self.data = self._read_arrow()
+            return
         data = read_csv(
-            filename,
-            parse_dates=self.dates_col,
-            encoding='latin-1',
+            engine="c",
             low_memory=False,
+            **self._read_options(),
         )
         self.data = data[self.usefull_cols]
 
+    def _read_arrow(self) -> DataFrame:
+        """
+        Parse with pyarrow's multithreaded reader and the same result as
+        the c engine. read_csv(engine="pyarrow") only applies dtype after
+        pyarrow inferred the types, which turns text such as TELEFONO into
+        floats and missing values into "nan", so the text and date columns
+        are read as strings, with the c engine's missing value markers
+        """
+        from pyarrow import (
+            csv,
+            float32,
+            string,
+        )
+        options = self._read_options()
+        types = {
+            col: float32() if dtype == "float32" else string()
+            for col, dtype in self.dtypes.items()
+        }
+        types.update({col: string() for col in self.dates_col})
+        table = csv.read_csv(
+            options["filepath_or_buffer"],
+            read_options=csv.ReadOptions(encoding=options["encoding"]),
+            convert_options=csv.ConvertOptions(
+                include_columns=self.usefull_cols,
+                column_types=types,
+                null_values=sorted(STR_NA_VALUES),
+                strings_can_be_null=True,
+            ),
+        )
+        data = table.to_pandas()
+        for col in self.dates_col:
+            data[col] = to_datetime(data[col])
+        return data.astype({
+            col: dtype
+            for col, dtype in self.dtypes.items()
+            if dtype == "category"
+        })
+
+    @timed(rows=data_rows)
+    def _read_chunks(self) -> DataFrame:
+        """
+        Read and format the dataset params["chunksize"] rows at a time, so
+        only one raw chunk is in memory besides the formatted ones
+        """
+        if self.params.get("engine", "c") == "pyarrow":
+            raise ValueError(
+                'The pyarrow engine does not support chunksize.'
+            )
+        reader = read_csv(
+            chunksize=self.params["chunksize"],
+            **self._read_options(),
+        )
+        chunks = []
+        with reader:
+            for chunk in reader:
+                self.data = chunk[self.usefull_cols]
+                self._format()
+                chunks.append(self.data)
+        self.data = self._concat(chunks)
+
+    @staticmethod
+    def _concat(chunks: list) -> DataFrame:
+        """
+        Concatenate formatted chunks, merging the categories of each
+        categorical column instead of falling back to object
+        """
+        for col in chunks[0].select_dtypes('category'):
+            categories = union_categoricals(
+                [
+                    chunk[col]
+                    for chunk in chunks
+                ],
+                sort_categories=True,
+            ).categories
+            for chunk in chunks:
+                chunk[col] = chunk[col].cat.set_categories(categories)
+        return concat(chunks, ignore_index=True)
+
+    @timed(rows=data_rows)
     def _format(self) -> DataFrame:
         """
         Documentation
         """
-        tweak = Tweak(self.data)
-        self.data = tweak.get_data()
+        tweak = Tweak(self.data, derived=self.params.get("derived"))
+        self.data = tweak.get_data(copy=False)
 
-    def get_data(self) -> DataFrame:
+    def _cache_key(self) -> str:
         """
-        Documentation
+        Fingerprint of the source file (size, mtime and a hash of its first
+        and last MiB) and of everything that shapes the cleaned frame: the
+        schema, the stopword list and the cleaning code
+        """
+        filename = join(
+            self.params["path_data"],
+            self.params["dataset"],
+        )
+        info = stat(filename)
+        key = blake2b(digest_size=16)
+        key.update(repr((
+            CACHE_VERSION,
+            pandas_version,
+            info.st_size,
+            info.st_mtime_ns,
+            self.usefull_cols,
+            self.dates_col,
+            sorted(self.dtypes.items()),
+            tweak.street_stopword,
+            self.params.get("derived"),
+        )).encode())
+        with open(filename, 'rb') as file:
+            key.update(file.read(1 << 20))
+            file.seek(max(info.st_size - (1 << 20), 0))
+            key.update(file.read(1 << 20))
+        key.update(getsource(tweak).encode())
+        key.update(getsource(Dataset).encode())
+        return key.hexdigest()
+
+    def _cache_path(self) -> str:
+        path = join(self.params["path_data"], ".cache")
+        return join(
+            path,
+            f'{self.params["dataset"]}.{self._cache_key()}.feather',
+        )
+
+    @timed(rows=data_rows)
+    def _load_cache(self, path: str) -> bool:
+        """
+        Memory-map the cleaned frame from the cache, if present
+        """
+        from pyarrow import feather
+        try:
+            table = feather.read_table(path, memory_map=True)
+        except FileNotFoundError:
+            return False
+        # The modification time orders the entries by last use
+        utime(path)
+        # Hand the Arrow buffers over column by column instead of building
+        # consolidated blocks next to the whole table
+        self.data = table.to_pandas(
+            split_blocks=True,
+            self_destruct=True,
+        )
+        return True
+
+    def _save_cache(self, path: str) -> None:
+        """
+        Write the cleaned frame as uncompressed Feather, so it can be
+        memory-mapped, next to at most CACHE_ENTRIES - 1 other entries of
+        the dataset, e.g. its older versions or other derived settings
+        """
+        from pyarrow import feather
+        folder = join(self.params["path_data"], ".cache")
+        mkdir(folder)
+        entries = sorted(
+            glob(join(folder, f'{self.params["dataset"]}.*.feather')),
+            key=getmtime,
+        )
+        for old in entries[:max(len(entries) - CACHE_ENTRIES + 1, 0)]:
+            remove(old)
+        feather.write_feather(
+            self.data,
+            path + ".tmp",
+            compression="uncompressed",
+        )
+        replace(path + ".tmp", path)
+
+    def pairs(self,
+              left: np.ndarray,
+              right: np.ndarray,
+              columns: list = None,
+              suffix: str = "1") -> DataFrame:
+        """
+        Aligned values of the record pairs, see take_pairs
+        """
+        return take_pairs(self.data, left, right, columns, suffix)
+
+    @timed(rows=data_rows)
+    def require(self,
+                columns: list) -> DataFrame:
+        """
+        Add the derived Tweak columns left out by params["derived"]. Frames
+        already taken with get_data do not get them
+        """
+        tweak = Tweak(self.data, derived=[])
+        self.data = tweak.require(columns)
+        return self.data
+
+    def get_data(self,
+                 copy: bool = True) -> DataFrame:
+        """
+        Cleaned data. With copy=False the frame shares its columns with
+        the Dataset: columns can be added, dropped or renamed freely, but
+        without pandas copy-on-write, values edited in place are edited
+        in the Dataset too
         """
-        return self.data.copy()
+        if copy:
+            return self.data.copy()
+        return self.data.copy(deep=False)
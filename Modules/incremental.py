@@ -0,0 +1,416 @@
+from json import (
+    dump,
+    load,
+)
+from os import (
+    remove,
+    replace,
+)
+from shutil import rmtree
+from os.path import (
+    exists,
+    join,
+)
+from typing import Callable
+
+import numpy as np
+from pandas import (
+    Categorical,
+    CategoricalDtype,
+    DataFrame,
+    MultiIndex,
+    Series,
+    StringDtype,
+    array,
+    concat,
+    isna,
+)
+from pandas.api.types import union_categoricals
+from pandas.util import hash_pandas_object
+from .params import mkdir
+
+# Bump when the stored state changes in a way older states cannot be read
+STATE_VERSION = 2
+
+
+class Incremental:
+    """
+    Incremental deduplication of dated extracts of the same dataset.
+    The prepared records, their blocking keys and the scores of their
+    candidate pairs are kept in params["path_data"]/params["incremental"]
+    between runs. Records are recognized across extracts by a hash of
+    their values, so each run only prepares, blocks and scores the added
+    or changed records, against all the current ones, and forgets the
+    pairs of the removed or changed ones.
+    blocks are the column lists of the blocking passes, e.g.
+    [['id_soundex'], ['name', 'fecnaci']], looked up in the prepared
+    records. compare(df, pairs) scores the MultiIndex pairs of labels of
+    df, e.g. functools.partial(features.compare_fields, fields=[...]).
+    prepare(df) adds the derived columns of new records, e.g. the blocking
+    keys, and must only depend on each record's own values
+    """
+
+    def __init__(self,
+                 params: dict,
+                 blocks: list,
+                 compare: Callable,
+                 prepare: Callable = None,
+                 columns: list = None) -> None:
+        self.params = params
+        self.blocks = [
+            [on] if isinstance(on, str) else list(on)
+            for on in blocks
+        ]
+        self.compare = compare
+        self.prepare = prepare
+        # Columns hashed to recognize records, all of them when None,
+        # e.g. Dataset.usefull_cols
+        self.columns = columns
+        self.path = join(
+            params["path_data"],
+            params.get("incremental") or ".incremental",
+        )
+        self.records = None
+        self.scores = None
+        self.next_id = 0
+        self.added = 0
+        self.removed = 0
+        self._load()
+
+    def _meta(self) -> dict:
+        return {
+            "version": STATE_VERSION,
+            "blocks": self.blocks,
+            "columns": self.columns,
+        }
+
+    def _load(self) -> None:
+        """
+        Read the state of the previous run, if it was made with the same
+        blocks and hashed columns
+        """
+        meta = join(self.path, "state.json")
+        if exists(meta):
+            with open(meta) as file:
+                state = load(file)
+            next_id = state.pop("next_id")
+            frames = state.pop("frames")
+            if state == self._meta():
+                self.records = _load_frame(
+                    join(self.path, "records"),
+                    frames["records"],
+                ).set_index("record_id")
+                self.scores = _load_frame(
+                    join(self.path, "scores"),
+                    frames["scores"],
+                ).set_index(["record_id_0", "record_id_1"])
+                self.next_id = next_id
+
+    def _save(self) -> None:
+        """
+        Write the state, the metadata last so an interrupted run leaves
+        the previous state or none
+        """
+        mkdir(self.path)
+        meta = join(self.path, "state.json")
+        if exists(meta):
+            remove(meta)
+        frames = {
+            name: _save_frame(join(self.path, name), frame.reset_index())
+            for name, frame in (
+                ("records", self.records),
+                ("scores", self.scores),
+            )
+        }
+        with open(meta + ".tmp", "w") as file:
+            dump(
+                dict(self._meta(), next_id=self.next_id, frames=frames),
+                file,
+            )
+        replace(meta + ".tmp", meta)
+
+    def reset(self) -> None:
+        """
+        Forget the stored state, the next update starts from scratch
+        """
+        meta = join(self.path, "state.json")
+        if exists(meta):
+            remove(meta)
+        self.records = None
+        self.scores = None
+        self.next_id = 0
+
+    def _record_keys(self, data: DataFrame) -> DataFrame:
+        """
+        Hash of the values of every record, with the rank of the record
+        among its exact duplicates so that they stay distinct records
+        """
+        values = data if self.columns is None else data[self.columns]
+        hashes = hash_pandas_object(values, index=False).to_numpy()
+        ranks = Series(hashes).groupby(hashes).cumcount().to_numpy()
+        return DataFrame({
+            "_hash": hashes,
+            "_rank": ranks.astype(np.int64),
+        })
+
+    def _block_keys(self, prepared: DataFrame) -> DataFrame:
+        """
+        One hash per blocking pass and record, NA when the record misses
+        one of the pass columns
+        """
+        keys = {}
+        for i, on in enumerate(self.blocks):
+            key = hash_pandas_object(prepared[on], index=False)
+            key = key.astype("UInt64")
+            key[prepared[on].isna().any(axis=1)] = None
+            keys[f"_block{i}"] = key.array
+        return DataFrame(keys, index=prepared.index)
+
+    def update(self,
+               data: DataFrame) -> DataFrame:
+        """
+        Scores of the candidate pairs of a new extract, indexed by pairs
+        of labels of data. Only pairs with an added or changed record are
+        scored, the others are taken from the previous run
+        """
+        keys = self._record_keys(data)
+        ids = np.full(len(data), -1, dtype=np.int64)
+        if self.records is not None and len(self.records):
+            stored = MultiIndex.from_arrays([
+                self.records["_hash"],
+                self.records["_rank"],
+            ])
+            found = stored.get_indexer(MultiIndex.from_arrays([
+                keys["_hash"],
+                keys["_rank"],
+            ]))
+            ids[found >= 0] = self.records.index[found[found >= 0]]
+        new = np.flatnonzero(ids < 0)
+        ids[new] = np.arange(self.next_id, self.next_id + len(new))
+        self.next_id += len(new)
+
+        frames = []
+        self.removed = 0
+        if self.records is not None:
+            frames.append(
+                self.records.loc[np.intersect1d(self.records.index, ids)]
+            )
+            self.removed = len(self.records) - len(frames[0])
+        if len(new):
+            # Prepare and key the new records only
+            prepared = data.iloc[new].copy()
+            prepared.index = ids[new]
+            if self.prepare is not None:
+                prepared = self.prepare(prepared)
+            frames.append(concat(
+                [
+                    prepared,
+                    keys.iloc[new].set_axis(prepared.index),
+                    self._block_keys(prepared),
+                ],
+                axis=1,
+            ))
+        records = _concat(frames).loc[ids]
+        records.index.name = "record_id"
+
+        scores = []
+        if self.scores is not None:
+            scores.append(self.scores[
+                self.scores.index.get_level_values(0).isin(ids)
+                & self.scores.index.get_level_values(1).isin(ids)
+            ])
+        pairs = self._candidate_pairs(records, ids[new])
+        if len(pairs) or not scores:
+            internal = ["_hash", "_rank"] + [
+                f"_block{i}"
+                for i in range(len(self.blocks))
+            ]
+            # Only the records of the new pairs are handed to compare
+            involved = np.union1d(
+                pairs.get_level_values(0),
+                pairs.get_level_values(1),
+            )
+            computed = self.compare(
+                records.loc[involved].drop(columns=internal),
+                pairs,
+            )
+            computed.index = pairs.set_names(["record_id_0", "record_id_1"])
+            scores.append(computed)
+        scores = concat(scores)
+
+        self.records = records
+        self.scores = scores
+        self.added = len(new)
+        self._save()
+
+        labels = Series(data.index, index=ids)
+        return scores.set_axis(MultiIndex.from_arrays([
+            labels[scores.index.get_level_values(0)].to_numpy(),
+            labels[scores.index.get_level_values(1)].to_numpy(),
+        ]))
+
+    def _candidate_pairs(self,
+                         records: DataFrame,
+                         new: np.ndarray) -> MultiIndex:
+        """
+        Pairs of record ids sharing the key of a blocking pass with at
+        least one new record, as (smaller id, larger id)
+        """
+        ids = records.index.to_numpy()
+        is_new = np.isin(ids, new)
+        n_ids = max(self.next_id, 1)
+        found = [np.array([], dtype=np.int64)]
+        for i in range(len(self.blocks)):
+            key = records[f"_block{i}"]
+            valid = key.notna().to_numpy()
+            keys = key[valid].to_numpy(dtype=np.uint64)
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            members = ids[valid][order]
+            probes = keys[is_new[valid][order]]
+            lo = np.searchsorted(keys, probes, side="left")
+            hi = np.searchsorted(keys, probes, side="right")
+            sizes = hi - lo
+            ends = np.cumsum(sizes)
+            positions = np.repeat(lo - (ends - sizes), sizes)
+            positions += np.arange(len(positions))
+            left = np.repeat(members[is_new[valid][order]], sizes)
+            right = members[positions]
+            distinct = left != right
+            left, right = left[distinct], right[distinct]
+            found.append(np.minimum(left, right) * n_ids
+                         + np.maximum(left, right))
+        found = np.unique(np.concatenate(found))
+        return MultiIndex.from_arrays(
+            [found // n_ids, found % n_ids],
+        )
+
+
+def _concat(frames: list) -> DataFrame:
+    """
+    Concatenate frames, merging the categories of the columns that are
+    categorical in all of them instead of falling back to object
+    """
+    frames = [frame.copy(deep=False) for frame in frames]
+    for col in frames[0].select_dtypes("category"):
+        if all(frame[col].dtype == "category" for frame in frames):
+            categories = union_categoricals(
+                [
+                    frame[col]
+                    for frame in frames
+                ],
+                sort_categories=True,
+            ).categories
+            for frame in frames:
+                frame[col] = frame[col].cat.set_categories(categories)
+    return concat(frames)
+
+
+def _save_frame(path: str, frame: DataFrame) -> list:
+    """
+    Write every column of frame as .npy files in the folder path,
+    returning the JSON description _load_frame reads them back with
+    """
+    if exists(path):
+        rmtree(path)
+    mkdir(path)
+    return [
+        dict(
+            _save_values(join(path, str(i)), frame[col].values),
+            name=col,
+        )
+        for i, col in enumerate(frame.columns)
+    ]
+
+
+def _load_frame(path: str, columns: list) -> DataFrame:
+    """
+    Read back a frame written by _save_frame
+    """
+    return DataFrame({
+        spec["name"]: _load_values(join(path, str(i)), spec)
+        for i, spec in enumerate(columns)
+    })
+
+
+def _save_values(path: str, values) -> dict:
+    """
+    Write the values of a column as .npy files named after path:
+    categories as codes and categories, nullable extension arrays as
+    values and mask, and strings as their concatenated UTF-8 bytes with
+    offsets and a missing mask, so that no file needs pickle
+    """
+    dtype = values.dtype
+    if isinstance(dtype, CategoricalDtype):
+        np.save(path + ".codes.npy", values.codes)
+        return {
+            "kind": "category",
+            "ordered": bool(dtype.ordered),
+            "categories": _save_values(
+                path + ".categories",
+                dtype.categories.values,
+            ),
+        }
+    if isinstance(dtype, StringDtype) or dtype == object:
+        null = np.asarray(isna(values))
+        strings = np.asarray(values, dtype=object)[~null]
+        if not all(isinstance(value, str) for value in strings):
+            raise TypeError(
+                f"Cannot store the object values of {path}, "
+                "only strings are supported."
+            )
+        encoded = [value.encode() for value in strings]
+        lengths = np.fromiter(map(len, encoded), np.int64, len(encoded))
+        np.save(path + ".null.npy", null)
+        np.save(
+            path + ".offsets.npy",
+            np.concatenate(([0], lengths.cumsum())),
+        )
+        np.save(
+            path + ".utf8.npy",
+            np.frombuffer(b"".join(encoded), dtype=np.uint8),
+        )
+        return {"kind": "strings", "dtype": str(dtype)}
+    if hasattr(dtype, "numpy_dtype"):
+        null = np.asarray(isna(values))
+        np.save(path + ".null.npy", null)
+        np.save(
+            path + ".npy",
+            values.to_numpy(dtype=dtype.numpy_dtype, na_value=0),
+        )
+        return {"kind": "masked", "dtype": str(dtype)}
+    values = np.asarray(values)
+    if values.dtype == object:
+        raise TypeError(f"Cannot store the {dtype} values of {path}.")
+    np.save(path + ".npy", values)
+    return {"kind": "array"}
+
+
+def _load_values(path: str, spec: dict):
+    """
+    Read back the values written by _save_values
+    """
+    kind = spec["kind"]
+    if kind == "category":
+        return Categorical.from_codes(
+            np.load(path + ".codes.npy"),
+            categories=_load_values(path + ".categories", spec["categories"]),
+            ordered=spec["ordered"],
+        )
+    if kind == "strings":
+        null = np.load(path + ".null.npy")
+        offsets = np.load(path + ".offsets.npy")
+        buffer = np.load(path + ".utf8.npy").tobytes()
+        values = np.full(len(null), None, dtype=object)
+        values[~null] = [
+            buffer[start:end].decode()
+            for start, end in zip(offsets[:-1], offsets[1:])
+        ]
+        if spec["dtype"] == "object":
+            return values
+        return array(values, dtype=spec["dtype"])
+    if kind == "masked":
+        values = array(np.load(path + ".npy"), dtype=spec["dtype"])
+        values[np.load(path + ".null.npy")] = None
+        return values
+    return np.load(path + ".npy")
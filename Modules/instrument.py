@@ -0,0 +1,188 @@
+import cProfile
+import json
+import re
+import resource
+import sys
+from contextlib import contextmanager
+from functools import wraps
+from os.path import join
+from time import (
+    perf_counter,
+    process_time,
+)
+from typing import Callable
+
+from .params import mkdir
+
+# Trace receiving the stages, None when instrumentation is off
+_active = None
+
+# ru_maxrss is in KiB on Linux and in bytes on macOS
+_RSS_UNIT = 1 if sys.platform == "darwin" else 1024
+
+
+def _peak_rss() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * _RSS_UNIT
+
+
+class Trace:
+    """
+    Timing of the instrumented pipeline stages run inside a with block.
+    Every stage records its wall and CPU time, the rows or pairs it
+    processed and how much it raised the peak RSS of the process. Stages
+    run inside other stages are recorded too, with their depth. With
+    profile, the outermost stages also run under cProfile and are dumped
+    to profile/<n>_<stage>.prof, readable with pstats or snakeviz
+    """
+
+    def __init__(self,
+                 profile: str = None) -> None:
+        self.profile = profile
+        self.stages = []
+        self._depth = 0
+        self._profiling = False
+        self._start = None
+        self._previous = None
+
+    def __enter__(self) -> "Trace":
+        global _active
+        self._previous = _active
+        self._start = perf_counter()
+        _active = self
+        return self
+
+    def __exit__(self, *exc) -> None:
+        global _active
+        _active = self._previous
+
+    @contextmanager
+    def stage(self,
+              name: str,
+              rows: int = None,
+              pairs: int = None):
+        record = {
+            "stage": name,
+            "depth": self._depth,
+            "start": perf_counter() - self._start,
+        }
+        profiler = None
+        if self.profile is not None and not self._profiling:
+            profiler = cProfile.Profile()
+            self._profiling = True
+        peak = _peak_rss()
+        cpu = process_time()
+        wall = perf_counter()
+        self._depth += 1
+        try:
+            if profiler is None:
+                yield record
+            else:
+                with profiler:
+                    yield record
+        finally:
+            wall = perf_counter() - wall
+            self._depth -= 1
+            record.update({
+                "wall": wall,
+                "cpu": process_time() - cpu,
+                "rss_peak_delta": _peak_rss() - peak,
+            })
+            # The stage can set its counts on the record it was given
+            rows = record.setdefault("rows", rows)
+            pairs = record.setdefault("pairs", pairs)
+            record["rows_per_sec"] = rows / wall if rows and wall else None
+            record["pairs_per_sec"] = (
+                pairs / wall if pairs and wall else None
+            )
+            if profiler is not None:
+                self._profiling = False
+                mkdir(self.profile)
+                filename = re.sub(r"[^\w.-]", "_", name)
+                record["profile"] = join(
+                    self.profile,
+                    f"{len(self.stages)}_{filename}.prof",
+                )
+                profiler.dump_stats(record["profile"])
+            self.stages.append(record)
+
+    def summary(self):
+        """
+        Total wall and CPU time, calls, rows and pairs by stage
+        """
+        from pandas import DataFrame
+        stages = DataFrame(self.stages)
+        if stages.empty:
+            return stages
+        return stages.groupby("stage").agg(
+            calls=("wall", "size"),
+            wall=("wall", "sum"),
+            cpu=("cpu", "sum"),
+            rows=("rows", "sum"),
+            pairs=("pairs", "sum"),
+            rss_peak_delta=("rss_peak_delta", "max"),
+        ).sort_values("wall", ascending=False)
+
+    def save(self,
+             path: str) -> None:
+        """
+        Write the stages as JSON, in the order they finished
+        """
+        with open(path, "w") as file:
+            json.dump({"stages": self.stages}, file, indent=1)
+
+
+@contextmanager
+def stage(name: str,
+          rows: int = None,
+          pairs: int = None):
+    """
+    Record the enclosed code as a stage of the active Trace, if any. The
+    yielded record (None when off) accepts "rows" and "pairs" counts
+    """
+    if _active is None:
+        yield None
+        return
+    with _active.stage(name, rows, pairs) as record:
+        yield record
+
+
+def timed(name: str = None,
+          rows: Callable = None,
+          pairs: Callable = None) -> Callable:
+    """
+    Decorator recording every call as a stage of the active Trace, named
+    after the function by default. rows and pairs compute the counts
+    from the call arguments once the call is done, e.g. from self.data
+    after Dataset._read. When no Trace is active the call costs one
+    global lookup more
+    """
+    def decorator(func: Callable) -> Callable:
+        label = name or func.__qualname__
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if _active is None:
+                return func(*args, **kwargs)
+            with _active.stage(label) as record:
+                result = func(*args, **kwargs)
+                if rows is not None:
+                    record["rows"] = rows(*args, **kwargs)
+                if pairs is not None:
+                    record["pairs"] = pairs(*args, **kwargs)
+            return result
+        return wrapper
+    return decorator
+
+
+def data_rows(self, *args, **kwargs) -> int:
+    """
+    Rows of self.data, for the Dataset and Tweak methods
+    """
+    return 0 if self.data is None else len(self.data)
+
+
+def batch_pairs(s1, *args, **kwargs) -> int:
+    """
+    Pairs of the batch comparators, one per value of s1
+    """
+    return len(s1)
@@ -7,7 +7,21 @@ def get_params() -> dict:
     """
     params = {
         "path_data": "base_datos_covid",
-        "dataset": "BASE_SISVER_101121_EPI.csv"
+        "dataset": "BASE_SISVER_101121_EPI.csv",
+        # CSV parser, "c" or "pyarrow" (needs pyarrow)
+        "engine": "c",
+        # Rows per chunk, None reads the whole file at once
+        "chunksize": None,
+        # Keep the cleaned dataset in path_data/.cache between runs, with
+        # pyarrow
+        "cache": True,
+        # State of Incremental runs, in path_data
+        "incremental": ".incremental",
+        # Phonetic keys of the names, in path_data
+        "phonetic": ".phonetic.json",
+        # Derived Tweak columns computed at load, e.g. [] for name-only
+        # runs, None computes all of them
+        "derived": None,
     }
     return params
 
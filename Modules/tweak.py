@@ -1,6 +1,20 @@
-from nltk.tokenize.treebank import TreebankWordDetokenizer
-from nltk.tokenize import word_tokenize
-from pandas import DataFrame
+import re
+from functools import wraps
+
+import numpy as np
+from pandas import (
+    Categorical,
+    CategoricalDtype,
+    DataFrame,
+    Series,
+    factorize,
+    to_numeric,
+)
+from pandas.api.types import is_numeric_dtype
+from .instrument import (
+    data_rows,
+    timed,
+)
 
 street_stopword = [
     'A', 'Y', 'UN', 'UNO', 'AV.', 'AV', 'AVE', 'ESC.', 'ESC .', 'AVENIDA',
@@ -10,199 +24,372 @@ street_stopword = [
     ' SIN NOMBRE', 'SIN NOMBRE', 'SIN NOMBRE ', 'No.', 'NO CONOCIDA', 'No .'
 ]
 
+# Padding rules of the NLTK Treebank word tokenizer that apply to the
+# punctuation found in addresses (quotes and contractions are left out)
+_TOKENIZE = [
+    (re.compile(r'([^\.])(\.)([\]\)}>"\'»”’ ]*)\s*$'), r"\1 \2 \3 "),
+    (re.compile(r"([:,])([^\d])"), r" \1 \2"),
+    (re.compile(r"([:,])$"), r" \1 "),
+    (re.compile(r"\.{2,}"), r" \g<0> "),
+    (re.compile(r"[;@#$%&]"), r" \g<0> "),
+    (re.compile(r"[\u2012-\u2015]"), r" \g<0> "),
+    (re.compile(r'([^\.])(\.)([\]\)}>"\']*)\s*$'), r"\1 \2\3 "),
+    (re.compile(r"[?!]"), r" \g<0> "),
+    (re.compile(r"[*]"), r" \g<0> "),
+    (re.compile(r"[\]\[\(\)\{\}\<\>]"), r" \g<0> "),
+    (re.compile(r"--"), r" -- "),
+]
+
+# The matching Treebank detokenizer rules, undoing the padding
+_DETOKENIZE = [
+    (re.compile(r" -- "), r"--"),
+    (re.compile(r"([\[\(\{\<])\s"), r"\g<1>"),
+    (re.compile(r"\s([\]\)\}\>])"), r"\g<1>"),
+    (re.compile(r"([\]\)\}\>])\s([:;,.])"), r"\1\2"),
+    (re.compile(r"\s([?!])"), r"\g<1>"),
+    (re.compile(r'([^\.])\s(\.)(?!\.)([\]\)}>"\']*)'), r"\1\2\3"),
+    (re.compile(r"([#$])\s"), r"\g<1>"),
+    (re.compile(r"\s([;%])"), r"\g<1>"),
+    (re.compile(r"\s\.\.\.\s"), r"..."),
+    (re.compile(r"\s([:,])"), r"\1"),
+]
+
+# Strings without any punctuation besides "." and "/" can only be changed
+# by the rules about periods
+_PUNCTUATION = re.compile(r"[^\w\s./]")
+_TOKENIZE_PERIOD = [_TOKENIZE[0], _TOKENIZE[3], _TOKENIZE[6]]
+_DETOKENIZE_PERIOD = [_DETOKENIZE[5], _DETOKENIZE[8]]
+
+# Whole tokens found in street_stopword. Entries with spaces can never be
+# a single token and are left out. Every token of the padded text owns the
+# space before and after it, so adjacent stopwords are all matched.
+_STOPWORD_TOKENS = re.compile(
+    r" (?:"
+    + "|".join(
+        re.escape(word)
+        for word in sorted(set(street_stopword), key=len, reverse=True)
+        if not re.search(r"\s", word)
+    )
+    + r") "
+)
+_WHITESPACE = re.compile(r"\s+")
+
+
+def _replace(data: Series, rules: list) -> Series:
+    for regexp, substitution in rules:
+        data = data.str.replace(regexp, substitution, regex=True)
+    return data
+
+
+def strip_stopwords(data: Series) -> Series:
+    """
+    Remove the street_stopword tokens of every string, with the same
+    result as NLTK's word_tokenize, filtering and TreebankWordDetokenizer
+    on address text, using a few precompiled regexes per column
+    """
+    special = data.str.contains(_PUNCTUATION, regex=True, na=False)
+    special = special.to_numpy(dtype=bool)
+    values = data.to_numpy(dtype=object, copy=True)
+    values[special] = _replace(data[special], _TOKENIZE)
+    values[~special] = _replace(data[~special], _TOKENIZE_PERIOD)
+    data = Series(values, index=data.index)
+
+    data = data.str.strip().str.replace(_WHITESPACE, "  ", regex=True)
+    data = (" " + data + " ").str.replace(_STOPWORD_TOKENS, "", regex=True)
+    data = data.str.strip().str.replace(_WHITESPACE, " ", regex=True)
+
+    values = data.to_numpy(dtype=object, copy=True)
+    values[special] = _replace(data[special], _DETOKENIZE)
+    values[~special] = _replace(data[~special], _DETOKENIZE_PERIOD)
+    return Series(values, index=data.index).str.strip()
+
+
+# One pass over DOMICILIO, every field is captured by its own lookahead
+# from the start of the stripped string. The separators are the regexes
+# the former str.split calls used, where "." is any character but a
+# newline, e.g. "No. " also splits "NoL " and "C.P." splits "CAPU":
+#   calle     text before the first "No. "
+#   street    text before the first "COLONIA: "
+#   colonia   text after the first "COLONIA: ", up to the next one or "C.P."
+#   num       text of street between its first and second "No."
+#   cp, telefono  first run of 5 and of 10 digits
+# A separator cannot end inside a "COLONIA: " the split had cut off first.
+_DOMICILIO = re.compile(
+    r"^(?=(?P<calle>.*?)(?:No[^\n] |\Z))"
+    r"(?=(?P<street>.*?)"
+    r"(?:COLONIA: (?P<colonia>.*?)"
+    r"(?:COLONIA: |C[^\n]P(?!COLONIA: )[^\n]|\Z)|\Z))"
+    r"(?=.*?(?:No(?!COLONIA: )[^\n](?P<num>.*?)"
+    r"(?:COLONIA: |No(?!COLONIA: )[^\n]|\Z)|COLONIA: |\Z))"
+    r"(?=.*?(?P<cp>\d{5}))?"
+    r"(?=.*?(?P<telefono>\d{10}))?",
+    re.DOTALL,
+)
+
+
+def _broadcast(result, codes: np.ndarray, index):
+    """
+    Expand a result computed per unique value to every row. Numeric
+    results keep their dtype, anything else becomes categorical
+    """
+    if isinstance(result, DataFrame):
+        return DataFrame({
+            col: _broadcast(result[col], codes, index)
+            for col in result
+        })
+    if is_numeric_dtype(result.dtype):
+        return Series(result.to_numpy()[codes], index=index, name=result.name)
+    result_codes, uniques = factorize(result.to_numpy(dtype=object),
+                                      sort=True)
+    return Series(
+        Categorical.from_codes(result_codes[codes], uniques),
+        index=index,
+        name=result.name,
+    )
+
+
+def unique_values(func):
+    """
+    Decorator running a Series -> Series (or DataFrame) transform once per
+    unique value of its input instead of once per row, and broadcasting
+    the result back through the category codes
+    """
+    @wraps(func)
+    def wrapper(data: Series, *args, **kwargs):
+        if not isinstance(data.dtype, CategoricalDtype):
+            data = data.astype("category")
+        codes = data.cat.codes.to_numpy()
+        # The extra last value stands for the missing rows, whose code is -1
+        values = np.append(data.cat.categories.to_numpy(dtype=object), np.nan)
+        result = func(Series(values, dtype=object, name=data.name),
+                      *args, **kwargs)
+        return _broadcast(result, codes, data.index)
+    return wrapper
+
+
+@unique_values
+def parse_domicilio(address_data: Series) -> DataFrame:
+    """
+    Split DOMICILIO ("CALLE No. N COLONIA: X C.P. NNNNN") into the raw
+    calle, street, colonia, num, cp and telefono parts with one regex
+    """
+    data = address_data.astype(str)
+    data = data.str.strip()
+    parts = data.str.extract(_DOMICILIO)
+    # Only the text fields treated missing DOMICILIO as the string "nan"
+    missing = address_data.isna()
+    parts.loc[missing, ["num", "telefono"]] = None
+    return parts
+
+
+@unique_values
+def clean_address(data: Series) -> Series:
+    data = strip_stopwords(data)
+    data = data.str.replace(
+        "\ C.P.+",
+        "",
+        regex=True
+    )
+    data = data.str.replace(
+        "SIN NOMBRE",
+        "",
+        regex=True
+    )
+    data = data.str.replace(
+        "No . SIN NUMERO",
+        "",
+        regex=True
+    )
+    return data.str.replace("No . ", "", regex=True)
+
+
+@unique_values
+def clean_calle(data: Series) -> Series:
+    # keep only the [A-Z ] characters
+    data = data.str.replace(
+        "[^A-Z ]+",
+        "",
+        regex=True
+    )
+    data = data.fillna("")
+    data = strip_stopwords(data)
+    data = data.str.replace(
+        "SIN NOMBRE",
+        "",
+        regex=True
+    )
+    return data.str.replace(
+        "No . SIN NUMERO",
+        "",
+        regex=True
+    )
+
+
+@unique_values
+def clean_num(data: Series) -> Series:
+    return data.str.extract(
+        r'(\d+)',
+        expand=False
+    )
+
+
+@unique_values
+def clean_cp(data: Series) -> Series:
+    data = data.fillna(0)
+    return data.astype('float16')
+
+
+@unique_values
+def clean_colonia(data: Series) -> Series:
+    data = data.str.replace(
+        "SIN NOMBRE",
+        "",
+        regex=True
+    )
+    data = data.str.replace(
+        "No . SIN NUMERO",
+        "",
+        regex=True
+    )
+    return data.str.replace(
+        "No . ",
+        "",
+        regex=True
+    )
+
 
 class Tweak:
     """
     Class documentation
     """
 
+    # Derived columns, in the order they are added by default, with the
+    # method computing each one and the columns it needs. Needed columns
+    # that are derived too are computed first
+    DERIVED = {
+        "address": ("_get_address", ["DOMICILIO"]),
+        "calle": ("_get_calle", ["DOMICILIO"]),
+        "num": ("_get_num", ["DOMICILIO"]),
+        "telefono": ("_get_telephone", ["DOMICILIO"]),
+        "colonia": ("_get_colonia", ["DOMICILIO"]),
+    }
+
     def __init__(self,
-                 data: DataFrame) -> None:
+                 data: DataFrame,
+                 derived: list = None) -> None:
         self.data = data
+        self.domicilio = None
         self._obj2category()
-        self._get_address()
-        self._get_calle()
-        self._get_num()
-        self._get_telephone()
-        self._get_colonia()
+        self._downcast_int()
+        self.require(list(self.DERIVED) if derived is None else derived)
 
-    def _int2uint32(self) -> None:
+    def require(self,
+                columns: list) -> DataFrame:
         """
-        convert integer to uint32
+        Compute the derived columns that are not in the data yet, so an
+        empty derived list at init defers them until they are needed
         """
-        # type: ignore
-        cols = self.data.select_dtypes('int')
-        # type: ignore
-        self.data = self.data.astype({
-            col: "uint16"
-            for col in cols
-        })
+        for col in columns:
+            if col in self.data.columns:
+                continue
+            method, needs = self.DERIVED[col]
+            self.require([need for need in needs if need in self.DERIVED])
+            missing = [need for need in needs if need not in self.data]
+            if missing:
+                raise KeyError(f"{col} needs the missing columns {missing}.")
+            getattr(self, method)()
+        return self.data
+
+    def __getitem__(self,
+                    col: str) -> Series:
+        """
+        A column of the data, derived on first access
+        """
+        if col in self.DERIVED:
+            self.require([col])
+        return self.data[col]
+
+    def _downcast_int(self) -> None:
+        """
+        convert integers to the smallest type holding their values,
+        unsigned when none of them is negative
+        """
+        for col in self.data.select_dtypes('integer'):
+            data = self.data[col]
+            self.data[col] = to_numeric(
+                data,
+                downcast="unsigned" if (data >= 0).all() else "integer",
+            )
 
     def _obj2category(self) -> None:
         """
         convert object to category
         """
         # type: ignore
-        cols = self.data.select_dtypes('object')
+        cols = self.data.select_dtypes(['object', 'string'])
         self.data = self.data.astype({
             col: "category"
             for col in cols
         })
 
+    @timed(rows=data_rows)
+    def _parse_domicilio(self) -> DataFrame:
+        """
+        DOMICILIO split into its parts, parsed once for all extractors
+        """
+        if self.domicilio is None:
+            self.domicilio = parse_domicilio(self.data["DOMICILIO"])
+        return self.domicilio
+
+    @timed(rows=data_rows)
     def _get_address(self) -> None:
-        address_data = self.data["DOMICILIO"]
-        data = address_data.astype(str)
-        data = data.str.strip()
-        data = data.str.split(
-            'COLONIA: ',
-            expand=False
+        self.data["address"] = clean_address(
+            self._parse_domicilio()["street"]
         )
-        data = data.str[0]
-        data = data.apply(word_tokenize)
-        data = data.apply(
-            lambda x:
-            [word
-             for word in x
-             if word not in street_stopword]
-        )
-        data = data.apply(TreebankWordDetokenizer().detokenize)
-        data = data.str.replace(
-            "\ C.P.+",
-            "",
-            regex=True
-        )
-        data = data.str.replace(
-            "SIN NOMBRE",
-            "",
-            regex=True
-        )
-        data = data.str.replace(
-            "No . SIN NUMERO",
-            "",
-            regex=True
-        )
-        data = data.str.replace("No . ", "", regex=True)
-        self.data["address"] = data
 
+    @timed(rows=data_rows)
     def _get_calle(self) -> None:
         '''
         calle
         '''
-        address_data = self.data["DOMICILIO"]
-        # type: ignore
-        data = address_data.astype(str)
-        data = data.str.strip()
-        data = data.str.split(
-            'No. ',
-            expand=False
-        )
-        data = data.str[0]
-        data = data.str.findall('[A-Z ]+')
-        data = data.str.join("")
-        data = data.fillna("")
-        data = data.apply(word_tokenize)
-        data = data.apply(
-            lambda x:
-            [
-                word
-                for word in x
-                if word not in street_stopword
-            ]
-        )
-        data = data.apply(TreebankWordDetokenizer().detokenize)
-        data = data.str.replace(
-            "SIN NOMBRE",
-            "",
-            regex=True
-        )
-        data = data.str.replace(
-            "No . SIN NUMERO",
-            "",
-            regex=True
-        )
-        self.data["calle"] = data
+        self.data["calle"] = clean_calle(self._parse_domicilio()["calle"])
 
+    @timed(rows=data_rows)
     def _get_num(self):
         """
         numero
         """
-        address_data = self.data["DOMICILIO"]
-        data = address_data.str.split(
-            'COLONIA: ',
-            expand=False)
-        data = data.str[0]
-        data = data.str.split(
-            'No.',
-            expand=False,
-        )
-        data = data.str[1]
-        data = data.str.replace(
-            r"\b(.)\1+\b",
-            " "
-        )
-        data = data.str.extract(
-            '(\d+)',
-            expand=False
-        )
-        self.data["num"] = data
+        self.data["num"] = clean_num(self._parse_domicilio()["num"])
 
+    @timed(rows=data_rows)
     def _get_cp(self) -> None:
         """
         Codigo postal
         """
-        address_data = self.data["DOMICILIO"]
-        data = address_data.astype(str)
-        data = data.str.extract(r'(\d{5})')
-        data = data.fillna(0)
-        data = data.astype('float16')
-        self.data["cp"] = data
+        self.data["cp"] = clean_cp(self._parse_domicilio()["cp"])
 
+    @timed(rows=data_rows)
     def _get_telephone(self) -> None:
         """
         Telefono
         """
-        address_data = self.data["DOMICILIO"]
-        # type: ignore
-        data = address_data.str.extract(r'(\d{10})')
-        self.data["telefono"] = data
+        self.data["telefono"] = self._parse_domicilio()["telefono"]
 
+    @timed(rows=data_rows)
     def _get_colonia(self):
         """
         colonia
         """
-        address_data = self.data["DOMICILIO"]
-        # type: ignore
-        data = address_data.astype(str)
-        data = data.str.strip()
-        data = data.str.split(
-            'COLONIA: ',
-            expand=False
-        )
-        data = data.str[1]
-        data = data.str.split(
-            'C.P.',
-            expand=False,
-        )
-        data = data.str[0]
-        data = data.str.replace(
-            "SIN NOMBRE",
-            "",
-            regex=True
-        )
-        data = data.str.replace(
-            "No . SIN NUMERO",
-            "",
-            regex=True
-        )
-        data = data.str.replace(
-            "No . ",
-            "",
-            regex=True
+        self.data["colonia"] = clean_colonia(
+            self._parse_domicilio()["colonia"]
         )
-        self.data["colonia"] = data
 
-    def get_data(self) -> DataFrame:
+    def get_data(self,
+                 copy: bool = True) -> DataFrame:
         """
-        Documentation
+        Cleaned data. With copy=False the frame shares its columns with
+        the Tweak instead of duplicating them
         """
-        return self.data.copy()
+        if copy:
+            return self.data.copy()
+        return self.data.copy(deep=False)
@@ -1,13 +1,28 @@
+import warnings
+
 import pandas as pd
 import numpy as np
 
+from Modules.instrument import (
+    batch_pairs,
+    timed,
+)
+from strbatch import (
+    PRUNED,
+    StringColumn,
+    count_pruned,
+    length_groups,
+)
+
+
 def smith_waterman_similarity(s1,
                               s2,
                               match=5,
                               mismatch=-5,
                               gap_start=-5,
                               gap_continue=-1,
-                              norm="mean"):
+                              norm="mean",
+                              min_score=None):
     """Smith-Waterman string comparison.
     An implementation of the Smith-Waterman string comparison algorithm
     described in Christen, Peter (2012).
@@ -35,6 +50,8 @@ def smith_waterman_similarity(s1,
         of "min", "max",or "mean". "min" will use the minimum string length
         as the normalization metric. "max" and "mean" use the maximum and
         mean string length respectively. Default: "mean""
+    min_score : float
+        Similarity threshold, see smith_waterman_batch. Default: None
     Returns
     -------
     pandas.Series
@@ -42,169 +59,255 @@ def smith_waterman_similarity(s1,
         and 1.
     """
 
-    # Assert that match is greater than or equal to mismatch, gap_start, and
-    # gap_continue.
+    if len(s1) != len(s2):
+        raise ValueError('Arrays or Series have to be same length.')
+
+    if len(s1) == len(s2) == 0:
+        return []
+
+    return pd.Series(smith_waterman_batch(s1,
+                                          s2,
+                                          match=match,
+                                          mismatch=mismatch,
+                                          gap_start=gap_start,
+                                          gap_continue=gap_continue,
+                                          norm=norm,
+                                          min_score=min_score))
+
+
+@timed(pairs=batch_pairs)
+def smith_waterman_batch(s1,
+                         s2,
+                         match=5,
+                         mismatch=-5,
+                         gap_start=-5,
+                         gap_continue=-1,
+                         norm="mean",
+                         score_only=False,
+                         min_score=None,
+                         stats=None,
+                         bucket=8,
+                         batch_size=4096):
+    """
+    smith_waterman_batch(s1, s2, match=5, mismatch=-5, gap_start=-5,
+                         gap_continue=-1, norm="mean", score_only=False,
+                         min_score=None, stats=None)
+    Batch Smith-Waterman comparison of two aligned string arrays.
+    Same scoring scheme and normalization as smith_waterman_similarity,
+    but pairs are grouped by string length and scored together in NumPy,
+    one anti-diagonal of the dynamic programming matrix at a time. Only
+    the two previous anti-diagonals are kept in memory, together with the
+    horizontal/vertical gap flags the scoring scheme needs; no score or
+    trace matrix is ever allocated.
+    With min_score, pairs that cannot reach it are skipped: first when
+    the most their string lengths allow is too low, then during the
+    dynamic program as soon as the best score so far plus the most the
+    remaining anti-diagonals can add falls short.
+    Parameters
+    ----------
+    s1 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Left strings.
+    s2 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Right strings, aligned by position with s1.
+    match, mismatch, gap_start, gap_continue : float
+        Scoring scheme, see smith_waterman_similarity.
+    norm : str
+        One of "min", "max" or "mean", see smith_waterman_similarity.
+        Default: "mean"
+    score_only : bool
+        Return the raw alignment scores instead of normalized similarities.
+        Default: False
+    min_score : float
+        Threshold on the returned values. Pairs that are proven to stay
+        below it get strbatch.PRUNED instead of their score; other pairs
+        below it may still get their exact score. Default: None
+    stats : dict
+        When given, stats["pruned"] is increased by the number of pruned
+        pairs.
+    bucket : int
+        Width of the string length buckets used to group pairs. Default: 8.
+    batch_size : int
+        Maximum number of pairs scored together. Default: 4096.
+    Returns
+    -------
+    numpy.ndarray
+        A float array with one value per pair. Missing values give NaN,
+        empty strings give 0.
+    """
+
     assert match >= max(mismatch, gap_start, gap_continue), \
         "match must be greater than or equal to mismatch, " \
         "gap_start, and gap_continue"
 
-    if len(s1) != len(s2):
+    a = StringColumn.from_values(s1)
+    b = StringColumn.from_values(s2)
+
+    if len(a) != len(b):
         raise ValueError('Arrays or Series have to be same length.')
 
-    if len(s1) == len(s2) == 0:
-        return []
+    null = a.null | b.null
+    len1 = np.where(null, 0, a.lengths)
+    len2 = np.where(null, 0, b.lengths)
 
-    concat = pd.Series(list(zip(s1, s2)))
-
-    def sw_apply(t):
-        """
-        sw_apply(t)
-        A helper function that is applied to each pair of records
-        in s1 and s2. Assigns a similarity score to each pair,
-        between 0 and 1. Used by the pandas.apply method.
-        Parameters
-        ----------
-        t : pandas.Series
-            A pandas Series containing two strings to be compared.
-        Returns
-        -------
-        Float
-            A similarity score between 0 and 1.
-        """
-        str1 = t[0]
-        str2 = t[1]
-
-        def compute_score():
-            """
-            compute_score()
-            The helper function that produces the non-normalized
-            similarity score between two strings. The scores are
-            determined using the Smith-Waterman dynamic programming
-            algorithm. The scoring scheme is determined from the
-            parameters provided to the parent smith_waterman_similarity()
-            function.
-            Returns
-            -------
-            Float
-                A score 0 or greater. Indicates similarity between two strings.
-            """
-
-            # Initialize the score matrix with 0s
-
-            m = [[0] * (1 + len(str2)) for i in range(1 + len(str1))]
-
-            # Initialize the trace matrix with empty lists
-            trace = [[[] for _ in range(1 + len(str2))]
-                     for _ in range(1 + len(str1))]
-
-            # Initialize the highest seen score to 0
-            highest = 0
-
-            # Iterate through the matrix
-            for x in range(1, 1 + len(str1)):
-                for y in range(1, 1 + len(str2)):
-                    # Calculate Diagonal Score
-                    if str1[x - 1] == str2[y - 1]:
-                        # If characters match, add the match score to the
-                        # diagonal score
-                        diagonal = m[x - 1][y - 1] + match
-                    else:
-                        # If characters do not match, add the mismatch score
-                        # to the diagonal score
-                        diagonal = m[x - 1][y - 1] + mismatch
-
-                    # Calculate the Left Gap Score
-                    if "H" in trace[x - 1][y]:
-                        # If cell to the left's score was calculated based on
-                        # a horizontal gap, add the gap continuation penalty
-                        # to the left score.
-                        gap_horizontal = m[x - 1][y] + gap_continue
-                    else:
-                        # Otherwise, add the gap start penalty to the left
-                        # score
-                        gap_horizontal = m[x - 1][y] + gap_start
-
-                    # Calculate the Above Gap Score
-                    if "V" in trace[x][y - 1]:
-                        # If above cell's score was calculated based on a
-                        # vertical gap, add the gap continuation penalty to
-                        # the above score.
-                        gap_vertical = m[x][y - 1] + gap_continue
-                    else:
-                        # Otherwise, add the gap start penalty to the above
-                        # score
-                        gap_vertical = m[x][y - 1] + gap_start
-
-                    # Choose the highest of the three scores
-                    score = max(diagonal, gap_horizontal, gap_vertical)
-
-                    if score <= 0:
-                        # If score is less than 0, boost to 0
-                        score = 0
-                    else:
-                        # If score is greater than 0, determine whether it was
-                        # calculated based on a diagonal score, horizontal gap,
-                        # or vertical gap. Store D, H, or V in the trace matrix
-                        # accordingly.
-                        if score == diagonal:
-                            trace[x][y].append("D")
-                        if score == gap_horizontal:
-                            trace[x][y].append("H")
-                        if score == gap_vertical:
-                            trace[x][y].append("V")
-
-                    # If the cell's score is greater than the highest score
-                    # previously present, record the score as the highest.
-                    if score > highest:
-                        highest = score
-
-                    # Set the cell's score to score
-                    m[x][y] = score
-
-            # After iterating through the entire matrix, return the highest
-            # score found.
-            return highest
-
-        def normalize(score):
-            """
-            normalize(score)
-            A helper function used to normalize the score produced by
-            compute_score() to a score between 0 and 1. The method for
-            normalization is determined by the norm argument provided
-            to the parent, smith_waterman_similarity function.
-            Parameters
-            ----------
-            score : Float
-                The score produced by the compute_score() function.
-            Returns
-            -------
-            Float
-                A normalized score between 0 and 1.
-            """
-            if norm == "min":
-                # Normalize by the shorter string's length
-                return score / (min(len(str1), len(str2)) * match)
-            if norm == "max":
-                # Normalize by the longer string's length
-                return score / (max(len(str1), len(str2)) * match)
-            if norm == "mean":
-                # Normalize by the mean length of the two strings
-                return 2 * score / ((len(str1) + len(str2)) * match)
-            else:
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if score_only:
+            denom = np.ones(len(a))
+        elif norm == "min":
+            denom = np.minimum(len1, len2) * match
+        elif norm == "max":
+            denom = np.maximum(len1, len2) * match
+        else:
+            if norm != "mean":
                 warnings.warn(
-                    'Unrecognized longest common substring normalization. '
+                    'Unrecognized Smith-Waterman normalization. '
                     'Defaulting to "mean" method.')
-                return 2 * score / ((len(str1) + len(str2)) * match)
+            denom = (len1 + len2) * match / 2
+
+    # Raw score each pair has to reach, with some slack for rounding
+    need = None
+    pruned = np.zeros(len(a), dtype=bool)
+    if min_score is not None:
+        need = min_score * denom * (1 - 1e-9)
+        if max(gap_start, gap_continue) > 0:
+            # Gaps add to the score, bound it by the gain per anti-diagonal
+            # of _sw_diagonals
+            best = (len1 + len2) * max(match / 2, gap_start, gap_continue)
+        else:
+            best = np.minimum(len1, len2) * match
+        pruned = ~null & (best < need)
+
+    scores = np.zeros(len(a), dtype=np.float64)
+    todo = np.flatnonzero(~null & ~pruned & (len1 > 0) & (len2 > 0))
+
+    for group in length_groups(len1[todo], len2[todo], bucket, batch_size):
+        idx = todo[group]
+        scores[idx] = _sw_diagonals(
+            a.padded(idx, len1[idx].max()),
+            b.padded(idx, len2[idx].max()),
+            len1[idx],
+            len2[idx],
+            match,
+            mismatch,
+            gap_start,
+            gap_continue,
+            None if need is None else need[idx],
+        )
+    pruned |= np.isnan(scores)
+
+    if score_only:
+        sims = scores
+    else:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sims = np.where(denom > 0,
+                            scores / np.where(denom > 0, denom, 1),
+                            0)
+    sims[pruned] = PRUNED
+    sims[null] = np.nan
+    count_pruned(stats, pruned)
+    return sims
+
+
+def _sw_diagonals(A,
+                  B,
+                  len1,
+                  len2,
+                  match,
+                  mismatch,
+                  gap_start,
+                  gap_continue,
+                  need=None,
+                  check=8):
+    """
+    _sw_diagonals(A, B, len1, len2, match, mismatch, gap_start,
+                  gap_continue, need=None, check=8)
+    Highest Smith-Waterman score of each row pair of A and B.
+    Anti-diagonal d holds the cells (x, y) with x + y = d, stored by row x.
+    Cell (x, y) only depends on (x - 1, y - 1) on diagonal d - 2 and on
+    (x - 1, y), (x, y - 1) on diagonal d - 1, so a whole diagonal of every
+    pair in the batch is computed at once. Padding cells never feed valid
+    cells and are masked out of the maximum.
+    No cell exceeds the best score of the two previous diagonals plus
+    gain = max(match / 2, gap_start, gap_continue) per diagonal, so every
+    check diagonals the pairs whose best score plus gain times their
+    remaining diagonals is below need are dropped from the batch.
+    Parameters
+    ----------
+    A : numpy.ndarray
+        (n, L1) codepoint matrix of the left strings.
+    B : numpy.ndarray
+        (n, L2) codepoint matrix of the right strings.
+    len1, len2 : numpy.ndarray
+        Unpadded string lengths.
+    need : numpy.ndarray
+        Raw score each pair has to reach, or None to score all pairs.
+    check : int
+        Number of diagonals between two pruning passes.
+    Returns
+    -------
+    numpy.ndarray
+        The raw scores, one per pair, NaN for pruned pairs.
+    """
+    n, L1 = A.shape
+    L2 = B.shape[1]
+
+    # Score and gap flags of diagonals d - 2 (m2) and d - 1 (m1, h1, v1).
+    m2 = np.zeros((n, L1 + 1))
+    m1 = np.zeros((n, L1 + 1))
+    h1 = np.zeros((n, L1 + 1), dtype=bool)
+    v1 = np.zeros((n, L1 + 1), dtype=bool)
+    m0 = np.zeros((n, L1 + 1))
+    h0 = np.zeros((n, L1 + 1), dtype=bool)
+    v0 = np.zeros((n, L1 + 1), dtype=bool)
+    highest = np.zeros(n)
+    result = np.full(n, np.nan)
+    rows = np.arange(n)
+    gain = max(match / 2, gap_start, gap_continue)
+
+    len1 = len1[:, None]
+    len2 = len2[:, None]
+
+    for d in range(2, L1 + L2 + 1):
+        if need is not None and d % check == 0:
+            remaining = np.maximum(len1 + len2 - d + 2, 0)[:, 0]
+            bound = highest + gain * remaining
+            keep = bound >= need
+            if not keep.all():
+                A, B, len1, len2 = A[keep], B[keep], len1[keep], len2[keep]
+                m2, m1, m0 = m2[keep], m1[keep], m0[keep]
+                h1, h0, v1, v0 = h1[keep], h0[keep], v1[keep], v0[keep]
+                highest, rows, need = highest[keep], rows[keep], need[keep]
+                if not len(rows):
+                    break
+
+        lo = max(1, d - L2)
+        hi = min(L1, d - 1)
+        xs = np.arange(lo, hi + 1)
+        ys = d - xs
+
+        same = A[:, xs - 1] == B[:, ys - 1]
+        diagonal = m2[:, lo - 1:hi] + np.where(same, match, mismatch)
+        gap_horizontal = m1[:, lo - 1:hi] + np.where(h1[:, lo - 1:hi],
+                                                     gap_continue, gap_start)
+        gap_vertical = m1[:, lo:hi + 1] + np.where(v1[:, lo:hi + 1],
+                                                   gap_continue, gap_start)
+        score = np.maximum(np.maximum(diagonal, gap_horizontal), gap_vertical)
+        positive = score > 0
+
+        m0.fill(0)
+        h0.fill(False)
+        v0.fill(False)
+        m0[:, lo:hi + 1] = np.where(positive, score, 0)
+        h0[:, lo:hi + 1] = positive & (score == gap_horizontal)
+        v0[:, lo:hi + 1] = positive & (score == gap_vertical)
 
-        try:
-            if len(str1) == 0 or len(str2) == 0:
-                return 0
-            return normalize(compute_score())
+        valid = (xs <= len1) & (ys <= len2)
+        np.maximum(highest,
+                   np.where(valid, m0[:, lo:hi + 1], 0).max(axis=1),
+                   out=highest)
 
-        except Exception as err:
-            if pd.isnull(t[0]) or pd.isnull(t[1]):
-                return np.nan
-            else:
-                raise err
+        m2, m1, m0 = m1, m0, m2
+        h1, h0 = h0, h1
+        v1, v0 = v0, v1
 
-    return concat.apply(sw_apply)
+    result[rows] = highest
+    return result
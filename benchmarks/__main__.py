@@ -0,0 +1,61 @@
+"""
+Run the benchmarks on generated SISVER extracts, from the repository root:
+
+    python -m benchmarks --sizes 10000 1000000 --output bench.json
+    python -m benchmarks --groups similarity --baseline bench.json
+"""
+from argparse import ArgumentParser
+from sys import exit
+
+from .suite import (
+    GROUPS,
+    SIZES,
+    compare,
+    load,
+    run,
+    save,
+)
+
+
+def main() -> int:
+    parser = ArgumentParser(prog="python -m benchmarks")
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES,
+                        help="rows of the generated extracts")
+    parser.add_argument("--groups", nargs="+", choices=GROUPS,
+                        default=GROUPS)
+    parser.add_argument("--max-pairs", type=int, default=1000000,
+                        help="pairs scored by the similarity benchmarks")
+    parser.add_argument("--max-lsh", type=int, default=1000000,
+                        help="records signed by the LSH benchmark")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--no-memory", action="store_true",
+                        help="skip the traced run measuring peak memory")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench.json",
+                        help="JSON file of the results")
+    parser.add_argument("--baseline",
+                        help="JSON results to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed slowdown or memory growth")
+    args = parser.parse_args()
+
+    results = run(
+        sizes=args.sizes,
+        groups=args.groups,
+        max_pairs=args.max_pairs,
+        max_lsh=args.max_lsh,
+        repeat=args.repeat,
+        memory=not args.no_memory,
+        seed=args.seed,
+    )
+    save(results, args.output)
+    if args.baseline is None:
+        return 0
+    regressions = compare(load(args.baseline), results, args.tolerance)
+    for name, size, key, before, after in regressions:
+        print(f"REGRESSION {name} {size:,} {key}: {before:.4g} -> {after:.4g}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    exit(main())
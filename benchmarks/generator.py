@@ -0,0 +1,301 @@
+import string
+
+import numpy as np
+from pandas import (
+    DataFrame,
+    Series,
+    Timestamp,
+    concat,
+    to_timedelta,
+)
+
+from curp import check_digit
+
+NOMBRES = [
+    'JOSE', 'JUAN', 'MARIA', 'GUADALUPE', 'FRANCISCO', 'ANTONIO', 'ROSA',
+    'JESUS', 'MIGUEL', 'ALEJANDRO', 'PEDRO', 'LUIS', 'CARMEN', 'ANA',
+    'VERONICA', 'JUANA', 'PATRICIA', 'ELIZABETH', 'LETICIA', 'ROBERTO',
+    'MANUEL', 'FERNANDO', 'RICARDO', 'JAVIER', 'SERGIO', 'YOLANDA',
+    'GABRIELA', 'MARTHA', 'SILVIA', 'ALICIA', 'JOSE LUIS', 'MARIA ELENA',
+    'JUAN CARLOS', 'MA. DEL CARMEN', 'NOEMI', 'VICTOR', 'HECTOR',
+    'ARTURO', 'CESAR', 'ROCIO', 'XIMENA', 'GUILLERMO', 'ÑUSTA', 'YESENIA',
+]
+APELLIDOS = [
+    'HERNANDEZ', 'GARCIA', 'MARTINEZ', 'LOPEZ', 'GONZALEZ', 'RODRIGUEZ',
+    'PEREZ', 'SANCHEZ', 'RAMIREZ', 'CRUZ', 'FLORES', 'GOMEZ', 'MORALES',
+    'VAZQUEZ', 'JIMENEZ', 'REYES', 'DIAZ', 'TORRES', 'GUTIERREZ', 'RUIZ',
+    'MENDOZA', 'AGUILAR', 'ORTIZ', 'MORENO', 'CASTILLO', 'ROMERO',
+    'ALVAREZ', 'MENDEZ', 'CHAVEZ', 'RIVERA', 'JUAREZ', 'RAMOS', 'DOMINGUEZ',
+    'HERRERA', 'MEDINA', 'CASTRO', 'VARGAS', 'GUZMAN', 'VELAZQUEZ',
+    'MUÑOZ', 'NUÑEZ', 'VILLALOBOS', 'BRAVO', 'QUINTERO', 'ZAVALA',
+]
+CALLES = [
+    'AV. JUAREZ', 'HIDALGO', 'MORELOS', 'CALLE 5 DE MAYO', 'INDEPENDENCIA',
+    'PRIV. GUERRERO', 'CERRADA LAS FLORES', 'PROL. REFORMA', 'ZARAGOZA',
+    'ALLENDE', 'AVENIDA INSURGENTES', 'CALLEJON DEL BESO', 'BENITO JUAREZ',
+    'LAZARO CARDENAS', 'EMILIANO ZAPATA', 'SIN NOMBRE', 'CONOCIDO',
+    'AMPLIACION LOS PINOS', 'DE LA PAZ', 'EL ROSARIO',
+]
+COLONIAS = [
+    'CENTRO', 'SAN JUAN', 'LA JOYA', 'EL CARMEN', 'LOS ANGELES', 'LAS PALMAS',
+    'SANTA CRUZ', 'GUADALUPE', 'LA PROGRESO', 'INFONAVIT', 'EL MIRADOR',
+    'BENITO JUAREZ', 'SAN ANTONIO', 'LOMAS DEL VALLE', 'SIN NOMBRE',
+]
+OCUPACIONES = [
+    'HOGAR', 'EMPLEADOS', 'ESTUDIANTES', 'CAMPESINOS', 'COMERCIANTES',
+    'JUBILADO / PENSIONADO', 'DESEMPLEADOS', 'MEDICOS', 'ENFERMERAS',
+    'CHOFERES', 'OBREROS', 'MAESTROS', 'OTROS',
+]
+CLASIFICACIONES = [
+    'NEGATIVO ANT', 'NEGATIVO', 'CONF ANT', 'CONF LAB', 'CONF ASO',
+    'CONF DIC', 'SOSPECHOSO', 'INVALIDO',
+]
+ESTADOS = [
+    'AS', 'BC', 'BS', 'CC', 'CL', 'CM', 'CS', 'CH', 'DF', 'DG', 'GT', 'GR',
+    'HG', 'JC', 'MC', 'MN', 'MS', 'NT', 'NL', 'OC', 'PL', 'QT', 'QR', 'SP',
+    'SL', 'SR', 'TC', 'TS', 'TL', 'VZ', 'YN', 'ZS',
+]
+SI_NO = ['SI', 'NO', 'SE IGNORA']
+
+# Text columns receiving the typos of the duplicates
+TYPO_COLS = ['NOMBRE', 'APEPATER', 'APEMATER', 'DOMICILIO', 'CURP']
+_LETTERS = np.array(list(string.ascii_uppercase))
+# Day of the extract, counted from 1930-01-01 as the birth dates are
+_TODAY = (Timestamp("2021-11-10") - Timestamp("1930-01-01")).days
+# First birth day whose CURP homoclave is a letter instead of a digit
+_Y2K = (Timestamp("2000-01-01") - Timestamp("1930-01-01")).days
+# Words the CURP skips: the first one of compound first names such as
+# JOSE LUIS or MA. DEL CARMEN, and the particles of compound names
+_COMMON_NAMES = {"JOSE", "J", "J.", "MARIA", "MA", "MA.", "M", "M."}
+_PARTICLES = {
+    "DA", "DAS", "DE", "DEL", "DER", "DI", "DIE", "DD", "EL", "LA", "LAS",
+    "LE", "LES", "LOS", "MAC", "MC", "VAN", "VON", "Y",
+}
+_VOWELS = "AEIOU"
+
+
+def _pick(rng: np.random.Generator,
+          values: list,
+          n_rows: int) -> np.ndarray:
+    """
+    n_rows values drawn with a Zipf-like skew, as names are
+    """
+    weights = 1 / np.arange(1, len(values) + 1)
+    return np.array(values, dtype=object)[
+        rng.choice(len(values), n_rows, p=weights / weights.sum())
+    ]
+
+
+def _digits(rng: np.random.Generator,
+            n_rows: int,
+            width: int) -> Series:
+    values = Series(rng.integers(0, 10 ** width, n_rows)).astype(str)
+    return values.str.zfill(width)
+
+
+def _days(start: str,
+          days: int,
+          format: str = "%Y-%m-%d") -> np.ndarray:
+    """
+    The days from start formatted once, to be indexed by day offset
+    """
+    return (
+        Timestamp(start) + to_timedelta(np.arange(days), unit="D")
+    ).strftime(format).to_numpy(dtype=object)
+
+
+def _dates(rng: np.random.Generator,
+           n_rows: int,
+           start: str,
+           days: int) -> np.ndarray:
+    return _days(start, days)[rng.integers(0, days, n_rows)]
+
+
+def _curp_letters(value: str,
+                  first_name: bool = False) -> tuple:
+    """
+    (first letter, first inner vowel, first inner consonant) of the word
+    of a name the CURP is formed from, Ñ written X and X for the missing
+    ones
+    """
+    words = value.replace("Ñ", "X").split()
+    if first_name and len(words) > 1 and words[0] in _COMMON_NAMES:
+        words = words[1:]
+    while len(words) > 1 and words[0] in _PARTICLES:
+        words = words[1:]
+    word = words[0] if words else ""
+    inner = [char for char in word[1:] if char.isalpha()]
+    return (
+        word[:1] or "X",
+        next((char for char in inner if char in _VOWELS), "X"),
+        next((char for char in inner if char not in _VOWELS), "X"),
+    )
+
+
+def _curps(rng: np.random.Generator,
+           apepater: np.ndarray,
+           apemater: np.ndarray,
+           nombre: np.ndarray,
+           born: np.ndarray,
+           sexo: np.ndarray,
+           entnaci: np.ndarray) -> Series:
+    """
+    CURPs formed from the names, birth days (from 1930-01-01), sexes and
+    birth states as RENAPO does, with a random homoclave, a digit for the
+    births before 2000 and a letter from 2000 on, and their check digit
+    """
+    def letters(values, first_name=False):
+        found = {
+            value: _curp_letters(value, first_name)
+            for value in set(values)
+        }
+        return np.array([found[value] for value in values], dtype=object)
+
+    pater = letters(apepater)
+    mater = letters(apemater)
+    name = letters(nombre, first_name=True)
+    homoclave = np.where(
+        born >= _Y2K,
+        _LETTERS.astype(object)[rng.integers(0, 26, len(born))],
+        rng.integers(0, 10, len(born)).astype(str).astype(object),
+    )
+    curp = (
+        pater[:, 0] + pater[:, 1] + mater[:, 0] + name[:, 0]
+        + _days("1930-01-01", 90 * 365, "%y%m%d")[born]
+        + np.where(sexo == "MUJER", "M", "H").astype(object)
+        + entnaci
+        + pater[:, 2] + mater[:, 2] + name[:, 2]
+        + homoclave
+    )
+    return Series(curp + check_digit(curp).astype(str).astype(object))
+
+
+def typo(value: str,
+         rng: np.random.Generator) -> str:
+    """
+    value with one random substitution, deletion, insertion or
+    transposition of its characters
+    """
+    if not isinstance(value, str) or len(value) < 2:
+        return value
+    i = int(rng.integers(0, len(value) - 1))
+    kind = rng.integers(0, 4)
+    letter = rng.choice(_LETTERS)
+    if kind == 0:
+        return value[:i] + letter + value[i + 1:]
+    if kind == 1:
+        return value[:i] + value[i + 1:]
+    if kind == 2:
+        return value[:i] + letter + value[i:]
+    return value[:i] + value[i + 1] + value[i] + value[i + 2:]
+
+
+def generate(n_rows: int,
+             duplicate_rate: float = 0.05,
+             typo_rate: float = 0.3,
+             missing_rate: float = 0.02,
+             seed=0) -> DataFrame:
+    """
+    Fake SISVER rows with the Dataset.usefull_cols columns, as read from
+    the CSV (dates and text as strings). A duplicate_rate share of the
+    rows repeat an earlier record, each of their TYPO_COLS values with a
+    typo with probability typo_rate. DUPLICATE_OF holds the row of the
+    repeated record, -1 for the others
+    """
+    rng = np.random.default_rng(seed)
+    n_dups = int(n_rows * duplicate_rate)
+    n_base = n_rows - n_dups
+
+    nombre = _pick(rng, NOMBRES, n_base)
+    apepater = _pick(rng, APELLIDOS, n_base)
+    apemater = _pick(rng, APELLIDOS, n_base)
+    sexo = rng.choice(np.array(['MUJER', 'HOMBRE'], dtype=object), n_base)
+    born = rng.integers(0, 90 * 365, n_base)
+    entnaci = _pick(rng, ESTADOS, n_base)
+    curp = _curps(rng, apepater, apemater, nombre, born, sexo, entnaci)
+    cp = _digits(rng, n_base, 5)
+    telefono = _digits(rng, n_base, 10)
+    domicilio = (
+        Series(_pick(rng, CALLES, n_base))
+        + " No. " + Series(rng.integers(1, 3000, n_base)).astype(str)
+        + " COLONIA: " + Series(_pick(rng, COLONIAS, n_base))
+        + " C.P. " + cp
+    )
+    with_phone = rng.random(n_base) < 0.3
+    domicilio[with_phone] += " TEL " + telefono[with_phone]
+
+    data = DataFrame({
+        'FECHREG': _dates(rng, n_base, "2020-03-01", 600),
+        'FECINISI': _dates(rng, n_base, "2020-02-20", 600),
+        'APEPATER': apepater,
+        'APEMATER': apemater,
+        'NOMBRE': nombre,
+        'SEXO': sexo,
+        'FECNACI': _days("1930-01-01", 90 * 365)[born],
+        'EDAD': ((_TODAY - born) // 365).astype(float),
+        'CURP': curp,
+        'DOMICILIO': domicilio,
+        'CP': cp.astype(float),
+        'TELEFONO': telefono,
+        'ENTNACI': entnaci,
+        'ENTRESI': _pick(rng, ESTADOS, n_base),
+        'MPIORESI': Series(rng.integers(1, 125, n_base)).astype(str),
+        'ESINDIGE': _pick(rng, SI_NO, n_base),
+        'HABLEIND': _pick(rng, SI_NO, n_base),
+        'OCUPACIO': _pick(rng, OCUPACIONES, n_base),
+        'FECDEF': None,
+        'CLASCOVID19': _pick(rng, CLASIFICACIONES, n_base),
+        'RESDEFIN': _pick(rng, ['NEGATIVO', 'SARS-CoV-2', 'NO ADECUADO'],
+                          n_base),
+    })
+    dead = rng.random(n_base) < 0.05
+    data.loc[dead, 'FECDEF'] = _dates(rng, int(dead.sum()), "2020-04-01",
+                                      600)
+    for col in ['APEMATER', 'CURP', 'TELEFONO', 'CP']:
+        data.loc[rng.random(n_base) < missing_rate, col] = None
+
+    # Duplicates repeat a base record with typos and another FECHREG
+    source = rng.integers(0, n_base, n_dups)
+    dups = data.iloc[source].reset_index(drop=True)
+    for col in TYPO_COLS:
+        rows = np.flatnonzero(rng.random(n_dups) < typo_rate)
+        dups.loc[rows, col] = [typo(value, rng) for value in dups[col][rows]]
+    dups['FECHREG'] = _dates(rng, n_dups, "2020-03-01", 600)
+
+    data = concat([data, dups], ignore_index=True)
+    duplicate_of = np.concatenate([np.full(n_base, -1), source])
+
+    # Shuffle, pointing DUPLICATE_OF to the new rows of the base records
+    order = rng.permutation(n_rows)
+    position = np.argsort(order)
+    data = data.iloc[order].reset_index(drop=True)
+    duplicate_of = duplicate_of[order]
+    data['DUPLICATE_OF'] = np.where(
+        duplicate_of < 0, -1, position[np.maximum(duplicate_of, 0)]
+    )
+    return data
+
+
+def write_csv(path: str,
+              n_rows: int,
+              chunk_rows: int = 1000000,
+              seed=0,
+              **kwargs) -> None:
+    """
+    Write n_rows generated rows to a latin-1 CSV like the SISVER extracts,
+    chunk_rows at a time so any size fits in memory. Duplicates only
+    repeat records of their own chunk. kwargs are passed to generate
+    """
+    for i, start in enumerate(range(0, n_rows, chunk_rows)):
+        data = generate(min(chunk_rows, n_rows - start),
+                        seed=[seed, i],
+                        **kwargs)
+        dup = data['DUPLICATE_OF'] >= 0
+        data.loc[dup, 'DUPLICATE_OF'] += start
+        data.to_csv(
+            path,
+            mode="w" if i == 0 else "a",
+            header=i == 0,
+            index=False,
+            encoding="latin-1",
+        )
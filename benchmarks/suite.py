@@ -0,0 +1,424 @@
+import gc
+import json
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+from functools import partial
+from os.path import join
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable
+
+import numpy as np
+import pandas as pd
+from pandas.testing import assert_frame_equal
+
+from bitparallel import edit_similarity_batch
+from blocking import block_pairs
+from features import (
+    METRICS,
+    compare_fields,
+)
+from jaccard import jaccard_batch
+from LCS import (
+    longest_common_subsequence_batch,
+    longest_common_substring_batch,
+)
+from lsh import lsh_index
+from Modules import tweak
+from Modules.dataset import Dataset
+from phonetic import (
+    PhoneticCache,
+    combined_key,
+)
+from simcache import SimilarityCache
+from SmithWaterman import smith_waterman_batch
+from .generator import (
+    generate,
+    write_csv,
+)
+
+# Bump when the results change in a way older results cannot be compared
+RESULTS_VERSION = 1
+
+SIZES = [10000, 1000000, 10000000]
+GROUPS = ["dataset", "tweak", "similarity", "blocking"]
+
+# The notebook's blocking passes, on the generated columns
+BLOCKS = [
+    ["name", "FECNACI"],
+    ["id_soundex"],
+    ["name", "FECNACI", "SEXO"],
+    ["FECNACI", "MPIORESI", "ESINDIGE", "OCUPACIO", "HABLEIND"],
+]
+
+
+def measure(func: Callable,
+            rows: int = 0,
+            pairs: int = 0,
+            repeat: int = 1,
+            memory: bool = True) -> dict:
+    """
+    Best wall time of repeat calls of func, with the rows and pairs it
+    processes per second. With memory, func is run once more under
+    tracemalloc for the peak of the memory allocated by Python and NumPy,
+    so the timed runs are not slowed down by the tracing
+    """
+    seconds = []
+    for _ in range(repeat):
+        gc.collect()
+        start = perf_counter()
+        func()
+        seconds.append(perf_counter() - start)
+    result = {
+        "rows": rows,
+        "pairs": pairs,
+        "seconds": min(seconds),
+        "rows_per_sec": rows / min(seconds) if rows else None,
+        "pairs_per_sec": pairs / min(seconds) if pairs else None,
+        "peak_bytes": None,
+    }
+    if memory:
+        gc.collect()
+        tracemalloc.start()
+        try:
+            func()
+            result["peak_bytes"] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _dataset_benchmarks(n_rows: int,
+                        folder: str) -> dict:
+    """
+    Dataset ingest of a generated CSV, read at once and in chunks
+    """
+    write_csv(join(folder, "sisver.csv"), n_rows)
+    params = {
+        "path_data": folder,
+        "dataset": "sisver.csv",
+        "engine": "c",
+        "chunksize": None,
+        "cache": False,
+    }
+    dataset = Dataset(params)
+    check_handoff(dataset)
+    benchmarks = {
+        "dataset.read": (partial(Dataset, params), n_rows, 0),
+        "dataset.read_chunks": (
+            partial(Dataset, dict(params, chunksize=min(n_rows, 1000000))),
+            n_rows,
+            0,
+        ),
+        "dataset.get_data": (dataset.get_data, n_rows, 0),
+        "dataset.get_data_view": (
+            partial(dataset.get_data, copy=False),
+            n_rows,
+            0,
+        ),
+    }
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return benchmarks
+    check_engines(params)
+    benchmarks["dataset.read_pyarrow"] = (
+        partial(Dataset, dict(params, engine="pyarrow")),
+        n_rows,
+        0,
+    )
+    return benchmarks
+
+
+def check_handoff(dataset: Dataset) -> None:
+    """
+    Raise AssertionError when get_data(copy=False) allocates more than a
+    tenth of the peak memory of get_data(), i.e. when the handoff
+    copies the columns
+    """
+    copy = measure(dataset.get_data)["peak_bytes"]
+    view = measure(partial(dataset.get_data, copy=False))["peak_bytes"]
+    assert view * 10 < copy, (
+        f"get_data(copy=False) peaked at {view:,} bytes, "
+        f"get_data() at {copy:,}."
+    )
+
+
+def check_cache_stats(s1: np.ndarray,
+                      s2: np.ndarray) -> None:
+    """
+    Raise AssertionError when a kernel wrapped by SimilarityCache does not
+    give the scores and the stats["pruned"] count of the kernel itself,
+    both when scoring and when reading the cache
+    """
+    options = {"min_score": 0.5, "norm": "mean"}
+    expected = {}
+    scores = smith_waterman_batch(s1, s2, stats=expected, **options)
+    wrapped = SimilarityCache().wrap(smith_waterman_batch)
+    for _ in range(2):
+        stats = {}
+        np.testing.assert_array_equal(
+            wrapped(s1, s2, stats=stats, **options),
+            scores,
+        )
+        assert stats == expected, (
+            f"The cached kernel counted {stats}, the kernel {expected}."
+        )
+
+
+def check_engines(params: dict) -> None:
+    """
+    Raise AssertionError when the c and pyarrow engines read the dataset
+    of params into different frames
+    """
+    assert_frame_equal(
+        Dataset(dict(params, engine="c")).data,
+        Dataset(dict(params, engine="pyarrow")).data,
+    )
+
+
+def _tweak_benchmarks(data: pd.DataFrame) -> dict:
+    """
+    Every Tweak step on the categorical columns Dataset hands over, and
+    the whole of Tweak
+    """
+    domicilio = data["DOMICILIO"].astype("category")
+    parts = tweak.parse_domicilio(domicilio)
+    n_rows = len(data)
+    steps = {
+        "tweak.parse_domicilio": partial(tweak.parse_domicilio, domicilio),
+        "tweak.strip_stopwords": partial(
+            tweak.strip_stopwords,
+            parts["street"].astype(str),
+        ),
+    }
+    for name, func, col in [
+        ("clean_address", tweak.clean_address, "street"),
+        ("clean_calle", tweak.clean_calle, "calle"),
+        ("clean_num", tweak.clean_num, "num"),
+        ("clean_cp", tweak.clean_cp, "cp"),
+        ("clean_colonia", tweak.clean_colonia, "colonia"),
+    ]:
+        steps[f"tweak.{name}"] = partial(func, parts[col])
+    steps["tweak.Tweak"] = partial(_tweak, data)
+    return {
+        name: (func, n_rows, 0)
+        for name, func in steps.items()
+    }
+
+
+def _tweak(data: pd.DataFrame) -> pd.DataFrame:
+    return tweak.Tweak(data.copy()).get_data(copy=False)
+
+
+def _with_keys(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    The notebook's name and id_soundex columns
+    """
+    data = data.copy()
+    data["name"] = (
+        data["NOMBRE"] + " " + data["APEPATER"] + " "
+        + data["APEMATER"].fillna("")
+    )
+    phonetic = PhoneticCache()
+    for col in ["NOMBRE", "APEPATER", "APEMATER"]:
+        data[col + "_soundex"] = phonetic.encode(data[col], "soundex")
+    data["id_soundex"] = combined_key(
+        data,
+        ["NOMBRE_soundex", "APEPATER_soundex", "APEMATER_soundex"],
+    )
+    return data
+
+
+def _similarity_benchmarks(data: pd.DataFrame,
+                           max_pairs: int,
+                           seed: int) -> dict:
+    """
+    Every similarity kernel on up to max_pairs blocked pairs of names
+    """
+    left, right = block_pairs(data, BLOCKS, max_block=1000)
+    if len(left) > max_pairs:
+        keep = np.random.default_rng(seed).choice(
+            len(left), max_pairs, replace=False,
+        )
+        left, right = left[keep], right[keep]
+    n_pairs = len(left)
+    names = data["name"].to_numpy(dtype=object)
+    s1, s2 = names[left], names[right]
+    check_cache_stats(s1, s2)
+    kernels = {
+        "similarity.jaccard": partial(jaccard_batch, s1, s2),
+        "similarity.lcs": partial(longest_common_substring_batch, s1, s2),
+        "similarity.lcs_subsequence": partial(
+            longest_common_subsequence_batch, s1, s2,
+        ),
+        "similarity.smith_waterman": partial(smith_waterman_batch, s1, s2),
+        "similarity.levenshtein": partial(edit_similarity_batch, s1, s2),
+        "similarity.osa": partial(
+            edit_similarity_batch, s1, s2, transpositions=True,
+        ),
+    }
+    frame = data[["name"]].reset_index(drop=True)
+    pairs = pd.MultiIndex.from_arrays([left, right])
+    for metric in METRICS:
+        kernels[f"similarity.compare_fields.{metric}"] = partial(
+            compare_fields, frame, pairs, ["name"], metrics=[metric],
+        )
+    kernels["similarity.compare_fields"] = partial(
+        compare_fields, frame, pairs, ["name"],
+    )
+    return {
+        name: (func, 0, n_pairs)
+        for name, func in kernels.items()
+    }
+
+
+def _blocking_benchmarks(data: pd.DataFrame,
+                         keyed: pd.DataFrame,
+                         max_lsh: int) -> dict:
+    """
+    Phonetic keys, multi-key blocking and LSH on up to max_lsh records
+    """
+    n_rows = len(data)
+    n_pairs = len(block_pairs(keyed, BLOCKS, max_block=1000)[0])
+    sample = keyed.iloc[:max_lsh]
+    return {
+        "blocking.phonetic": (partial(_with_keys, data), n_rows, 0),
+        "blocking.block_pairs": (
+            partial(block_pairs, keyed, BLOCKS, max_block=1000),
+            n_rows,
+            n_pairs,
+        ),
+        "blocking.lsh": (
+            partial(lsh_index, sample, "name"),
+            len(sample),
+            0,
+        ),
+    }
+
+
+def run(sizes: list = None,
+        groups: list = None,
+        max_pairs: int = 1000000,
+        max_lsh: int = 1000000,
+        repeat: int = 1,
+        memory: bool = True,
+        seed: int = 0,
+        log: Callable = print) -> dict:
+    """
+    Run the benchmarks of groups (all of GROUPS by default) on generated
+    extracts of every size in sizes (SIZES by default)
+    """
+    sizes = sizes or SIZES
+    groups = groups or GROUPS
+    results = []
+    for n_rows in sizes:
+        data = generate(n_rows, seed=seed).drop(columns="DUPLICATE_OF")
+        keyed = _with_keys(data)
+        with TemporaryDirectory() as folder:
+            benchmarks = {}
+            if "dataset" in groups:
+                benchmarks.update(_dataset_benchmarks(n_rows, folder))
+            if "tweak" in groups:
+                benchmarks.update(_tweak_benchmarks(data))
+            if "similarity" in groups:
+                benchmarks.update(
+                    _similarity_benchmarks(keyed, max_pairs, seed)
+                )
+            if "blocking" in groups:
+                benchmarks.update(
+                    _blocking_benchmarks(data, keyed, max_lsh)
+                )
+            for name, (func, rows, pairs) in benchmarks.items():
+                result = dict(
+                    {"name": name, "size": n_rows},
+                    **measure(func, rows, pairs, repeat, memory),
+                )
+                log(_format(result))
+                results.append(result)
+    return {
+        "version": RESULTS_VERSION,
+        "meta": _meta(seed),
+        "results": results,
+    }
+
+
+def _meta(seed: int) -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "seed": seed,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def _format(result: dict) -> str:
+    rate = [
+        f"{result[key]:,.0f} {key.split('_')[0]}/s"
+        for key in ["rows_per_sec", "pairs_per_sec"]
+        if result[key]
+    ]
+    peak = result["peak_bytes"]
+    return " ".join([
+        f"{result['name']:<40} {result['size']:>10,}",
+        f"{result['seconds']:9.3f}s",
+        *rate,
+        f"peak {peak / 2 ** 20:,.1f} MiB" if peak is not None else "",
+    ])
+
+
+def save(results: dict,
+         path: str) -> None:
+    with open(path, "w") as file:
+        json.dump(results, file, indent=1)
+
+
+def load(path: str) -> dict:
+    with open(path) as file:
+        return json.load(file)
+
+
+def compare(baseline: dict,
+            results: dict,
+            tolerance: float = 0.2) -> list:
+    """
+    Benchmarks of results slower than in baseline, or using more memory,
+    by more than tolerance, as (name, size, measure, before, after)
+    """
+    if baseline.get("version") != results.get("version"):
+        raise ValueError("The results have different versions.")
+    before = {
+        (result["name"], result["size"]): result
+        for result in baseline["results"]
+    }
+    regressions = []
+    for result in results["results"]:
+        old = before.get((result["name"], result["size"]))
+        if old is None:
+            continue
+        for key in ["seconds", "peak_bytes"]:
+            if old[key] and result[key] \
+                    and result[key] > old[key] * (1 + tolerance):
+                regressions.append((
+                    result["name"],
+                    result["size"],
+                    key,
+                    old[key],
+                    result[key],
+                ))
+    return regressions
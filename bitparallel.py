@@ -0,0 +1,329 @@
+import numpy as np
+
+from Modules.instrument import (
+    batch_pairs,
+    timed,
+)
+from strbatch import (
+    StringColumn,
+    length_groups,
+)
+
+# Bits of the state words: the shorter string of a pair is encoded one
+# character per bit, so pairs whose strings are both longer go through the
+# dynamic programming fallback
+WORD = 64
+
+_ONE = np.uint64(1)
+_M1 = np.uint64(0x5555555555555555)
+_M2 = np.uint64(0x3333333333333333)
+_M4 = np.uint64(0x0F0F0F0F0F0F0F0F)
+_H01 = np.uint64(0x0101010101010101)
+
+
+def _popcount(x):
+    """
+    _popcount(x)
+    Number of set bits of every uint64 of x.
+    """
+    x = x - ((x >> _ONE) & _M1)
+    x = (x & _M2) + ((x >> np.uint64(2)) & _M2)
+    x = (x + (x >> np.uint64(4))) & _M4
+    return ((x * _H01) >> np.uint64(56)).astype(np.int64)
+
+
+def _low_bits(n):
+    """
+    _low_bits(n)
+    uint64 masks of the n[i] lowest bits, n[i] <= WORD.
+    """
+    n = np.asarray(n, dtype=np.uint64)
+    shifted = (_ONE << np.minimum(n, np.uint64(WORD - 1))) - _ONE
+    return np.where(n >= WORD, ~np.uint64(0), shifted)
+
+
+def _oriented(a, b, positions, len1, len2):
+    """
+    _oriented(a, b, positions, len1, len2)
+    The pairs at positions as a pattern matrix, holding the shorter string
+    of every pair, and a text matrix holding the other one, both with
+    characters renumbered 0..n_symbols - 1.
+    Returns
+    -------
+    tuple
+        (P, T, len_p, len_t, n_symbols).
+    """
+    l1 = len1[positions]
+    l2 = len2[positions]
+    width = max(l1.max(), l2.max())
+    A = a.padded(positions, width)
+    B = b.padded(positions, width)
+    swap = (l1 > l2)[:, None]
+    len_p = np.minimum(l1, l2)
+    len_t = np.maximum(l1, l2)
+    P = np.where(swap, B, A)[:, :max(len_p.max(), 1)]
+    T = np.where(swap, A, B)[:, :max(len_t.max(), 1)]
+    if P.dtype == np.uint8:
+        return P.astype(np.intp), T.astype(np.intp), len_p, len_t, 0x100
+    symbols, ids = np.unique(np.concatenate((P.ravel(), T.ravel())),
+                             return_inverse=True)
+    ids = ids.ravel()
+    return (ids[:P.size].reshape(P.shape), ids[P.size:].reshape(T.shape),
+            len_p, len_t, len(symbols))
+
+
+def _match_masks(P, len_p, n_symbols):
+    """
+    _match_masks(P, len_p, n_symbols)
+    (n, n_symbols) uint64 table whose bit x of row i, symbol c is set when
+    P[i, x] is c, for the x below len_p[i].
+    """
+    n = len(P)
+    rows = np.arange(n)
+    masks = np.zeros((n, n_symbols), dtype=np.uint64)
+    for x in range(P.shape[1]):
+        bit = np.where(x < len_p, _ONE << np.uint64(x), np.uint64(0))
+        masks[rows, P[:, x]] |= bit
+    return masks
+
+
+def _subsequence(P, T, len_p, len_t, n_symbols):
+    """
+    _subsequence(P, T, len_p, len_t, n_symbols)
+    Longest common subsequence length of every row pair, with the
+    bit-vector recurrence of Allison and Dix as given by Hyyro (2004):
+    V = (V + U) | (V - U) with U = V & match mask of the text character,
+    the length being the number of 0 bits of V.
+    """
+    n = len(P)
+    rows = np.arange(n)
+    masks = _match_masks(P, len_p, n_symbols)
+    v = np.full(n, ~np.uint64(0))
+    # Every text is active up to the shortest one
+    shortest = len_t.min()
+    for y in range(T.shape[1]):
+        u = v & masks[rows, T[:, y]]
+        step = (v + u) | (v - u)
+        v = step if y < shortest else np.where(y < len_t, step, v)
+    return _popcount(~v & _low_bits(len_p))
+
+
+def _edit(P, T, len_p, len_t, n_symbols, transpositions=False):
+    """
+    _edit(P, T, len_p, len_t, n_symbols, transpositions=False)
+    Levenshtein distance of every row pair with the bit-parallel algorithm
+    of Myers (1999) in the formulation of Hyyro (2003), or the optimal
+    string alignment distance with transpositions. The vertical deltas of
+    a text column are kept as positive (vp) and negative (vn) bit vectors
+    and the distance is tracked at the last pattern row.
+    """
+    n = len(P)
+    rows = np.arange(n)
+    masks = _match_masks(P, len_p, n_symbols)
+    high = _ONE << (np.maximum(len_p, 1).astype(np.uint64) - _ONE)
+    vp = _low_bits(len_p)
+    vn = np.zeros(n, dtype=np.uint64)
+    d0 = np.zeros(n, dtype=np.uint64)
+    previous = np.zeros(n, dtype=np.uint64)
+    distance = len_p.astype(np.int64)
+    shortest = len_t.min()
+    for y in range(T.shape[1]):
+        active = y < len_t
+        pm = masks[rows, T[:, y]]
+        diagonal = (((pm & vp) + vp) ^ vp) | pm | vn
+        if transpositions:
+            diagonal |= ((~d0 & pm) << _ONE) & previous
+            previous = pm
+        hp = vn | ~(diagonal | vp)
+        hn = diagonal & vp
+        distance += active & ((hp & high) != 0)
+        distance -= active & ((hn & high) != 0)
+        hp = (hp << _ONE) | _ONE
+        hn = hn << _ONE
+        if y < shortest:
+            vp = hn | ~(diagonal | hp)
+            vn = hp & diagonal
+        else:
+            vp = np.where(active, hn | ~(diagonal | hp), vp)
+            vn = np.where(active, hp & diagonal, vn)
+        d0 = diagonal
+    return distance
+
+
+def _edit_dp(A, B, len1, len2, transpositions=False):
+    """
+    _edit_dp(A, B, len1, len2, transpositions=False)
+    The fallback of _edit for pairs of strings longer than WORD: the
+    dynamic program one row at a time for the whole batch. Within a row,
+    d[y] = min(t[y], d[y - 1] + 1) is y + the running minimum of t[k] - k,
+    so each row is a single accumulate.
+    """
+    n, L1 = A.shape
+    L2 = B.shape[1]
+    cols = np.arange(L2 + 1)
+    prev = np.broadcast_to(cols, (n, L2 + 1)).astype(np.int64)
+    before = prev
+    result = np.where(len1 == 0, len2, 0).astype(np.int64)
+    for x in range(1, L1 + 1):
+        cost = (A[:, x - 1:x] != B).astype(np.int64)
+        row = np.empty_like(prev)
+        row[:, 0] = x
+        row[:, 1:] = np.minimum(prev[:, :-1] + cost, prev[:, 1:] + 1)
+        if transpositions and x > 1:
+            swapped = ((A[:, x - 1:x] == B[:, :-1])
+                       & (A[:, x - 2:x - 1] == B[:, 1:]))
+            row[:, 2:] = np.where(swapped,
+                                  np.minimum(row[:, 2:], before[:, :-2] + 1),
+                                  row[:, 2:])
+        row = cols + np.minimum.accumulate(row - cols, axis=1)
+        done = x == len1
+        result[done] = row[done, len2[done]]
+        before, prev = prev, row
+    return result
+
+
+def subsequence_lengths(a, b, positions, len1, len2):
+    """
+    subsequence_lengths(a, b, positions, len1, len2)
+    Longest common subsequence length of the pairs at positions of two
+    aligned columns, all of them with a non empty shorter string of at
+    most WORD characters, e.g. one length_groups group.
+    Parameters
+    ----------
+    a, b : strbatch.StringColumn
+        Left and right strings.
+    positions : numpy.ndarray
+        Positions of the pairs.
+    len1, len2 : numpy.ndarray
+        Lengths of all the strings of a and b.
+    Returns
+    -------
+    numpy.ndarray
+        int64 lengths, one per position.
+    """
+    return _subsequence(*_oriented(a, b, positions, len1, len2))
+
+
+def edit_distances(a, b, positions, len1, len2, transpositions=False):
+    """
+    edit_distances(a, b, positions, len1, len2, transpositions=False)
+    Levenshtein, or optimal string alignment, distance of the pairs at
+    positions of two aligned columns. Pairs whose shorter string exceeds
+    WORD characters use the dynamic programming fallback, which gives the
+    same distances in O(len1 * len2) per pair.
+    Parameters
+    ----------
+    a, b : strbatch.StringColumn
+        Left and right strings.
+    positions : numpy.ndarray
+        Positions of the pairs.
+    len1, len2 : numpy.ndarray
+        Lengths of all the strings of a and b.
+    transpositions : bool
+        Count the swap of two adjacent characters as one edit, as long as
+        neither of them is edited again. Default: False.
+    Returns
+    -------
+    numpy.ndarray
+        int64 distances, one per position.
+    """
+    distances = np.zeros(len(positions), dtype=np.int64)
+    shorter = np.minimum(len1[positions], len2[positions])
+    short = np.flatnonzero(shorter <= WORD)
+    long = np.flatnonzero(shorter > WORD)
+    if len(short):
+        P, T, len_p, len_t, n_symbols = _oriented(a, b, positions[short],
+                                                  len1, len2)
+        distances[short] = np.where(
+            len_p == 0,
+            len_t,
+            _edit(P, T, len_p, len_t, n_symbols, transpositions),
+        )
+    if len(long):
+        idx = positions[long]
+        distances[long] = _edit_dp(a.padded(idx, len1[idx].max()),
+                                   b.padded(idx, len2[idx].max()),
+                                   len1[idx],
+                                   len2[idx],
+                                   transpositions)
+    return distances
+
+
+@timed(pairs=batch_pairs)
+def edit_distance_batch(s1,
+                        s2,
+                        transpositions=False,
+                        bucket=8,
+                        batch_size=4096):
+    """
+    edit_distance_batch(s1, s2, transpositions=False, bucket=8,
+                        batch_size=4096)
+    Levenshtein distance of two aligned string arrays, or the optimal
+    string alignment (restricted Damerau-Levenshtein) distance with
+    transpositions, with 64-bit bit-parallel kernels: the shorter string
+    of every pair is one bit per character and each character of the
+    other one costs a few word operations for a whole batch of pairs.
+    Parameters
+    ----------
+    s1 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Left strings.
+    s2 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Right strings, aligned by position with s1.
+    transpositions : bool
+        Count adjacent transpositions as one edit. Default: False.
+    bucket : int
+        Width of the string length buckets used to group pairs. Default: 8.
+    batch_size : int
+        Maximum number of pairs scored together. Default: 4096.
+    Returns
+    -------
+    numpy.ndarray
+        A float array of distances, NaN for missing values.
+    """
+
+    a = StringColumn.from_values(s1)
+    b = StringColumn.from_values(s2)
+
+    if len(a) != len(b):
+        raise ValueError('Arrays or Series have to be same length.')
+
+    null = a.null | b.null
+    len1 = np.where(null, 0, a.lengths)
+    len2 = np.where(null, 0, b.lengths)
+
+    distances = np.zeros(len(a))
+    todo = np.flatnonzero(~null)
+    for group in length_groups(len1[todo], len2[todo], bucket, batch_size):
+        idx = todo[group]
+        distances[idx] = edit_distances(a, b, idx, len1, len2,
+                                        transpositions)
+    distances[null] = np.nan
+    return distances
+
+
+def edit_similarity_batch(s1,
+                          s2,
+                          transpositions=False,
+                          bucket=8,
+                          batch_size=4096):
+    """
+    edit_similarity_batch(s1, s2, transpositions=False, bucket=8,
+                          batch_size=4096)
+    1 - edit_distance_batch / longer string length, recordlinkage's
+    normalization of the Levenshtein distance (lsim).
+    Parameters
+    ----------
+    s1, s2, transpositions, bucket, batch_size :
+        See edit_distance_batch.
+    Returns
+    -------
+    numpy.ndarray
+        A float array of similarities, NaN for missing values and for
+        pairs of empty strings.
+    """
+    a = StringColumn.from_values(s1)
+    b = StringColumn.from_values(s2)
+    distances = edit_distance_batch(a, b, transpositions, bucket, batch_size)
+    longest = np.maximum(a.lengths, b.lengths)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1 - distances / longest
@@ -0,0 +1,226 @@
+import pandas as pd
+import numpy as np
+
+from Modules.instrument import timed
+
+_EMPTY = np.array([], dtype=np.int64)
+
+
+def block_codes(df, on):
+    """
+    block_codes(df, on)
+    Block of every record for one key spec, by hash-grouping the key
+    columns.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    on : str or list of str
+        Column(s) whose values must all be equal within a block.
+    Returns
+    -------
+    numpy.ndarray
+        int64 block code of every record, -1 for records with a missing
+        key value, which are in no block, as in recordlinkage Block.
+    """
+    on = [on] if isinstance(on, str) else list(on)
+    codes = df.groupby(on, sort=False, dropna=True, observed=True).ngroup()
+    return codes.fillna(-1).to_numpy(dtype=np.int64)
+
+
+def group_pairs(codes, max_block=1000):
+    """
+    group_pairs(codes, max_block=1000)
+    All pairs of records with the same group code, for groups of at most
+    max_block records.
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        Group of every record, -1 for records in no group, e.g. from
+        block_codes.
+    max_block : int
+        Largest group expanded into pairs. Default: 1000.
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Positions (left, right) of the pairs, left < right.
+    """
+    members, _, starts, sizes = _sorted_blocks(codes)
+    small = (sizes > 1) & (sizes <= max_block)
+    left, right = _within_pairs(members, starts[small], sizes[small])
+    return members[left], members[right]
+
+
+def _sorted_blocks(codes):
+    """
+    _sorted_blocks(codes)
+    Positions of the records in a group sorted by group, their group
+    codes, and the start and size of every group in them.
+    """
+    members = np.flatnonzero(codes >= 0)
+    members = members[np.argsort(codes[members], kind='stable')]
+    blocks = codes[members]
+    starts = np.flatnonzero(np.r_[True, blocks[1:] != blocks[:-1]])
+    sizes = np.diff(np.r_[starts, len(blocks)])
+    return members, blocks, starts, sizes
+
+
+def _within_pairs(members, starts, sizes):
+    """
+    _within_pairs(members, starts, sizes)
+    All pairs of members of the same block, as positions into members,
+    for blocks members[starts:starts + sizes].
+    """
+    if not len(sizes):
+        return _EMPTY, _EMPTY
+    # Rank of every member in its block, and the number of members after it
+    offsets = np.repeat(starts, sizes)
+    ranks = np.arange(len(offsets)) - np.repeat(np.cumsum(sizes) - sizes,
+                                                sizes)
+    after = np.repeat(sizes, sizes) - 1 - ranks
+    left = np.repeat(offsets + ranks, after)
+    ends = np.cumsum(after)
+    right = np.arange(len(left)) - np.repeat(ends - after, after)
+    right += np.repeat(offsets + ranks + 1, after)
+    return left, right
+
+
+def _window_pairs(members, blocks, window):
+    """
+    _window_pairs(members, blocks, window)
+    Sorted-neighbourhood pairs of already sorted members: every member
+    with the next window - 1 members of the same block.
+    """
+    left = [_EMPTY]
+    right = [_EMPTY]
+    for k in range(1, window):
+        same = np.flatnonzero(blocks[k:] == blocks[:-k])
+        left.append(members[same])
+        right.append(members[same + k])
+    return np.concatenate(left), np.concatenate(right)
+
+
+@timed(rows=lambda df, *args, **kwargs: len(df))
+def block_pairs(df,
+                keys,
+                max_block=1000,
+                window=None,
+                sort_on=None,
+                stats=None):
+    """
+    block_pairs(df, keys, max_block=1000, window=None, sort_on=None,
+                stats=None)
+    Candidate pairs of several blocking passes, e.g. the notebook's
+    [['name', 'fecnaci'], ['id_soundex'], ['name', 'fecnaci', 'sexo'],
+    ['fecnaci', 'mpioresi', 'esindige', 'ocupacio', 'hableind']], as
+    positions instead of unions of recordlinkage MultiIndexes.
+    Each pass hash-groups the records by their key codes and expands its
+    blocks into pairs with a single vectorized pass. The pairs of all the
+    passes are encoded as one int64 each and deduplicated with one sort.
+    Blocks with more than max_block records would give max_block ** 2 / 2
+    pairs: they are skipped, or with a window, replaced by a sorted
+    neighbourhood of the block's records ordered by sort_on.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    keys : list
+        Key specs, each a column name or a list of column names.
+    max_block : int
+        Largest block expanded into all its pairs. Default: 1000.
+    window : int
+        Window of the sorted neighbourhood used for the larger blocks.
+        Default: None, larger blocks are skipped.
+    sort_on : str or list of str
+        Column(s) ordering the records of the larger blocks. Default: the
+        order of df.
+    stats : dict
+        When given, filled with one dict per key spec, under the joined
+        column names (e.g. 'name+fecnaci'), with the number of 'blocks'
+        of two records or more, of 'oversized' blocks, of 'pairs' before
+        deduplication, the 'largest' block size and 'block_pairs', the
+        number of pairs of each block, indexed by its key values, plus
+        the number of 'unique' pairs of all the passes.
+    Returns
+    -------
+    tuple of numpy.ndarray
+        int32 positions (left, right) of the candidate pairs, left < right,
+        sorted and without duplicates.
+    """
+    n_records = len(df)
+    if n_records >= np.iinfo(np.int32).max:
+        raise ValueError('Too many records for int32 positions.')
+    if window is not None:
+        if sort_on is None:
+            order = np.arange(n_records)
+        else:
+            sort_on = [sort_on] if isinstance(sort_on, str) else sort_on
+            order = df.groupby(list(sort_on), sort=True, dropna=False,
+                               observed=True).ngroup().to_numpy()
+
+    found = [_EMPTY]
+    for on in keys:
+        on = [on] if isinstance(on, str) else list(on)
+        codes = block_codes(df, on)
+        members, blocks, starts, sizes = _sorted_blocks(codes)
+        small = (sizes > 1) & (sizes <= max_block)
+        large = sizes > max_block
+
+        left, right = _within_pairs(members, starts[small], sizes[small])
+        left, right = members[left], members[right]
+        counts = sizes[small] * (sizes[small] - 1) // 2
+        ids = blocks[starts[small]]
+        if window is not None and large.any():
+            inside = np.repeat(large, sizes)
+            wide = members[inside]
+            wide = wide[np.lexsort((order[wide], codes[wide]))]
+            more = _window_pairs(wide, codes[wide], window)
+            left = np.concatenate((left, more[0]))
+            right = np.concatenate((right, more[1]))
+            counts = np.concatenate((counts, np.bincount(
+                np.searchsorted(blocks[starts[large]], codes[more[0]]),
+                minlength=large.sum())))
+            ids = np.concatenate((ids, blocks[starts[large]]))
+        found.append(np.minimum(left, right) * n_records
+                     + np.maximum(left, right))
+
+        if stats is not None:
+            first = members[starts]
+            index = pd.MultiIndex.from_frame(
+                df[on].iloc[first[np.searchsorted(blocks[starts], ids)]])
+            stats['+'.join(on)] = {
+                'blocks': int((sizes > 1).sum()),
+                'oversized': int(large.sum()),
+                'pairs': len(left),
+                'largest': int(sizes.max()) if len(sizes) else 0,
+                'block_pairs': pd.Series(counts, index=index,
+                                         name='pairs'),
+            }
+
+    found = np.unique(np.concatenate(found))
+    if stats is not None:
+        stats['unique'] = len(found)
+    return ((found // n_records).astype(np.int32),
+            (found % n_records).astype(np.int32))
+
+
+def block_index(df, keys, **kwargs):
+    """
+    block_index(df, keys, **kwargs)
+    Candidate pairs of block_pairs as a MultiIndex of df index labels,
+    the union of the recordlinkage Block indexes of the key specs.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    keys : list
+        Key specs, each a column name or a list of column names.
+    **kwargs :
+        See block_pairs.
+    Returns
+    -------
+    pandas.MultiIndex
+        Pairs of df index labels.
+    """
+    left, right = block_pairs(df, keys, **kwargs)
+    return pd.MultiIndex.from_arrays([df.index[left], df.index[right]])
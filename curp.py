@@ -0,0 +1,338 @@
+import re
+import unicodedata
+
+import pandas as pd
+import numpy as np
+
+from blocking import group_pairs
+from Modules.instrument import timed
+
+# Birth state codes of the CURP, in the order of their INEGI numbers
+# (AS is 1, ZS is 32). NE is born abroad.
+STATES = {
+    'AS': 'AGUASCALIENTES',
+    'BC': 'BAJA CALIFORNIA',
+    'BS': 'BAJA CALIFORNIA SUR',
+    'CC': 'CAMPECHE',
+    'CL': 'COAHUILA',
+    'CM': 'COLIMA',
+    'CS': 'CHIAPAS',
+    'CH': 'CHIHUAHUA',
+    'DF': 'CIUDAD DE MEXICO',
+    'DG': 'DURANGO',
+    'GT': 'GUANAJUATO',
+    'GR': 'GUERRERO',
+    'HG': 'HIDALGO',
+    'JC': 'JALISCO',
+    'MC': 'MEXICO',
+    'MN': 'MICHOACAN',
+    'MS': 'MORELOS',
+    'NT': 'NAYARIT',
+    'NL': 'NUEVO LEON',
+    'OC': 'OAXACA',
+    'PL': 'PUEBLA',
+    'QT': 'QUERETARO',
+    'QR': 'QUINTANA ROO',
+    'SP': 'SAN LUIS POTOSI',
+    'SL': 'SINALOA',
+    'SR': 'SONORA',
+    'TC': 'TABASCO',
+    'TS': 'TAMAULIPAS',
+    'TL': 'TLAXCALA',
+    'VZ': 'VERACRUZ',
+    'YN': 'YUCATAN',
+    'ZS': 'ZACATECAS',
+    'NE': 'NACIDO EN EL EXTRANJERO',
+}
+
+_CURP = re.compile(
+    r'^(?P<initials>[A-Z][AEIOUX][A-Z]{2})'
+    r'(?P<year>\d{2})(?P<month>0[1-9]|1[0-2])(?P<day>0[1-9]|[12]\d|3[01])'
+    r'(?P<sex>[HMX])'
+    r'(?P<state>' + '|'.join(STATES) + r')'
+    r'(?P<consonants>[B-DF-HJ-NP-TV-Z]{3})'
+    r'(?P<homoclave>[0-9A-Z])'
+    r'(?P<check>\d)$'
+)
+
+# Values of the characters in the check digit, Ñ between N and O
+_ALPHABET = '0123456789ABCDEFGHIJKLMNÑOPQRSTUVWXYZ'
+_VALUES = np.full(0x100, -1, dtype=np.int64)
+for _value, _char in enumerate(_ALPHABET):
+    _VALUES[ord(_char)] = _value
+_WEIGHTS = np.arange(18, 1, -1)
+
+
+def normalize(values):
+    """
+    normalize(values)
+    CURPs in upper case without surrounding spaces, missing values kept.
+    Parameters
+    ----------
+    values : pandas.Series
+        The CURPs.
+    Returns
+    -------
+    pandas.Series
+        The normalized CURPs, as objects.
+    """
+    return values.astype(object).where(values.notna()).str.strip().str.upper()
+
+
+def check_digit(values):
+    """
+    check_digit(values)
+    Check digit of the first 17 characters of every CURP.
+    Parameters
+    ----------
+    values : numpy.ndarray
+        Normalized CURPs of at least 17 characters.
+    Returns
+    -------
+    numpy.ndarray
+        int64 check digits, -1 where a character is not in the alphabet.
+    """
+    if not len(values):
+        return np.array([], dtype=np.int64)
+    chars = np.array([value[:17] for value in values], dtype='U17')
+    codes = chars.view(np.uint32).reshape(len(values), 17)
+    digits = _VALUES[np.minimum(codes, 0xFF)]
+    total = (digits * _WEIGHTS).sum(axis=1)
+    return np.where((digits < 0).any(axis=1), -1, (10 - total % 10) % 10)
+
+
+def _decode_uniques(values):
+    """
+    _decode_uniques(values)
+    decode of distinct normalized CURPs.
+    """
+    parts = pd.Series(values, dtype=object).str.extract(_CURP)
+    formed = parts['check'].notna().to_numpy()
+    valid = formed.copy()
+    valid[formed] = (check_digit(values[formed])
+                     == parts['check'][formed].astype(int).to_numpy())
+    # The homoclave is a digit for the births before 2000, a letter after
+    century = np.where(parts['homoclave'].str.isdigit(), '19', '20')
+    birth = pd.to_datetime(century + parts['year'] + parts['month']
+                           + parts['day'],
+                           format='%Y%m%d',
+                           errors='coerce')
+    return pd.DataFrame({
+        'valid': valid,
+        'formed': formed,
+        'birth': birth,
+        'sex': parts['sex'],
+        'state': parts['state'],
+    })
+
+
+@timed(rows=lambda values: len(values))
+def decode(values):
+    """
+    decode(values)
+    Validate and decode CURPs, once per distinct value.
+    A CURP is valid when it has the official structure (initials, birth
+    date, sex, birth state, consonants, homoclave) and its check digit
+    matches. The other fields are decoded from any well formed CURP.
+    Parameters
+    ----------
+    values : pandas.Series
+        The CURPs, e.g. Dataset.data['CURP'].
+    Returns
+    -------
+    pandas.DataFrame
+        With the index of values: 'valid' (bool), 'formed' (bool, the
+        structure without the check digit), 'birth' (datetime64,
+        NaT when the date does not exist), 'sex' ('H', 'M' or 'X') and
+        'state' (a key of STATES).
+    """
+    codes, uniques = pd.factorize(normalize(values))
+    decoded = _decode_uniques(np.asarray(uniques, dtype=object))
+    # Missing CURPs take the extra last row
+    decoded = pd.concat([decoded, _decode_uniques(np.array([''], object))],
+                        ignore_index=True)
+    result = decoded.iloc[np.where(codes < 0, len(uniques), codes)]
+    return result.set_axis(values.index)
+
+
+def _plain(values):
+    """
+    _plain(values)
+    Upper case strings without accents.
+    """
+    return values.astype(str).str.upper().map(
+        lambda value: ''.join(
+            c for c in unicodedata.normalize('NFKD', value)
+            if not unicodedata.combining(c)
+        ).strip()
+    )
+
+
+# ENTNACI as a CURP code, an INEGI number or a state name
+_STATE_ALIASES = dict(
+    [(code, code) for code in STATES]
+    + [(str(number), code) for number, code in enumerate(STATES, 1)]
+    + [('%02d' % number, code) for number, code in enumerate(STATES, 1)]
+    + [(name, code) for code, name in STATES.items()]
+)
+_SEX_ALIASES = {
+    'H': 'H', 'HOMBRE': 'H', 'MASCULINO': 'H', '1': 'H',
+    'M': 'M', 'MUJER': 'M', 'FEMENINO': 'M', '2': 'M',
+}
+
+
+def cross_check(df,
+                curp='CURP',
+                fecnaci='FECNACI',
+                sexo='SEXO',
+                entnaci='ENTNACI'):
+    """
+    cross_check(df, curp='CURP', fecnaci='FECNACI', sexo='SEXO',
+                entnaci='ENTNACI')
+    Compare the birth date, sex and birth state encoded in the CURP with
+    the declared ones. Sex and state are recognized as codes, INEGI
+    numbers or names.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    curp, fecnaci, sexo, entnaci : str
+        Columns of df. A column set to None is not checked.
+    Returns
+    -------
+    pandas.DataFrame
+        With the index of df: 'valid' and one boolean column per checked
+        field ('birth', 'sex', 'state'), NA when either side is unknown.
+    """
+    decoded = decode(df[curp])
+    checks = pd.DataFrame({'valid': decoded['valid']}, index=df.index)
+    declared = {}
+    if fecnaci is not None:
+        declared['birth'] = pd.to_datetime(df[fecnaci].astype(object),
+                                           errors='coerce')
+    if sexo is not None:
+        declared['sex'] = _plain(df[sexo]).map(_SEX_ALIASES)
+    if entnaci is not None:
+        declared['state'] = _plain(df[entnaci]).map(_STATE_ALIASES)
+    for field, values in declared.items():
+        known = values.notna() & decoded[field].notna()
+        checks[field] = (values == decoded[field]).astype('boolean')
+        checks.loc[~known, field] = pd.NA
+    return checks
+
+
+def _substitution_codes(chars, position):
+    """
+    _substitution_codes(chars, position)
+    Group of every CURP by its characters other than position, so two
+    CURPs share a group when they differ at most at that position.
+    """
+    others = np.ascontiguousarray(np.delete(chars, position, axis=1))
+    _, codes = np.unique(others.view('V%d' % (4 * others.shape[1])).ravel(),
+                         return_inverse=True)
+    return codes.ravel()
+
+
+@timed(rows=lambda df, *args, **kwargs: len(df))
+def curp_pairs(df,
+               column='CURP',
+               max_block=100,
+               formed_only=True,
+               stats=None):
+    """
+    curp_pairs(df, column='CURP', max_block=100, formed_only=True,
+               stats=None)
+    Record pairs whose CURPs are equal, through a hash index, or differ
+    by one substituted character, through a deletion-neighbourhood index
+    (one index of the CURPs with position i deleted, for every i).
+    Such pairs are settled by the CURP and can skip the costly
+    comparators, see remaining_pairs.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    column : str
+        The CURP column. Default: 'CURP'.
+    max_block : int
+        Largest group of records sharing a key that is expanded into
+        pairs, which skips placeholder CURPs shared by many records.
+        Default: 100.
+    formed_only : bool
+        Only index the CURPs with the official structure (see decode),
+        whatever their check digit, which a typo usually breaks.
+        Otherwise any CURP of 18 characters. Default: True.
+    stats : dict
+        When given, filled with the number of 'exact' and 'one_off'
+        pairs and of 'indexed' records.
+    Returns
+    -------
+    tuple of numpy.ndarray
+        int32 positions (left, right) of the pairs, left < right, sorted
+        and without duplicates, and the int8 number of differing
+        characters (0 or 1).
+    """
+    values = normalize(df[column])
+    if formed_only:
+        indexed = decode(values)['formed'].to_numpy()
+    else:
+        indexed = (values.str.len() == 18).fillna(False).to_numpy(bool)
+    positions = np.flatnonzero(indexed)
+    n_records = len(df)
+
+    codes, uniques = pd.factorize(values.iloc[positions])
+    exact = group_pairs(codes, max_block)
+    found = [positions[exact[0]] * n_records + positions[exact[1]]]
+    n_exact = len(found[0])
+
+    chars = np.array(list(uniques), dtype='U18').view(np.uint32)
+    chars = chars.reshape(len(uniques), 18)
+    for position in range(18):
+        group = _substitution_codes(chars, position)[codes]
+        left, right = group_pairs(group, max_block)
+        # Records with the same CURP are the exact pairs
+        differ = codes[left] != codes[right]
+        found.append(positions[left[differ]] * n_records
+                     + positions[right[differ]])
+    one_off = np.unique(np.concatenate(found[1:]))
+
+    keys = np.concatenate((np.unique(found[0]), one_off))
+    distance = np.r_[np.zeros(n_exact, np.int8),
+                     np.ones(len(one_off), np.int8)]
+    order = np.argsort(keys, kind='stable')
+    keys, distance = keys[order], distance[order]
+    if stats is not None:
+        stats.update({
+            'indexed': len(positions),
+            'exact': n_exact,
+            'one_off': len(one_off),
+        })
+    return ((keys // n_records).astype(np.int32),
+            (keys % n_records).astype(np.int32),
+            distance)
+
+
+def remaining_pairs(left, right, resolved_left, resolved_right):
+    """
+    remaining_pairs(left, right, resolved_left, resolved_right)
+    Mask of the candidate pairs not settled by curp_pairs, the only ones
+    that need the similarity comparators.
+    Parameters
+    ----------
+    left, right : numpy.ndarray
+        Positions of the candidate pairs, left < right, e.g. from
+        blocking.block_pairs.
+    resolved_left, resolved_right : numpy.ndarray
+        Positions of the settled pairs, left < right, e.g. from
+        curp_pairs.
+    Returns
+    -------
+    numpy.ndarray
+        Boolean mask of the candidate pairs to score.
+    """
+    n_records = int(max(np.max(left, initial=0), np.max(right, initial=0),
+                        np.max(resolved_left, initial=0),
+                        np.max(resolved_right, initial=0))) + 1
+    candidates = np.asarray(left, np.int64) * n_records + right
+    resolved = np.asarray(resolved_left, np.int64) * n_records \
+        + resolved_right
+    return ~np.isin(candidates, resolved)
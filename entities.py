@@ -0,0 +1,141 @@
+from time import perf_counter
+
+import pandas as pd
+import numpy as np
+
+from Modules.instrument import timed
+
+
+def connected_components(left, right, n_records):
+    """
+    connected_components(left, right, n_records)
+    Connected components of the graph of records linked by the pairs
+    (left[i], right[i]), with an array-backed union-find: every round
+    hooks the root of each edge's larger side onto the smaller root, then
+    compresses all the paths by pointer jumping, so the work per round is
+    a few NumPy passes over the edges.
+    Parameters
+    ----------
+    left, right : numpy.ndarray
+        Positions of the linked records.
+    n_records : int
+        Number of records, positions range over 0..n_records - 1.
+    Returns
+    -------
+    numpy.ndarray
+        The smallest position of the component of every record.
+    """
+    parent = np.arange(n_records, dtype=np.int64)
+    left = np.asarray(left, dtype=np.int64)
+    right = np.asarray(right, dtype=np.int64)
+    while len(left):
+        root_l = parent[left]
+        root_r = parent[right]
+        linked = root_l != root_r
+        left, right = left[linked], right[linked]
+        root_l, root_r = root_l[linked], root_r[linked]
+        if not len(left):
+            break
+        # Hook the larger roots onto the smaller ones. np.minimum.at keeps
+        # the smallest candidate when a root is hooked by several edges.
+        np.minimum.at(parent,
+                      np.maximum(root_l, root_r),
+                      np.minimum(root_l, root_r))
+        # Path compression: jump until every record points to its root
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return parent
+
+
+@timed(rows=lambda df, *args, **kwargs: len(df))
+def resolve(df,
+            left,
+            right,
+            matched=None,
+            scores=None,
+            threshold=None,
+            column='entity_id',
+            stats=None):
+    """
+    resolve(df, left, right, matched=None, scores=None, threshold=None,
+            column='entity_id', stats=None)
+    Group the records of df into entities, the connected components of
+    their matched pairs, and add the entity of every record to df.
+    The entity id is the index label of the first record of the entity
+    in df, so it does not depend on the order of the pairs and a record
+    without matches is its own entity.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records, e.g. Dataset.data.
+    left, right : numpy.ndarray
+        Positions of the candidate pairs in df, e.g. from
+        blocking.block_pairs or the left and right columns of
+        stream.read_scores.
+    matched : numpy.ndarray
+        Boolean decision of every pair, e.g. a classifier's predict.
+    scores : numpy.ndarray
+        Score of every pair, matched when at least threshold. Used when
+        matched is not given.
+    threshold : float
+        Decision threshold of scores.
+    column : str
+        Name of the added column. Default: 'entity_id'.
+    stats : dict
+        When given, filled with the number of 'records', matched 'edges'
+        and 'entities', the 'cluster_sizes' distribution (number of
+        entities by size) and the 'seconds' taken.
+    Returns
+    -------
+    pandas.DataFrame
+        df, with the column added in place.
+    """
+    start = perf_counter()
+    left = np.asarray(left)
+    right = np.asarray(right)
+    if matched is None:
+        if scores is None or threshold is None:
+            raise ValueError('Give matched, or scores and threshold.')
+        matched = np.asarray(scores) >= threshold
+    matched = np.asarray(matched, dtype=bool)
+    roots = connected_components(left[matched], right[matched], len(df))
+    df[column] = df.index[roots]
+
+    if stats is not None:
+        sizes = np.bincount(roots, minlength=len(df))
+        sizes = sizes[sizes > 0]
+        stats.update({
+            'records': len(df),
+            'edges': int(matched.sum()),
+            'entities': len(sizes),
+            'cluster_sizes': pd.Series(sizes).value_counts().sort_index(),
+            'seconds': perf_counter() - start,
+        })
+    return df
+
+
+def count_entities(df, by, column='entity_id'):
+    """
+    count_entities(df, by, column='entity_id')
+    Number of records and of distinct entities by group, e.g. unique
+    cases by covid status.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Records with the entity column of resolve.
+    by : str or list of str
+        Grouping column(s), e.g. 'covid'.
+    column : str
+        The entity column. Default: 'entity_id'.
+    Returns
+    -------
+    pandas.DataFrame
+        'records' and 'entities' columns indexed by group.
+    """
+    return df.groupby(by, observed=True)[column].agg(
+        records='size',
+        entities='nunique',
+    )
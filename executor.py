@@ -0,0 +1,238 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+
+from jaccard import jaccard_batch
+from LCS import longest_common_substring_batch
+from Modules.instrument import timed
+from SmithWaterman import smith_waterman_batch
+from strbatch import StringColumn
+
+# Comparators by name. Workers look them up by name, so comparators must be
+# registered when their module is imported, not interactively.
+COMPARATORS = {}
+
+
+def register_comparator(name, func=None):
+    """
+    register_comparator(name, func=None)
+    Register a pair comparator under name, directly or as a decorator.
+    A comparator takes two aligned strbatch.StringColumn (plus keyword
+    arguments) and returns one similarity per pair, NaN for missing values.
+    Comparators that need Python strings can call StringColumn.to_numpy.
+    Parameters
+    ----------
+    name : str
+        Name used to refer to the comparator in score_positions.
+    func : callable
+        The comparator. When omitted a decorator is returned.
+    Returns
+    -------
+    callable
+        func, unchanged.
+    """
+    if func is None:
+        return lambda func: register_comparator(name, func)
+    COMPARATORS[name] = func
+    return func
+
+
+register_comparator('jaccard', jaccard_batch)
+register_comparator('lcs', longest_common_substring_batch)
+register_comparator('smith_waterman', smith_waterman_batch)
+
+
+def _factorize(values):
+    """
+    _factorize(values)
+    Codes and distinct values of a string column, with missing values
+    mapped to an extra last value.
+    """
+    codes, uniques = pd.factorize(values)
+    uniques = np.append(np.asarray(uniques, dtype=object), np.nan)
+    return np.where(codes < 0, len(uniques) - 1, codes), uniques
+
+
+def _score_chunk(folder, left, right, comparator, kwargs, lo, hi):
+    """
+    _score_chunk(folder, left, right, comparator, kwargs, lo, hi)
+    Score pairs lo:hi and write them into the shared output array.
+    """
+    pairs = np.load(os.path.join(folder, 'pairs.npy'), mmap_mode='r')
+    out = np.load(os.path.join(folder, 'scores.npy'), mmap_mode='r+')
+    s1 = StringColumn.load(left).take(pairs[0, lo:hi])
+    s2 = StringColumn.load(right).take(pairs[1, lo:hi])
+    out[lo:hi] = COMPARATORS[comparator](s1, s2, **kwargs)
+    out.flush()
+    return hi - lo
+
+
+@timed(pairs=lambda left, right, left_pos, *args, **kwargs: len(left_pos))
+def score_positions(left,
+                    right,
+                    left_pos,
+                    right_pos,
+                    comparator,
+                    workers=None,
+                    chunk_size=20000,
+                    tmpdir=None,
+                    dedupe=True,
+                    **kwargs):
+    """
+    score_positions(left, right, left_pos, right_pos, comparator,
+                    workers=None, chunk_size=20000, tmpdir=None,
+                    dedupe=True, **kwargs)
+    Score the pairs (left[left_pos[i]], right[right_pos[i]]) with a
+    registered comparator on a process pool.
+    The string columns (as strbatch.StringColumn buffers) and the pair
+    positions are written once as memory-mapped files that every worker
+    maps, so only chunk bounds are sent to the workers, and the workers
+    write their scores straight into one shared float32 array.
+    Parameters
+    ----------
+    left, right : pandas.Series, list, numpy.ndarray or StringColumn
+        String columns. right may be the same object as left, e.g. when
+        deduplicating a single table, and is then only shared once.
+    left_pos, right_pos : numpy.ndarray
+        Integer positions of the pairs in left and right.
+    comparator : str
+        Name of a registered comparator, see COMPARATORS.
+    workers : int
+        Number of worker processes. Default: os.cpu_count(). With 1 the
+        pairs are scored in the calling process.
+    chunk_size : int
+        Number of pairs per task. Default: 20000.
+    tmpdir : str
+        Folder for the shared files. Default: /dev/shm when available,
+        else the system temporary folder.
+    dedupe : bool
+        Score each distinct pair of values once and broadcast the scores
+        back to all its pairs. Only the distinct values are shared with
+        the workers. Ignored for StringColumn inputs. Default: True.
+    **kwargs :
+        Passed to the comparator, e.g. norm, min_len or min_score. A stats
+        dict is not filled in by worker processes; count the pruned pairs
+        on the result instead (scores == strbatch.PRUNED).
+    Returns
+    -------
+    numpy.ndarray
+        A float32 array with one score per pair, in the order of the pairs.
+    """
+    if comparator not in COMPARATORS:
+        raise ValueError('Unknown comparator %r.' % comparator)
+    left_pos = np.asarray(left_pos, dtype=np.int64)
+    right_pos = np.asarray(right_pos, dtype=np.int64)
+    if len(left_pos) != len(right_pos):
+        raise ValueError('Arrays or Series have to be same length.')
+    if dedupe and not isinstance(left, StringColumn) \
+            and not isinstance(right, StringColumn):
+        left_codes, left_values = _factorize(left)
+        if right is left:
+            right_codes, right_values = left_codes, left_values
+        else:
+            right_codes, right_values = _factorize(right)
+        n_right = len(right_values)
+        keys, inverse = np.unique(
+            left_codes[left_pos] * n_right + right_codes[right_pos],
+            return_inverse=True)
+        scores = score_positions(left_values,
+                                 right_values,
+                                 keys // n_right,
+                                 keys % n_right,
+                                 comparator,
+                                 workers=workers,
+                                 chunk_size=chunk_size,
+                                 tmpdir=tmpdir,
+                                 dedupe=False,
+                                 **kwargs)
+        return scores[inverse.ravel()]
+
+    workers = workers or os.cpu_count() or 1
+    n_pairs = len(left_pos)
+    if tmpdir is None and os.path.isdir('/dev/shm'):
+        tmpdir = '/dev/shm'
+
+    folder = tempfile.mkdtemp(prefix='scores-', dir=tmpdir)
+    try:
+        left_path = os.path.join(folder, 'left')
+        StringColumn.from_values(left).save(left_path)
+        if right is left:
+            right_path = left_path
+        else:
+            right_path = os.path.join(folder, 'right')
+            StringColumn.from_values(right).save(right_path)
+        np.save(os.path.join(folder, 'pairs.npy'),
+                np.stack([left_pos, right_pos]))
+        np.lib.format.open_memmap(os.path.join(folder, 'scores.npy'),
+                                  mode='w+',
+                                  dtype=np.float32,
+                                  shape=(n_pairs,)).flush()
+
+        bounds = [(lo, min(lo + chunk_size, n_pairs))
+                  for lo in range(0, n_pairs, chunk_size)]
+        args = (folder, left_path, right_path, comparator, kwargs)
+        if workers == 1 or len(bounds) <= 1:
+            for lo, hi in bounds:
+                _score_chunk(*args, lo, hi)
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                tasks = [pool.submit(_score_chunk, *args, lo, hi)
+                         for lo, hi in bounds]
+                for task in tasks:
+                    task.result()
+
+        return np.array(np.load(os.path.join(folder, 'scores.npy')))
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def score_pairs(df,
+                pairs,
+                on,
+                comparator,
+                workers=None,
+                chunk_size=20000,
+                **kwargs):
+    """
+    score_pairs(df, pairs, on, comparator, workers=None, chunk_size=20000,
+                **kwargs)
+    Score candidate pairs of df, e.g. a recordlinkage index, on one column
+    with score_positions.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records, with a unique index.
+    pairs : pandas.MultiIndex
+        Pairs of df index labels.
+    on : str or tuple of str
+        Column compared on both sides, or a (left, right) pair of columns.
+    comparator : str
+        Name of a registered comparator.
+    workers, chunk_size, **kwargs :
+        See score_positions.
+    Returns
+    -------
+    pandas.Series
+        float32 scores indexed by pairs.
+    """
+    if isinstance(on, str):
+        left = right = df[on]
+    else:
+        left, right = df[on[0]], df[on[1]]
+    left_pos = df.index.get_indexer(pairs.get_level_values(0))
+    right_pos = df.index.get_indexer(pairs.get_level_values(1))
+    if (left_pos < 0).any() or (right_pos < 0).any():
+        raise KeyError('pairs contain labels that are not in df.index.')
+    scores = score_positions(left,
+                             right,
+                             left_pos,
+                             right_pos,
+                             comparator,
+                             workers=workers,
+                             chunk_size=chunk_size,
+                             **kwargs)
+    return pd.Series(scores, index=pairs)
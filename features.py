@@ -0,0 +1,410 @@
+import unicodedata
+from collections import Counter
+
+import pandas as pd
+import numpy as np
+
+from bitparallel import edit_similarity_batch
+from jaccard import ngrams
+from Modules.instrument import timed
+from LCS import (
+    longest_common_subsequence_batch,
+    longest_common_substring_batch,
+)
+from SmithWaterman import smith_waterman_batch
+from strbatch import StringColumn
+
+# The similarity measures of the notebook, in the order they are computed
+# there. Feature columns are named "<metric>_<field>".
+METRICS = (
+    'lsim',
+    'dlsim',
+    'jwsim',
+    'qgsim',
+    'csim',
+    'jaccsim',
+    'lcssim',
+    'LCSubSecsim',
+    'SWsim',
+)
+
+
+def _strip_accents(s):
+    """
+    _strip_accents(s)
+    Decompose s and drop its combining characters, like scikit-learn's
+    strip_accents_unicode.
+    """
+    if s.isascii():
+        return s
+    normalized = unicodedata.normalize('NFKD', s)
+    return ''.join(c for c in normalized if not unicodedata.combining(c))
+
+
+def wb_bigrams(s):
+    """
+    wb_bigrams(s)
+    Character bigrams inside word boundaries, each word padded with a
+    space, of the lowercased and accent stripped string. These are the
+    features recordlinkage's qgram and cosine methods count (scikit-learn
+    CountVectorizer with analyzer="char_wb" and ngram_range=(2, 2)).
+    Parameters
+    ----------
+    s : str
+        The string.
+    Returns
+    -------
+    list of str
+        The bigrams, with repetitions.
+    """
+    grams = []
+    for word in _strip_accents(s.lower()).split():
+        grams.extend(ngrams(' ' + word + ' ', 2))
+    return grams
+
+
+def _profiles(values, tokenize):
+    """
+    _profiles(values, tokenize)
+    Sparse n-gram count vectors of values, in CSR form (indptr, gram ids,
+    counts), with one shared vocabulary.
+    """
+    vocabulary = {}
+    indptr = [0]
+    grams = []
+    counts = []
+    for value in values:
+        for gram, count in Counter(tokenize(value)).items():
+            grams.append(vocabulary.setdefault(gram, len(vocabulary)))
+            counts.append(count)
+        indptr.append(len(grams))
+    return (np.array(indptr, dtype=np.int64),
+            np.array(grams, dtype=np.int64),
+            np.array(counts, dtype=np.float64),
+            len(vocabulary))
+
+
+def _expand(profile, rows):
+    """
+    _expand(profile, rows)
+    Entries of the given profile rows, as (row number, gram id, count).
+    """
+    indptr, grams, counts, _ = profile
+    starts = indptr[rows]
+    sizes = indptr[rows + 1] - starts
+    ends = np.cumsum(sizes)
+    entries = np.repeat(starts - (ends - sizes), sizes)
+    entries += np.arange(len(entries))
+    owner = np.repeat(np.arange(len(rows)), sizes)
+    return owner, grams[entries], counts[entries]
+
+
+def _overlap(profile, left, right):
+    """
+    _overlap(profile, left, right)
+    Sum of the element-wise minimum and dot product of the profile rows
+    left[i] and right[i], for every i.
+    """
+    n_grams = max(profile[3], 1)
+    owner_l, grams_l, counts_l = _expand(profile, left)
+    owner_r, grams_r, counts_r = _expand(profile, right)
+    # Gram ids are unique within a row, so (pair, gram) keys are unique
+    _, il, ir = np.intersect1d(owner_l * n_grams + grams_l,
+                               owner_r * n_grams + grams_r,
+                               assume_unique=True,
+                               return_indices=True)
+    owner = owner_l[il]
+    minimum = np.bincount(owner,
+                          weights=np.minimum(counts_l[il], counts_r[ir]),
+                          minlength=len(left))
+    dot = np.bincount(owner,
+                      weights=counts_l[il] * counts_r[ir],
+                      minlength=len(left))
+    return minimum, dot
+
+
+def _edit_similarity(s1, s2, metric):
+    """
+    _edit_similarity(s1, s2, metric)
+    dlsim or jwsim of non-null pairs, with jellyfish like recordlinkage:
+    1 - distance / longest length for the edit distance. jellyfish's
+    Damerau-Levenshtein distance is the unrestricted one, which the optimal
+    string alignment of bitparallel can exceed.
+    """
+    import jellyfish
+    function = {
+        'dlsim': jellyfish.damerau_levenshtein_distance,
+        'jwsim': jellyfish.jaro_winkler_similarity,
+    }[metric]
+    values = np.fromiter((function(a, b) for a, b in zip(s1, s2)),
+                         dtype=np.float64,
+                         count=len(s1))
+    if metric == 'jwsim':
+        return values
+    longest = np.fromiter((max(len(a), len(b)) for a, b in zip(s1, s2)),
+                          dtype=np.float64,
+                          count=len(s1))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return 1 - values / longest
+
+
+class _Field:
+    """
+    Per field preprocessing shared by all metrics: the unique values (also
+    as a StringColumn), the code of every record, and the n-gram profiles
+    of the qgram/cosine and Jaccard measures, computed once per unique
+    value.
+    """
+
+    def __init__(self, values, metrics):
+        codes, uniques = pd.factorize(values)
+        self.codes = codes
+        self.uniques = np.asarray(uniques, dtype=object)
+        self.column = StringColumn.from_values(self.uniques)
+        self.wb = None
+        self.bigrams = None
+        if 'qgsim' in metrics or 'csim' in metrics:
+            self.wb = _profiles(self.uniques, wb_bigrams)
+            self.wb_total = self._row_sums(self.wb, self.wb[2])
+            self.wb_norm = np.sqrt(self._row_sums(self.wb, self.wb[2] ** 2))
+        if 'jaccsim' in metrics:
+            self.bigrams = _profiles(self.uniques,
+                                     lambda s: set(ngrams(s, 2)))
+            self.bigram_total = self._row_sums(self.bigrams, self.bigrams[2])
+
+    def _row_sums(self, profile, weights):
+        rows = np.repeat(np.arange(len(self.uniques)), np.diff(profile[0]))
+        return np.bincount(rows, weights=weights, minlength=len(self.uniques))
+
+
+@timed(pairs=lambda df, pairs, *args, **kwargs: len(pairs))
+def compare_fields(df,
+                   pairs,
+                   fields,
+                   metrics=METRICS,
+                   missing_value=0.0,
+                   options=None,
+                   cache=None,
+                   chunk_size=100000):
+    """
+    compare_fields(df, pairs, fields, metrics=METRICS, missing_value=0.0,
+                   options=None, cache=None, chunk_size=100000)
+    Score candidate pairs on several fields with any subset of the nine
+    similarity measures of the notebook, in one pass.
+    For every field the strings of each chunk of pairs are gathered once
+    and shared by all the metrics, the n-gram profiles are computed once
+    per unique value, and each distinct pair of values is scored once per
+    chunk and broadcast back to all its pairs.
+    Scores follow the methods they replace:
+        lsim, dlsim, jwsim, qgsim, csim
+            recordlinkage String methods levenshtein, damerau_levenshtein,
+            jarowinkler, qgram and cosine
+        jaccsim
+            jaccard.jaccard_h of the bigrams (jaccard.ngrams)
+        lcssim
+            LCS.longest_common_substring_batch
+        LCSubSecsim
+            1 - strsimpy MetricLCS distance
+        SWsim
+            SmithWaterman.smith_waterman_batch
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records, with a unique index.
+    pairs : pandas.MultiIndex
+        Pairs of df index labels, e.g. the union of the blocking indexes.
+    fields : list of str
+        Columns of df to compare.
+    metrics : iterable of str
+        Measures to compute, among METRICS. Default: all of them.
+    missing_value : float
+        Score of pairs with a missing value, and of undefined scores such
+        as qgram of two empty strings, as recordlinkage does. Default: 0.
+    options : dict
+        Keyword arguments of the lcssim, LCSubSecsim and SWsim kernels by
+        metric, e.g. {'SWsim': {'norm': 'min', 'min_score': 0.5}}. Pairs
+        pruned by a min_score get strbatch.PRUNED.
+    cache : simcache.SimilarityCache
+        Cache of scores by metric and value pair, e.g. shared by several
+        calls or fields with common values. Default: no cache.
+    chunk_size : int
+        Number of pairs processed at once, bounds the memory used.
+    Returns
+    -------
+    pandas.DataFrame
+        float32 feature matrix indexed by pairs, with one "<metric>_<field>"
+        column per metric and field, metric by metric.
+    """
+    metrics = _check_metrics(metrics)
+    options = options or {}
+
+    left_pos = df.index.get_indexer(pairs.get_level_values(0))
+    right_pos = df.index.get_indexer(pairs.get_level_values(1))
+    if (left_pos < 0).any() or (right_pos < 0).any():
+        raise KeyError('pairs contain labels that are not in df.index.')
+
+    columns = {
+        '%s_%s' % (metric, field): np.full(len(pairs),
+                                           missing_value,
+                                           dtype=np.float32)
+        for metric in metrics
+        for field in fields
+    }
+    for field in fields:
+        data = _Field(df[field], metrics)
+        for lo in range(0, len(pairs), chunk_size):
+            hi = min(lo + chunk_size, len(pairs))
+            sims = _score_chunk(data,
+                                data.codes[left_pos[lo:hi]],
+                                data.codes[right_pos[lo:hi]],
+                                metrics,
+                                options,
+                                cache)
+            for metric, values in sims.items():
+                columns['%s_%s' % (metric, field)][lo:hi] = np.where(
+                    np.isnan(values), missing_value, values)
+
+    return pd.DataFrame(columns, index=pairs)
+
+
+def iter_scores(df,
+                left_pos,
+                right_pos,
+                fields,
+                metrics=METRICS,
+                missing_value=0.0,
+                options=None,
+                cache=None,
+                chunk_size=100000,
+                done=()):
+    """
+    iter_scores(df, left_pos, right_pos, fields, metrics=METRICS,
+                missing_value=0.0, options=None, cache=None,
+                chunk_size=100000, done=())
+    Scores of compare_fields, chunk_size pairs at a time, for pair lists
+    too large to score at once. The fields are prepared once for all
+    chunks, so memory grows with the number of records and chunk_size,
+    not with the number of pairs.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    left_pos, right_pos : numpy.ndarray
+        Positions of the pairs in df, e.g. from blocking.block_pairs.
+        Memory-mapped arrays are only read one chunk at a time.
+    fields, metrics, missing_value, options, cache :
+        See compare_fields.
+    chunk_size : int
+        Number of pairs per chunk.
+    done : collection of int
+        Numbers of the chunks to skip, e.g. already stored ones.
+    Yields
+    ------
+    tuple
+        (chunk number, first pair, pandas.DataFrame) with the
+        "<metric>_<field>" float32 columns of the pairs of the chunk.
+    """
+    metrics = _check_metrics(metrics)
+    options = options or {}
+    data = {field: _Field(df[field], metrics) for field in fields}
+    for number, lo in enumerate(range(0, len(left_pos), chunk_size)):
+        if number in done:
+            continue
+        hi = min(lo + chunk_size, len(left_pos))
+        left = np.asarray(left_pos[lo:hi])
+        right = np.asarray(right_pos[lo:hi])
+        columns = {}
+        for field in fields:
+            sims = _score_chunk(data[field],
+                                data[field].codes[left],
+                                data[field].codes[right],
+                                metrics,
+                                options,
+                                cache)
+            for metric, values in sims.items():
+                columns['%s_%s' % (metric, field)] = np.where(
+                    np.isnan(values), missing_value, values
+                ).astype(np.float32)
+        # Same column order as compare_fields
+        yield number, lo, pd.DataFrame({
+            '%s_%s' % (metric, field): columns['%s_%s' % (metric, field)]
+            for metric in metrics
+            for field in fields
+        })
+
+
+def _check_metrics(metrics):
+    """
+    _check_metrics(metrics)
+    The requested metrics in METRICS order, or ValueError.
+    """
+    unknown = set(metrics) - set(METRICS)
+    if unknown:
+        raise ValueError('Unknown metrics: %s.' % ', '.join(sorted(unknown)))
+    return [metric for metric in METRICS if metric in set(metrics)]
+
+
+def _score_chunk(data, left, right, metrics, options, cache):
+    """
+    _score_chunk(data, left, right, metrics, options, cache)
+    All requested metrics of the pairs of unique value codes (left[i],
+    right[i]) of one field. Each distinct pair is scored once, through the
+    cache when there is one. Pairs with a missing side get NaN.
+    """
+    n_pairs = len(left)
+    n_values = max(len(data.uniques), 1)
+    valid = np.flatnonzero((left >= 0) & (right >= 0))
+    keys, inverse = np.unique(left[valid] * n_values + right[valid],
+                              return_inverse=True)
+    left, right = np.divmod(keys, n_values)
+
+    scores = {}
+    for metric in metrics:
+        if cache is None:
+            values = _metric(data, metric, left, right, options)
+        else:
+            values = cache.score(
+                (metric, tuple(sorted(options.get(metric, {}).items()))),
+                data.uniques[left],
+                data.uniques[right],
+                lambda todo: _metric(data, metric, left[todo], right[todo],
+                                     options),
+            )
+        scores[metric] = np.full(n_pairs, np.nan)
+        scores[metric][valid] = values[inverse.ravel()]
+    return scores
+
+
+def _metric(data, metric, left, right, options):
+    """
+    _metric(data, metric, left, right, options)
+    One metric of the pairs of unique value codes (left[i], right[i]).
+    """
+    if metric == 'lsim':
+        return edit_similarity_batch(data.column.take(left),
+                                     data.column.take(right))
+    if metric in ('dlsim', 'jwsim'):
+        return _edit_similarity(data.uniques[left], data.uniques[right],
+                                metric)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if metric == 'qgsim':
+            minimum, _ = _overlap(data.wb, left, right)
+            return minimum / np.maximum(data.wb_total[left],
+                                        data.wb_total[right])
+        if metric == 'csim':
+            _, dot = _overlap(data.wb, left, right)
+            return dot / (data.wb_norm[left] * data.wb_norm[right])
+        if metric == 'jaccsim':
+            common, _ = _overlap(data.bigrams, left, right)
+            union = (data.bigram_total[left] + data.bigram_total[right]
+                     - common)
+            return np.where(union > 0, common / np.maximum(union, 1), 0)
+    s1 = data.column.take(left)
+    s2 = data.column.take(right)
+    if metric == 'lcssim':
+        return longest_common_substring_batch(s1, s2,
+                                              **options.get('lcssim', {}))
+    if metric == 'LCSubSecsim':
+        return longest_common_subsequence_batch(
+            s1, s2, **options.get('LCSubSecsim', {}))
+    return smith_waterman_batch(s1, s2, **options.get('SWsim', {}))
@@ -1,3 +1,16 @@
+import numpy as np
+
+from Modules.instrument import (
+    batch_pairs,
+    timed,
+)
+from strbatch import (
+    PRUNED,
+    StringColumn,
+    count_pruned,
+)
+
+
 def jaccard_h(s1, s2):
     """ Jaccard similarity score.  (1 - jaccard) is a valid distance metric """
     a = set(s1)
@@ -12,3 +25,107 @@ def ngrams(seq, n):
     """List all the (overlapping) ngrams in a sequence."""
     return [seq[i:i + n] for i in range(1 + len(seq) - n)]
 
+
+@timed(pairs=batch_pairs)
+def jaccard_batch(s1, s2, n=2, min_score=None, stats=None):
+    """
+    jaccard_batch(s1, s2, n=2, min_score=None, stats=None)
+    jaccard_h of the n-grams of two aligned string arrays, computed on
+    their codepoint buffers: every n-gram is packed into one integer key,
+    and the n-gram sets of both sides are intersected with a single sort.
+    With min_score, pairs whose set sizes alone rule it out (the smaller
+    set over the larger one is below it) are left out of the sort.
+    Parameters
+    ----------
+    s1 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Left strings.
+    s2 : pandas.Series, list, numpy.ndarray or strbatch.StringColumn
+        Right strings, aligned by position with s1.
+    n : int
+        Size of the n-grams. Default: 2.
+    min_score : float
+        Threshold on the returned values. Pairs that are proven to stay
+        below it get strbatch.PRUNED instead of their score. Default: None
+    stats : dict
+        When given, stats["pruned"] is increased by the number of pruned
+        pairs.
+    Returns
+    -------
+    numpy.ndarray
+        A float array of similarities, 0 when neither string has an
+        n-gram and NaN for missing values.
+    """
+    a = StringColumn.from_values(s1)
+    b = StringColumn.from_values(s2)
+
+    if len(a) != len(b):
+        raise ValueError('Arrays or Series have to be same length.')
+
+    # Both sides must pack codepoints the same way
+    bits = 8 if a.codes.dtype == b.codes.dtype == np.uint8 else 21
+    rows_a, keys_a = _ngram_keys(a, n, bits)
+    rows_b, keys_b = _ngram_keys(b, n, bits)
+    size_a = np.bincount(rows_a, minlength=len(a))
+    size_b = np.bincount(rows_b, minlength=len(b))
+    null = a.null | b.null
+
+    pruned = np.zeros(len(a), dtype=bool)
+    if min_score is not None:
+        larger = np.maximum(size_a, size_b)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bound = np.where(larger > 0,
+                             np.minimum(size_a, size_b) / larger, 0)
+        pruned = ~null & (bound < min_score * (1 - 1e-9))
+        kept_a = ~pruned[rows_a]
+        kept_b = ~pruned[rows_b]
+        rows_a, keys_a = rows_a[kept_a], keys_a[kept_a]
+        rows_b, keys_b = rows_b[kept_b], keys_b[kept_b]
+
+    # Each side holds distinct (row, key) entries, so an entry found twice
+    # after sorting both sides together is in the intersection
+    rows = np.concatenate((rows_a, rows_b))
+    keys = np.concatenate((keys_a, keys_b))
+    order = np.lexsort((keys, rows))
+    rows = rows[order]
+    keys = keys[order]
+    common = (rows[1:] == rows[:-1]) & (keys[1:] == keys[:-1])
+    common = np.bincount(rows[1:][common], minlength=len(a))
+
+    union = size_a + size_b - common
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sims = np.where(union > 0, common / np.maximum(union, 1), 0.0)
+    sims[pruned] = PRUNED
+    sims[null] = np.nan
+    count_pruned(stats, pruned)
+    return sims
+
+
+def _ngram_keys(column, n, bits):
+    """
+    _ngram_keys(column, n, bits)
+    Distinct n-grams of every value of a StringColumn as (row, key)
+    arrays, sorted by row. Keys pack the n codepoints, bits bits each,
+    exactly when they fit in 64 bits and are a multiplicative hash of
+    them otherwise.
+    """
+    codes = np.asarray(column.codes).astype(np.uint64)
+    lengths = column.lengths
+    counts = np.maximum(lengths - n + 1, 0)
+    rows = np.repeat(np.arange(len(column)), counts)
+    starts = np.repeat(column.offsets[:-1] - (np.cumsum(counts) - counts),
+                       counts) + np.arange(counts.sum())
+
+    keys = np.zeros(len(starts), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+        for k in range(n):
+            if bits * n <= 64:
+                keys = (keys << np.uint64(bits)) | codes[starts + k]
+            else:
+                keys = keys * np.uint64(0x9E3779B97F4A7C15) + codes[starts + k]
+
+    order = np.lexsort((keys, rows))
+    rows = rows[order]
+    keys = keys[order]
+    first = np.ones(len(rows), dtype=bool)
+    first[1:] = (rows[1:] != rows[:-1]) | (keys[1:] != keys[:-1])
+    return rows[first], keys[first]
@@ -0,0 +1,222 @@
+import pandas as pd
+import numpy as np
+
+from jaccard import ngrams
+from Modules.instrument import timed
+
+# Largest prime below 2 ** 32. With 32-bit n-gram hashes and coefficients
+# (a * x + b) fits in 64 bits and wraps around the prime many times.
+_PRIME = np.uint64(4294967291)
+_EMPTY = np.iinfo(np.uint32).max
+
+
+def minhash_signatures(strings, n=2, num_perm=128, seed=1, chunk_size=1 << 18):
+    """
+    minhash_signatures(strings, n=2, num_perm=128, seed=1)
+    MinHash signatures of the n-gram sets of a column of strings.
+    The n-grams are the ones jaccard_h compares (jaccard.ngrams), hashed
+    with a stable hash so signatures are reproducible across runs. Each of
+    the num_perm permutations is a universal hash (a * x + b) mod p, and
+    the minimum over a record's n-grams is taken with a segmented
+    reduction, num_perm x chunk_size hashes at a time.
+    Parameters
+    ----------
+    strings : pandas.Series, list or numpy.ndarray
+        The values to sign. Missing values are treated as empty strings.
+    n : int
+        Size of the n-grams. Default: 2.
+    num_perm : int
+        Number of permutations, i.e. the signature length. Default: 128.
+    seed : int
+        Seed of the permutations. Signatures are only comparable when they
+        were built with the same seed and num_perm. Default: 1.
+    chunk_size : int
+        Number of n-grams hashed at once, bounds the memory used.
+    Returns
+    -------
+    numpy.ndarray
+        A (len(strings), num_perm) uint32 matrix. Rows of strings shorter
+        than n are all set to the maximum uint32 value.
+    """
+    values = pd.Series(strings, dtype=object).fillna('').astype(str)
+    shingles = [sorted(set(ngrams(value, n))) for value in values]
+    counts = np.fromiter((len(s) for s in shingles), dtype=np.int64,
+                         count=len(shingles))
+    flat = np.fromiter((g for s in shingles for g in s), dtype=object,
+                       count=counts.sum())
+    hashes = pd.util.hash_array(flat) % _PRIME
+
+    rng = np.random.RandomState(seed)
+    a = rng.randint(1, _PRIME, size=num_perm, dtype=np.uint64)[:, None]
+    b = rng.randint(0, _PRIME, size=num_perm, dtype=np.uint64)[:, None]
+
+    signatures = np.full((len(values), num_perm), _EMPTY, dtype=np.uint32)
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    nonempty = np.flatnonzero(counts > 0)
+
+    # Process whole records, about chunk_size n-grams at a time.
+    start = 0
+    while start < len(nonempty):
+        stop = np.searchsorted(offsets[nonempty + 1],
+                               offsets[nonempty[start]] + chunk_size,
+                               side='right')
+        stop = max(stop, start + 1)
+        records = nonempty[start:stop]
+        lo = offsets[records[0]]
+        hi = offsets[records[-1] + 1]
+        permuted = (a * hashes[None, lo:hi] + b) % _PRIME
+        signatures[records] = np.minimum.reduceat(permuted,
+                                                  offsets[records] - lo,
+                                                  axis=1).T
+        start = stop
+
+    return signatures
+
+
+def lsh_params(threshold, num_perm=128):
+    """
+    lsh_params(threshold, num_perm=128)
+    Number of bands and rows per band whose S-curve threshold
+    (1 / bands) ** (1 / rows) is closest to the requested Jaccard
+    threshold.
+    Parameters
+    ----------
+    threshold : float
+        Target Jaccard similarity, between 0 and 1.
+    num_perm : int
+        Signature length. Default: 128.
+    Returns
+    -------
+    tuple of int
+        (bands, rows), with bands * rows <= num_perm.
+    """
+    best = None
+    for rows in range(1, num_perm + 1):
+        bands = num_perm // rows
+        error = abs((1 / bands) ** (1 / rows) - threshold)
+        if best is None or error < best[0]:
+            best = (error, bands, rows)
+    return best[1], best[2]
+
+
+def lsh_candidate_pairs(signatures,
+                        threshold=0.5,
+                        bands=None,
+                        rows=None,
+                        max_bucket=1000,
+                        max_memory=1 << 26):
+    """
+    lsh_candidate_pairs(signatures, threshold=0.5, bands=None, rows=None,
+                        max_bucket=1000, max_memory=1 << 26)
+    Candidate pairs of records sharing at least one LSH band bucket, whose
+    estimated Jaccard similarity is at least threshold.
+    Each band of rows signature values is used as a bucket key; all record
+    pairs within a bucket are candidates. Buckets with more than
+    max_bucket records are skipped, so the number of pairs grows with the
+    number of records rather than with the square of the bucket sizes.
+    Parameters
+    ----------
+    signatures : numpy.ndarray
+        Output of minhash_signatures.
+    threshold : float
+        Minimum estimated Jaccard similarity of the returned pairs.
+        Default: 0.5.
+    bands, rows : int
+        Banding of the signatures. Chosen with lsh_params from the
+        threshold when not given.
+    max_bucket : int
+        Largest bucket expanded into pairs. Default: 1000.
+    max_memory : int
+        Bytes used to estimate the similarities: the pairs are estimated a
+        chunk at a time, each pair taking both signature rows and their
+        comparison. Default: 64 MiB.
+    Returns
+    -------
+    tuple of numpy.ndarray
+        Positions (left, right) of the candidate pairs, left < right,
+        sorted and without duplicates.
+    """
+    n_records, num_perm = signatures.shape
+    if bands is None or rows is None:
+        bands, rows = lsh_params(threshold, num_perm)
+    if bands * rows > num_perm:
+        raise ValueError('bands * rows must not exceed the signature length.')
+
+    signed = np.flatnonzero(signatures[:, 0] != _EMPTY)
+    keys = [np.array([], dtype=np.int64)]
+    for band in range(bands):
+        block = np.ascontiguousarray(
+            signatures[signed, band * rows:(band + 1) * rows])
+        _, buckets = np.unique(block.view('V%d' % (4 * rows)).ravel(),
+                               return_inverse=True)
+        keys.append(_bucket_pairs(signed, buckets, max_bucket, n_records))
+    keys = np.unique(np.concatenate(keys))
+
+    left = keys // n_records
+    right = keys % n_records
+    keep = np.zeros(len(keys), dtype=bool)
+    chunk_size = max(max_memory // (num_perm * (2 * 4 + 1)), 1)
+    for lo in range(0, len(keys), chunk_size):
+        hi = lo + chunk_size
+        estimate = (signatures[left[lo:hi]]
+                    == signatures[right[lo:hi]]).mean(axis=1)
+        keep[lo:hi] = estimate >= threshold
+    return left[keep], right[keep]
+
+
+def _bucket_pairs(records, buckets, max_bucket, n_records):
+    """
+    _bucket_pairs(records, buckets, max_bucket, n_records)
+    All pairs of records sharing a bucket, encoded as
+    left * n_records + right with left < right.
+    """
+    order = np.argsort(buckets, kind='stable')
+    records = records[order]
+    buckets = buckets[order]
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    sizes = np.diff(np.r_[starts, len(buckets)])
+    usable = (sizes > 1) & (sizes <= max_bucket)
+
+    # Expand all buckets of the same size at once.
+    pairs = [np.array([], dtype=np.int64)]
+    for size in np.unique(sizes[usable]):
+        members = records[starts[sizes == size][:, None] + np.arange(size)]
+        i, j = np.triu_indices(size, 1)
+        left = np.minimum(members[:, i], members[:, j])
+        right = np.maximum(members[:, i], members[:, j])
+        pairs.append((left * n_records + right).ravel())
+    return np.concatenate(pairs)
+
+
+@timed(rows=lambda df, *args, **kwargs: len(df))
+def lsh_index(df, on, n=2, threshold=0.5, num_perm=128, seed=1,
+              max_bucket=1000):
+    """
+    lsh_index(df, on, n=2, threshold=0.5, num_perm=128, seed=1,
+              max_bucket=1000)
+    Candidate record pairs of df by MinHash LSH on the n-grams of one or
+    more columns, as a drop-in complement to recordlinkage Block indexes.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    on : str or list of str
+        Column(s) to sign. Several columns are joined with a space, like
+        the notebook's name and direccion fields.
+    n, threshold, num_perm, seed, max_bucket :
+        See minhash_signatures and lsh_candidate_pairs.
+    Returns
+    -------
+    pandas.MultiIndex
+        Pairs of df index labels, which can be unioned with the pairs of
+        a recordlinkage Block index.
+    """
+    if isinstance(on, str):
+        values = df[on]
+    else:
+        values = df[list(on)].astype(str).agg(' '.join, axis=1)
+    signatures = minhash_signatures(values, n=n, num_perm=num_perm, seed=seed)
+    left, right = lsh_candidate_pairs(signatures,
+                                      threshold=threshold,
+                                      max_bucket=max_bucket)
+    return pd.MultiIndex.from_arrays([df.index[left], df.index[right]])
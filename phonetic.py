@@ -0,0 +1,173 @@
+import json
+import os
+import re
+import unicodedata
+
+import pandas as pd
+import numpy as np
+
+from recordlinkage.standardise import phonetic as _phonetic
+
+# Methods of recordlinkage.standardise.phonetic, plus the Spanish encoder
+METHODS = ('soundex', 'nysiis', 'metaphone', 'match_rating', 'spanish')
+
+# Spanish spelling to sound rules, applied in order to upper case letters.
+# Ñ is read as N, since it is often typed without its tilde, and CH and SH
+# are written 0, as metaphone writes TH. Soft G goes to J before the silent
+# U of GUE and GUI is dropped, so that their G stays hard.
+_SPANISH = [
+    (re.compile(r'[^A-Z]'), ''),
+    (re.compile(r'PH'), 'F'),
+    (re.compile(r'CH'), '0'),
+    (re.compile(r'SH'), '0'),
+    (re.compile(r'H'), ''),
+    (re.compile(r'LL'), 'Y'),
+    (re.compile(r'QU'), 'K'),
+    (re.compile(r'G(?=[EI])'), 'J'),
+    (re.compile(r'GU(?=[EI])'), 'G'),
+    (re.compile(r'C(?=[EI])'), 'S'),
+    (re.compile(r'[CQ]'), 'K'),
+    (re.compile(r'Z'), 'S'),
+    (re.compile(r'X(?=[AEIOU])'), 'J'),
+    (re.compile(r'X'), 'KS'),
+    (re.compile(r'[VW]'), 'B'),
+    (re.compile(r'Y(?![AEIOU])'), 'I'),
+    (re.compile(r'(.)\1+'), r'\1'),
+]
+
+# Bump when spanish_key changes, so that the keys kept in PhoneticCache
+# files by older versions are encoded again
+SPANISH_VERSION = 2
+
+
+def spanish_key(value):
+    """
+    spanish_key(value)
+    Phonetic key of a Spanish name. Accents are dropped, H is silent, LL
+    and Y, B and V, and Z, S and soft C sound alike, hard C, K and QU
+    sound alike, as do soft G and J, and doubled letters are read once.
+    Parameters
+    ----------
+    value : str
+        The name.
+    Returns
+    -------
+    str
+        The key, e.g. 'BAYE' for both 'VALLE' and 'BAYE'.
+    Examples
+    --------
+    >>> [spanish_key(name) for name in ('MIGUEL', 'GUILLERMO', 'GERARDO')]
+    ['MIGEL', 'GIYERMO', 'JERARDO']
+    >>> spanish_key('GUERRERO'), spanish_key('GERRERO')
+    ('GERERO', 'JERERO')
+    """
+    value = unicodedata.normalize('NFKD', value.upper())
+    value = ''.join(c for c in value if not unicodedata.combining(c))
+    for regexp, substitution in _SPANISH:
+        value = regexp.sub(substitution, value)
+    return value
+
+
+def _encode(values, method):
+    """
+    _encode(values, method)
+    Keys of distinct non-missing values, as recordlinkage phonetic does,
+    whitespace, dashes and underscores removed.
+    """
+    values = pd.Series(values, dtype=object)
+    if method != 'spanish':
+        return _phonetic(values, method=method).to_numpy(dtype=object)
+    values = values.str.replace(r'[\-\_\s]', '', regex=True)
+    return np.array([spanish_key(value) for value in values], dtype=object)
+
+
+class PhoneticCache:
+    """
+    Phonetic keys by method and value, computed once per distinct value
+    and broadcast back to the rows. The dictionary can be kept in a JSON
+    file between runs.
+    Parameters
+    ----------
+    path : str
+        JSON file of the dictionary, read when it exists and written by
+        save. Default: None, nothing is kept.
+    Examples
+    --------
+    >>> cache = PhoneticCache('base_datos_covid/.phonetic.json')
+    >>> df['nombre_soundex'] = cache.encode(df['nombre'], 'soundex')
+    >>> cache.save()
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.keys = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as file:
+                self.keys = json.load(file)
+            if self.keys.pop('spanish_version', 1) != SPANISH_VERSION:
+                self.keys.pop('spanish', None)
+
+    def encode(self, values, method='spanish'):
+        """
+        encode(values, method='spanish')
+        Phonetic keys of a column, encoding only the values not seen yet.
+        Parameters
+        ----------
+        values : pandas.Series
+            The names. Missing values get a missing key.
+        method : str
+            One of METHODS. Default: 'spanish'.
+        Returns
+        -------
+        pandas.Series
+            Categorical keys with the index of values.
+        """
+        if method not in METHODS:
+            raise ValueError("The algorithm '%s' is not known." % method)
+        codes, uniques = pd.factorize(values)
+        uniques = np.asarray(uniques, dtype=object).astype(str)
+        known = self.keys.setdefault(method, {})
+        new = [value for value in uniques if value not in known]
+        if new:
+            known.update(zip(new, _encode(new, method)))
+        key_codes, categories = pd.factorize(
+            np.array([known[value] for value in uniques], dtype=object))
+        codes = np.where(codes < 0, -1, np.append(key_codes, -1)[codes])
+        keys = pd.Categorical.from_codes(codes, categories)
+        return pd.Series(keys, index=values.index, name=values.name)
+
+    def save(self):
+        """
+        save()
+        Write the dictionary to path, through a temporary file so an
+        interrupted run leaves the previous one.
+        """
+        if self.path is None:
+            return
+        with open(self.path + '.tmp', 'w') as file:
+            json.dump(dict(self.keys, spanish_version=SPANISH_VERSION),
+                      file)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def combined_key(df, columns):
+    """
+    combined_key(df, columns)
+    Integer id of the combination of several key columns, e.g. the
+    notebook's id_soundex of the soundex keys of nombre, apepater and
+    apemater, grouping their categorical codes instead of joining strings.
+    Missing keys are a value of their own, as 'nan' is in the joined
+    strings.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The keys, e.g. from PhoneticCache.encode.
+    columns : list of str
+        Columns to combine.
+    Returns
+    -------
+    pandas.Series
+        int64 ids with the index of df, equal for equal combinations.
+    """
+    return df.groupby(list(columns), sort=False, dropna=False,
+                      observed=True).ngroup().astype(np.int64)
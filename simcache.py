@@ -0,0 +1,223 @@
+import sys
+from collections import OrderedDict
+
+import pandas as pd
+import numpy as np
+
+from strbatch import (
+    PRUNED,
+    as_object_array,
+    count_pruned,
+)
+
+# Rough memory of one cache entry besides its two strings: the key tuple,
+# the float and the OrderedDict node
+_ENTRY_OVERHEAD = 200
+
+
+def unique_pairs(s1, s2):
+    """
+    unique_pairs(s1, s2)
+    Distinct (s1[i], s2[i]) value pairs of two aligned string arrays.
+    Parameters
+    ----------
+    s1 : pandas.Series, list or numpy.ndarray
+        Left strings.
+    s2 : pandas.Series, list or numpy.ndarray
+        Right strings, aligned by position with s1.
+    Returns
+    -------
+    tuple of numpy.ndarray
+        (left, right, inverse): the distinct pairs as two object arrays,
+        and for every input pair the position of its distinct pair, so
+        that scores of the distinct pairs broadcast back with
+        scores[inverse].
+    """
+    a = as_object_array(s1)
+    b = as_object_array(s2)
+    if len(a) != len(b):
+        raise ValueError('Arrays or Series have to be same length.')
+    codes, uniques = pd.factorize(np.concatenate((a, b)))
+    # Missing values have code -1
+    keys = (codes[:len(a)] + 1) * (len(uniques) + 1) + codes[len(a):] + 1
+    _, first, inverse = np.unique(keys, return_index=True,
+                                  return_inverse=True)
+    return a[first], b[first], inverse.ravel()
+
+
+class SimilarityCache:
+    """
+    Bounded LRU cache of similarity scores keyed by comparator and
+    ordered value pair, shared by all the comparators it wraps.
+    Pairs with a missing value are always computed and never stored.
+    Parameters
+    ----------
+    max_entries : int
+        Largest number of stored scores. Default: 1000000.
+    max_bytes : int
+        Approximate memory cap of the stored scores and their keys.
+        Default: 256 MiB.
+    Examples
+    --------
+    >>> cache = SimilarityCache()
+    >>> sw = cache.wrap(smith_waterman_batch, 'smith_waterman')
+    >>> scores = sw(df['nombre'], df['nombre1'], norm='mean')
+    >>> cache.stats()
+    """
+
+    def __init__(self, max_entries=1000000, max_bytes=256 << 20):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        stats()
+        Counters of the cache as a dict: hits, misses, evictions, entries,
+        approximate bytes and hit rate.
+        """
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self._entries),
+            'nbytes': self.nbytes,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def clear(self):
+        """
+        clear()
+        Drop all the stored scores. Counters are kept.
+        """
+        self._entries.clear()
+        self.nbytes = 0
+
+    def score(self, key, s1, s2, compute):
+        """
+        score(key, s1, s2, compute)
+        Scores of the pairs (s1[i], s2[i]), taken from the cache when
+        present and computed with compute otherwise.
+        Parameters
+        ----------
+        key : hashable
+            Identifies the comparator and its parameters.
+        s1, s2 : numpy.ndarray
+            Aligned object arrays of strings, ideally distinct pairs (see
+            unique_pairs), as repeated missing pairs are computed twice.
+        compute : callable
+            compute(positions) returns the scores of the pairs at the
+            given positions of s1 and s2.
+        Returns
+        -------
+        numpy.ndarray
+            A float array with one score per pair.
+        """
+        s1 = as_object_array(s1)
+        s2 = as_object_array(s2)
+        scores = np.empty(len(s1))
+        entries = self._entries
+        null = pd.isnull(s1) | pd.isnull(s2)
+
+        missing = []
+        for i in np.flatnonzero(~null):
+            pair = (key, s1[i], s2[i])
+            value = entries.get(pair)
+            if value is None:
+                missing.append(i)
+            else:
+                entries.move_to_end(pair)
+                scores[i] = value
+        self.hits += int((~null).sum()) - len(missing)
+        self.misses += len(missing)
+
+        todo = np.concatenate((np.flatnonzero(null),
+                               np.array(missing, dtype=np.int64)))
+        if len(todo):
+            scores[todo] = compute(todo)
+        for i in missing:
+            pair = (key, s1[i], s2[i])
+            entries[pair] = scores[i]
+            self.nbytes += (sys.getsizeof(s1[i]) + sys.getsizeof(s2[i])
+                            + _ENTRY_OVERHEAD)
+        self._evict()
+        return scores
+
+    def _evict(self):
+        entries = self._entries
+        while entries and (len(entries) > self.max_entries
+                           or self.nbytes > self.max_bytes):
+            (_, a, b), _ = entries.popitem(last=False)
+            self.nbytes -= sys.getsizeof(a) + sys.getsizeof(b) \
+                + _ENTRY_OVERHEAD
+            self.evictions += 1
+
+    def wrap(self, func, name=None):
+        """
+        wrap(func, name=None)
+        Put the cache in front of a pair comparator: func(s1, s2, **kwargs)
+        returning one score per pair, such as smith_waterman_batch,
+        longest_common_substring_batch, jaccard_batch or the functions of
+        recordlinkage.algorithms.string.
+        The wrapped comparator scores each distinct value pair once per
+        call, looks it up in the cache first, and broadcasts the scores
+        back to all pairs. A stats dict is not part of the cache key nor
+        passed to func: stats["pruned"] is increased by the number of
+        pairs scored strbatch.PRUNED, cached ones included, as the batch
+        kernels do.
+        Parameters
+        ----------
+        func : callable
+            The comparator. It is called with two pandas Series.
+        name : str
+            Cache key of the comparator. Default: its qualified name.
+        Returns
+        -------
+        callable
+            wrapper(s1, s2, **kwargs) returning a float array.
+        """
+        name = name or func.__qualname__
+
+        def wrapper(s1, s2, stats=None, **kwargs):
+            key = (name, tuple(sorted(
+                (option, value if _hashable(value) else repr(value))
+                for option, value in kwargs.items()
+            )))
+            left, right, inverse = unique_pairs(s1, s2)
+            scores = self.score(
+                key,
+                left,
+                right,
+                lambda todo: np.asarray(
+                    func(pd.Series(left[todo]), pd.Series(right[todo]),
+                         **kwargs),
+                    dtype=np.float64,
+                ),
+            )
+            scores = scores[inverse]
+            count_pruned(stats, scores == PRUNED)
+            return scores
+
+        wrapper.__name__ = getattr(func, '__name__', name)
+        wrapper.__doc__ = func.__doc__
+        return wrapper
+
+
+def _hashable(value):
+    """
+    _hashable(value)
+    Whether value can be part of a cache key.
+    """
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
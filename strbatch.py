@@ -0,0 +1,269 @@
+from os import makedirs
+from os.path import join
+
+import pandas as pd
+import numpy as np
+
+# Value given by kernels to pairs skipped because they cannot reach the
+# requested min_score. Similarities are never negative.
+PRUNED = -1.0
+
+
+def as_object_array(s):
+    """
+    as_object_array(s)
+    Convert a Series, list or array of strings to a 1-D object array,
+    dropping any pandas index so pairs are aligned by position.
+    Parameters
+    ----------
+    s : pandas.Series, list or numpy.ndarray
+        The values to convert.
+    Returns
+    -------
+    numpy.ndarray
+        An object array with the same length as s.
+    """
+    if isinstance(s, (pd.Series, pd.Index)):
+        return s.to_numpy(dtype=object, na_value=np.nan)
+    return np.asarray(s, dtype=object)
+
+
+def count_pruned(stats, pruned):
+    """
+    count_pruned(stats, pruned)
+    Add the number of pruned pairs to stats["pruned"], when stats is a
+    dict.
+    Parameters
+    ----------
+    stats : dict or None
+        Counters of the caller.
+    pruned : numpy.ndarray
+        Boolean mask of the pruned pairs.
+    """
+    if stats is not None:
+        stats['pruned'] = stats.get('pruned', 0) + int(np.sum(pruned))
+
+
+def length_groups(len1, len2, bucket=8, batch_size=4096):
+    """
+    length_groups(len1, len2, bucket=8, batch_size=4096)
+    Split pair positions into groups of similar string lengths, so each
+    group can be padded to a common shape with little waste.
+    Parameters
+    ----------
+    len1 : numpy.ndarray
+        Lengths of the left strings.
+    len2 : numpy.ndarray
+        Lengths of the right strings.
+    bucket : int
+        Width of a length bucket. Pairs whose lengths fall in the same
+        buckets end up in the same group. Default: 8.
+    batch_size : int
+        Maximum number of pairs in a group. Default: 4096.
+    Returns
+    -------
+    generator of numpy.ndarray
+        Positions of the pairs in each group.
+    """
+    if len(len1) == 0:
+        return
+    key1 = (len1 - 1) // bucket
+    key2 = (len2 - 1) // bucket
+    order = np.lexsort((key2, key1))
+    key1 = key1[order]
+    key2 = key2[order]
+    change = np.flatnonzero((np.diff(key1) != 0) | (np.diff(key2) != 0)) + 1
+    bounds = np.concatenate(([0], change, [len(order)]))
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        for lo in range(start, stop, batch_size):
+            yield order[lo:min(lo + batch_size, stop)]
+
+
+class StringColumn:
+    """
+    A column of strings stored like an Arrow string array: one contiguous
+    buffer of codepoints, an int64 offsets array (value i is
+    codes[offsets[i]:offsets[i + 1]]) and a null mask.
+    Columns whose characters all fit in latin-1 (Spanish text does) use
+    one byte per character, other columns use uint32 codepoints. Kernels
+    read the buffers directly, with no Python object per value.
+    Parameters
+    ----------
+    codes : numpy.ndarray
+        uint8 or uint32 codepoints of all the values, back to back.
+    offsets : numpy.ndarray
+        int64 start of every value in codes, plus the end of the last one.
+    null : numpy.ndarray
+        Boolean mask of the missing values, which are stored empty.
+    """
+
+    def __init__(self, codes, offsets, null):
+        self.codes = codes
+        self.offsets = offsets
+        self.null = null
+
+    @classmethod
+    def from_values(cls, values):
+        """
+        from_values(values)
+        Build a column from a Series (categorical or Arrow backed ones are
+        converted without going through Python strings), list or array.
+        """
+        if isinstance(values, cls):
+            return values
+        if isinstance(values, pd.Series):
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                # Missing values have code -1, the extra last category
+                categories = np.append(
+                    values.cat.categories.to_numpy(dtype=object), np.nan)
+                return cls.from_values(categories).take(
+                    values.cat.codes.to_numpy())
+            if isinstance(values.dtype, pd.ArrowDtype) or getattr(
+                    values.dtype, 'storage', None) == 'pyarrow':
+                import pyarrow
+                return cls.from_arrow(pyarrow.array(values.array))
+        values = as_object_array(values)
+        null = pd.isnull(values)
+        strings = np.where(null, '', values)
+        lengths = np.fromiter(map(len, strings), dtype=np.int64,
+                              count=len(strings))
+        text = ''.join(strings)
+        try:
+            codes = np.frombuffer(text.encode('latin-1'), dtype=np.uint8)
+        except UnicodeEncodeError:
+            codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        return cls(codes, offsets, null)
+
+    @classmethod
+    def from_arrow(cls, array):
+        """
+        from_arrow(array)
+        Build a column from a pyarrow string array. Pure ASCII data is
+        used in place: the codepoints are the UTF-8 bytes.
+        """
+        import pyarrow
+        if isinstance(array, pyarrow.ChunkedArray):
+            array = array.combine_chunks()
+        if pyarrow.types.is_dictionary(array.type):
+            array = array.dictionary_decode()
+        _, offsets, data = array.buffers()
+        width = np.int64 if pyarrow.types.is_large_string(array.type) \
+            else np.int32
+        offsets = np.frombuffer(offsets, dtype=width)[
+            array.offset:array.offset + len(array) + 1]
+        data = np.frombuffer(data, dtype=np.uint8) if data is not None \
+            else np.zeros(0, dtype=np.uint8)
+        codes = data[offsets[0]:offsets[-1]]
+        if (codes >= 0x80).any():
+            return cls.from_values(array.to_numpy(zero_copy_only=False))
+        null = array.is_null().to_numpy(zero_copy_only=False)
+        return cls(codes, (offsets - offsets[0]).astype(np.int64), null)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """
+        load(path, mmap_mode='r')
+        Open a column written by save, memory-mapped by default so that
+        processes loading the same files share their pages.
+        """
+        return cls(*(
+            np.load(join(path, name + '.npy'), mmap_mode=mmap_mode)
+            for name in ('codes', 'offsets', 'null')
+        ))
+
+    def save(self, path):
+        """
+        save(path)
+        Write the three buffers as .npy files into the folder path.
+        """
+        makedirs(path, exist_ok=True)
+        np.save(join(path, 'codes.npy'), self.codes)
+        np.save(join(path, 'offsets.npy'), self.offsets)
+        np.save(join(path, 'null.npy'), self.null)
+
+    def __len__(self):
+        return len(self.null)
+
+    @property
+    def lengths(self):
+        """
+        Length of every value, 0 for missing values.
+        """
+        return np.diff(self.offsets)
+
+    def take(self, positions):
+        """
+        take(positions)
+        A new column with the values at positions (negative ones count
+        from the end), gathered in one pass over the buffer.
+        """
+        positions = np.asarray(positions, dtype=np.int64) % max(len(self), 1)
+        starts = np.asarray(self.offsets[positions])
+        lengths = np.asarray(self.offsets[positions + 1]) - starts
+        missing = np.asarray(self.null[positions])
+        offsets = np.zeros(len(positions) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        gather = np.repeat(starts - offsets[:-1], lengths)
+        gather += np.arange(len(gather))
+        return StringColumn(np.asarray(self.codes[gather]), offsets, missing)
+
+    def padded(self, positions, width):
+        """
+        padded(positions, width)
+        (len(positions), width) matrix of the codepoints of the values at
+        positions, right padded with 0, as the batch kernels consume them.
+        """
+        width = max(int(width), 1)
+        starts = np.asarray(self.offsets[positions])
+        lengths = np.asarray(self.offsets[positions + 1]) - starts
+        cols = np.arange(width)
+        inside = cols[None, :] < lengths[:, None]
+        index = np.where(inside, starts[:, None] + cols[None, :], 0)
+        if len(self.codes) == 0:
+            return np.zeros((len(starts), width), dtype=self.codes.dtype)
+        return np.where(inside, self.codes[index], 0).astype(self.codes.dtype)
+
+    def to_numpy(self):
+        """
+        to_numpy()
+        Decode the column to an object array of str, NaN for missing values.
+        """
+        codes = np.asarray(self.codes)
+        if codes.dtype == np.uint8:
+            text = codes.tobytes().decode('latin-1')
+        else:
+            text = codes.astype('<u4').tobytes().decode('utf-32-le')
+        start = int(self.offsets[0])
+        bounds = (np.asarray(self.offsets) - start).tolist()
+        values = np.empty(len(self), dtype=object)
+        values[:] = [text[lo:hi] for lo, hi in zip(bounds[:-1], bounds[1:])]
+        values[np.asarray(self.null)] = np.nan
+        return values
+
+    def to_arrow(self):
+        """
+        to_arrow()
+        The column as a pyarrow large_string array, sharing the buffers
+        when they hold ASCII text only.
+        """
+        import pyarrow
+        codes = np.asarray(self.codes)
+        if codes.dtype != np.uint8 or (codes >= 0x80).any():
+            return pyarrow.array(self.to_numpy(), type=pyarrow.large_string(),
+                                 from_pandas=True)
+        valid = np.packbits(~np.asarray(self.null), bitorder='little')
+        return pyarrow.LargeStringArray.from_buffers(
+            len(self),
+            pyarrow.py_buffer(np.ascontiguousarray(self.offsets)),
+            pyarrow.py_buffer(codes),
+            pyarrow.py_buffer(valid),
+        )
+
+    def to_pandas(self):
+        """
+        to_pandas()
+        The column as a pandas Series backed by to_arrow.
+        """
+        return pd.Series(pd.arrays.ArrowExtensionArray(self.to_arrow()))
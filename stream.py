@@ -0,0 +1,182 @@
+import json
+import os
+import shutil
+from glob import glob
+from hashlib import blake2b
+
+import pandas as pd
+import numpy as np
+
+from features import (
+    METRICS,
+    iter_scores,
+)
+from Modules.instrument import stage
+
+# Bump when the stored chunks change in a way older ones cannot be read
+STREAM_VERSION = 1
+
+
+def save_pairs(path, left, right):
+    """
+    save_pairs(path, left, right)
+    Store candidate pairs as a (2, n) int32 .npy file, which
+    score_to_parquet reads one chunk at a time through a memory map.
+    Parameters
+    ----------
+    path : str
+        The .npy file.
+    left, right : numpy.ndarray
+        Positions of the pairs, e.g. from blocking.block_pairs.
+    """
+    pairs = np.lib.format.open_memmap(path + '.tmp.npy',
+                                      mode='w+',
+                                      dtype=np.int32,
+                                      shape=(2, len(left)))
+    pairs[0] = left
+    pairs[1] = right
+    pairs.flush()
+    del pairs
+    os.replace(path + '.tmp.npy', path)
+
+
+def _fingerprint(left, right):
+    """
+    _fingerprint(left, right)
+    Hash of the first and last 65536 pairs, to recognize the pairs of an
+    interrupted run without reading them all.
+    """
+    key = blake2b(digest_size=16)
+    for positions in (left, right):
+        key.update(np.asarray(positions[:1 << 16], np.int64).tobytes())
+        key.update(np.asarray(positions[-(1 << 16):], np.int64).tobytes())
+    return key.hexdigest()
+
+
+def _part(path, number):
+    return os.path.join(path, 'part-%06d.parquet' % number)
+
+
+def score_to_parquet(df,
+                     pairs,
+                     fields,
+                     path,
+                     metrics=METRICS,
+                     missing_value=0.0,
+                     options=None,
+                     cache=None,
+                     chunk_size=1000000,
+                     overwrite=False):
+    """
+    score_to_parquet(df, pairs, fields, path, metrics=METRICS,
+                     missing_value=0.0, options=None, cache=None,
+                     chunk_size=1000000, overwrite=False)
+    Score candidate pairs chunk_size at a time and append each chunk of
+    features to a Parquet dataset, so memory is bounded by the chunk size
+    instead of the number of pairs.
+    Every chunk is written to a temporary file and renamed once complete.
+    A run interrupted by a crash resumes from the chunks already in path
+    when called again with the same pairs and settings.
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        The records.
+    pairs : str or tuple of numpy.ndarray
+        A .npy file of save_pairs, memory-mapped, or (left, right)
+        positions of the pairs in df.
+    fields, metrics, missing_value, options, cache :
+        See features.compare_fields.
+    path : str
+        Folder of the dataset, with one part-NNNNNN.parquet file per chunk
+        and a _manifest.json of the settings.
+    chunk_size : int
+        Number of pairs per chunk. Default: 1000000.
+    overwrite : bool
+        Remove a dataset made with other pairs or settings instead of
+        raising ValueError. Default: False.
+    Returns
+    -------
+    int
+        Number of chunks scored by this call.
+    """
+    if isinstance(pairs, str):
+        pairs = np.load(pairs, mmap_mode='r')
+    left, right = pairs
+    manifest = {
+        'version': STREAM_VERSION,
+        'n_pairs': len(left),
+        'pairs': _fingerprint(left, right),
+        'chunk_size': chunk_size,
+        'fields': list(fields),
+        'metrics': [metric for metric in METRICS if metric in metrics],
+        'missing_value': missing_value,
+        'options': options or {},
+    }
+    meta = os.path.join(path, '_manifest.json')
+    if os.path.exists(meta):
+        with open(meta) as file:
+            stored = json.load(file)
+        if stored != json.loads(json.dumps(manifest)):
+            if not overwrite:
+                raise ValueError('%s holds scores of other pairs or '
+                                 'settings.' % path)
+            shutil.rmtree(path)
+    if not os.path.exists(meta):
+        os.makedirs(path, exist_ok=True)
+        for old in glob(os.path.join(path, 'part-*.parquet')):
+            os.remove(old)
+        with open(meta + '.tmp', 'w') as file:
+            json.dump(manifest, file)
+        os.replace(meta + '.tmp', meta)
+
+    done = {
+        int(os.path.basename(name)[5:11])
+        for name in glob(os.path.join(path, 'part-*.parquet'))
+    }
+    scored = 0
+    chunks = iter_scores(df, left, right, fields,
+                         metrics=metrics,
+                         missing_value=missing_value,
+                         options=options,
+                         cache=cache,
+                         chunk_size=chunk_size,
+                         done=done)
+    for number, lo, features in chunks:
+        with stage('score_to_parquet.write', rows=len(features)):
+            hi = lo + len(features)
+            features.insert(0, 'left', np.asarray(left[lo:hi], np.int32))
+            features.insert(1, 'right', np.asarray(right[lo:hi], np.int32))
+            part = _part(path, number)
+            features.to_parquet(part + '.tmp', index=False)
+            os.replace(part + '.tmp', part)
+        scored += 1
+    return scored
+
+
+def read_scores(path, columns=None, filters=None):
+    """
+    read_scores(path, columns=None, filters=None)
+    Features stored by score_to_parquet, in pair order.
+    Parameters
+    ----------
+    path : str
+        Folder of the dataset.
+    columns : list of str
+        Columns to read, e.g. ['left', 'right', 'SWsim_nombre'].
+        Default: all of them.
+    filters :
+        Row filters of pandas.read_parquet, e.g.
+        [('SWsim_nombre', '>=', 0.8)].
+    Returns
+    -------
+    pandas.DataFrame
+        The left and right positions of the pairs and their features.
+    """
+    parts = sorted(glob(os.path.join(path, 'part-*.parquet')))
+    if not parts:
+        raise FileNotFoundError('No scores in %s.' % path)
+    return pd.concat(
+        [pd.read_parquet(part, columns=columns, filters=filters)
+         for part in parts],
+        ignore_index=True,
+    )